@@ -0,0 +1,106 @@
+"""
+Benchmark small-file ``put()``/``get()`` latency over SFTP and over SCP.
+
+A directory of small files is uploaded, then downloaded again, with each of
+:ref:`env.transfer_backend <transfer-backend>`'s values, through the same
+latency-adding proxy as ``bench_sftp.py``. SFTP uploads take four round
+trips per file (open, write, close, stat), where the SCP protocol needs two
+(announcing the file, then sending it), over a single channel for the whole
+tree. Tar streaming is turned off, so SFTP really goes file by file.
+
+The test suite's SSH server serves SFTP from memory, and runs the remote
+``scp`` locally, in a temporary directory; both are fast enough for network
+latency to dominate. It does hold every command's channel open for half a
+second after the command exits, which SCP downloads (ending when the channel
+does) pay once per call.
+
+Usage::
+
+    python benchmarks/bench_backends.py [files] [round trip ms ...]
+
+Defaults to 100 files of 1 KB each, over round trips of 0, 10 and 50 ms.
+"""
+
+from __future__ import with_statement
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from fabric.api import env, get, hide, put, settings
+from server import server, local_process, PASSWORDS, PORT, USER
+from bench_sftp import LatencyProxy
+
+
+class LocalHost(dict):
+    """
+    Server responses running any command through the local /bin/sh, in
+    directory ``home``.
+    """
+    def __init__(self, home):
+        self.home = home
+
+    def __contains__(self, command):
+        return True
+
+    def __getitem__(self, command):
+        return local_process(['/bin/sh', '-c', command],
+            environ={'HOME': self.home}, cwd=self.home)
+
+
+def bench(tree, port, home):
+    @server(responses=LocalHost(home))
+    def run():
+        env.host_string = '%s@127.0.0.1:%s' % (USER, port)
+        results = []
+        for backend in ('sftp', 'scp'):
+            back = tempfile.mkdtemp()
+            try:
+                with settings(hide('everything'), put_stream_threshold=0,
+                    transfer_backend=backend):
+                    start = time.time()
+                    put(tree, '/' if backend == 'sftp' else '')
+                    put_time = time.time() - start
+                    start = time.time()
+                    got = get('/small' if backend == 'sftp' else 'small',
+                        back)
+                    get_time = time.time() - start
+            finally:
+                shutil.rmtree(back)
+            assert len(got) == len(os.listdir(tree))
+            results.append((backend, put_time, get_time))
+        return results
+    return run()
+
+
+def main(files=100, *latencies):
+    work = tempfile.mkdtemp()
+    try:
+        tree = os.path.join(work, 'small')
+        os.mkdir(tree)
+        for i in range(files):
+            with open(os.path.join(tree, 'file%04d' % i), 'wb') as fd:
+                fd.write(os.urandom(1024))
+        env.disable_known_hosts = True
+        env.password = PASSWORDS[USER]
+        for i, latency in enumerate(latencies or (0, 10, 50)):
+            port = PORT + 100 + i
+            LatencyProxy(port, PORT, latency / 2000.0)
+            print("Round trip: %d ms, %d files of 1 KB" % (latency, files))
+            home = os.path.join(work, 'home%d' % i)
+            os.mkdir(home)
+            for backend, put_time, get_time in bench(tree, port, home):
+                print("  %-6s put %8.1f ms/file   get %8.1f ms/file" % (
+                    backend, put_time * 1000 / files,
+                    get_time * 1000 / files))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,102 @@
+"""
+Benchmark ``run(..., compress=True)`` over a bandwidth-limited stand-in link.
+
+A fake channel trickles bytes out at a fixed rate (standing in for a slow WAN
+link) into `fabric.io.OutputLooper`, once as plain text and once gzipped the
+way `~fabric.operations._compress_wrap` would produce it. Wall-clock time for
+each, including local decompression, is reported.
+
+Usage::
+
+    python benchmarks/bench_compress.py [KB/sec] [MB of output]
+
+Defaults to a 512 KB/s link carrying 8 MB of ``journalctl``-style output.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fabric.api import env, hide
+from fabric.io import OutputLooper
+
+
+class ThrottledChannel(object):
+    """
+    Just enough of a channel to feed ``OutputLooper``, at ``rate`` bytes/sec.
+    """
+    def __init__(self, data, rate):
+        self.data = data
+        self.rate = float(rate)
+        self.offset = 0
+        self.start = None
+
+    def recv(self, size):
+        if self.start is None:
+            self.start = time.time()
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        # Sleep until the link would have delivered everything so far.
+        delay = self.start + (self.offset / self.rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return chunk
+
+
+def journal(megabytes):
+    lines = []
+    size = 0
+    i = 0
+    while size < megabytes * 1024 * 1024:
+        line = "Jan %02d %02d:%02d:%02d web%03d sshd[%d]: Accepted publickey" \
+            " for deploy from 10.0.%d.%d port %d ssh2\n" % (
+                i % 28 + 1, i % 24, i % 60, i % 59, i % 400, 1000 + i % 9000,
+                i % 255, i % 253, 40000 + i % 20000
+            )
+        lines.append(line)
+        size += len(line)
+        i += 1
+    return "".join(lines)
+
+
+def timed(data, rate, decompress):
+    capture = []
+    channel = ThrottledChannel(data, rate)
+    start = time.time()
+    OutputLooper(channel, 'recv', sys.stdout, capture, None,
+        decompress=decompress).loop()
+    return time.time() - start, "".join(capture)
+
+
+def main(rate_kb=512, megabytes=8):
+    rate = rate_kb * 1024
+    text = journal(megabytes)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    start = time.time()
+    compressed = compressor.compress(text) + compressor.flush()
+    gzip_time = time.time() - start
+
+    env.host_string = 'bench'
+    with hide('everything'):
+        raw_time, raw_out = timed(text, rate, False)
+        gz_time, gz_out = timed(compressed, rate, True)
+    assert raw_out == gz_out == text
+
+    print("Link: %d KB/s, output: %.1f MB (%.1f MB gzipped, ratio %.1fx)" % (
+        rate_kb, len(text) / 1048576.0, len(compressed) / 1048576.0,
+        len(text) / float(len(compressed))
+    ))
+    print("  plain:      %6.2fs" % raw_time)
+    print("  compressed: %6.2fs (+%.2fs remote gzip, est.)" % (
+        gz_time, gzip_time
+    ))
+    print("  speedup:    %6.1fx" % (raw_time / (gz_time + gzip_time)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
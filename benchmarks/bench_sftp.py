@@ -0,0 +1,138 @@
+"""
+Benchmark SFTP ``put()``/``get()`` throughput across network latencies.
+
+The test suite's SSH server runs behind a local TCP proxy which holds every
+packet back for half the round trip time in each direction, standing in for
+a distant host. One file is uploaded and downloaded with each of a few
+combinations of :ref:`env.sftp_max_requests <sftp-max-requests>`,
+:ref:`env.sftp_chunk_size <sftp-chunk-size>` and :ref:`env.sftp_window_size
+<sftp-window-size>`, and throughput for each is reported.
+
+Usage::
+
+    python benchmarks/bench_sftp.py [MB per file] [round trip ms ...]
+
+Defaults to a 4 MB file, over round trips of 0, 10 and 50 ms.
+"""
+
+from __future__ import with_statement
+
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from fabric.api import env, get, hide, put, settings
+from server import server, PASSWORDS, PORT, USER
+
+
+# name, env settings
+SETTINGS = [
+    ("1 x 32KB", dict(sftp_max_requests=1)),
+    ("16 x 32KB", dict(sftp_max_requests=16)),
+    ("64 x 32KB", dict(sftp_max_requests=64)),
+    ("64 x 128KB, 16MB window", dict(sftp_max_requests=64,
+        sftp_chunk_size=131072, sftp_window_size=16 << 20)),
+]
+
+
+class LatencyProxy(object):
+    """
+    Forward TCP connections on ``port`` to ``target``, ``delay`` seconds late.
+    """
+    def __init__(self, port, target, delay):
+        self.target = target
+        self.delay = delay
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', port))
+        self.listener.listen(5)
+        self.spawn(self.accept)
+
+    def spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.setDaemon(True)
+        thread.start()
+
+    def accept(self):
+        while True:
+            client = self.listener.accept()[0]
+            upstream = socket.socket()
+            upstream.connect(('127.0.0.1', self.target))
+            # Delays are this proxy's to add, not Nagle's algorithm's
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            for src, dst in ((client, upstream), (upstream, client)):
+                held = Queue.Queue()
+                self.spawn(self.receive, src, held)
+                self.spawn(self.deliver, held, dst)
+
+    def receive(self, src, held):
+        while True:
+            try:
+                data = src.recv(65536)
+            except socket.error:
+                data = ''
+            held.put((time.time() + self.delay, data))
+            if not data:
+                return
+
+    def deliver(self, held, dst):
+        while True:
+            due, data = held.get()
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+            except socket.error:
+                return
+
+
+def throughput(size, seconds):
+    return size / 1048576.0 / max(seconds, 1e-6)
+
+
+@server()
+def bench(data, port):
+    env.host_string = '%s@127.0.0.1:%s' % (USER, port)
+    results = []
+    for name, tuning in SETTINGS:
+        with settings(hide('everything'), **tuning):
+            start = time.time()
+            put(StringIO(data), '/bench.bin')
+            put_time = time.time() - start
+            received = StringIO()
+            start = time.time()
+            get('/bench.bin', received)
+            get_time = time.time() - start
+        assert received.getvalue() == data
+        results.append((name, put_time, get_time))
+    return results
+
+
+def main(megabytes=4, *latencies):
+    data = os.urandom(megabytes * 1024 * 1024)
+    env.disable_known_hosts = True
+    env.password = PASSWORDS[USER]
+    for i, latency in enumerate(latencies or (0, 10, 50)):
+        port = PORT + 100 + i
+        LatencyProxy(port, PORT, latency / 2000.0)
+        print("Round trip: %d ms, file: %d MB" % (latency, megabytes))
+        for name, put_time, get_time in bench(data, port):
+            print("  %-24s put %7.2f MB/s   get %7.2f MB/s" % (name,
+                throughput(len(data), put_time),
+                throughput(len(data), get_time)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -30,24 +30,27 @@ def issues_role(name, rawtext, text, lineno, inliner, options={}, content=[]):
 
     When invoked as :issue:, turns into just a "#NN" hyperlink to Github.
 
-    When invoked otherwise, turns into "[Type] <#NN hyperlink>: ".
+    When invoked otherwise, turns into "[Type] <#NN hyperlink>: ", or just
+    "[Type]: " when given ``-`` for changes without a ticket of their own.
     """
     # Old-style 'just the issue link' behavior
     issue_no = utils.unescape(text)
-    ref = "https://github.com/fabric/fabric/issues/" + issue_no
-    link = nodes.reference(rawtext, '#' + issue_no, refuri=ref, **options)
-    ret = [link]
+    links = []
+    if issue_no != '-':
+        ref = "https://github.com/fabric/fabric/issues/" + issue_no
+        links = [
+            nodes.reference(rawtext, '#' + issue_no, refuri=ref, **options)
+        ]
+    ret = links
     # Additional 'new-style changelog' stuff
     if name in issue_types:
         which = '[<span class="changelog-%s">%s</span>]' % (
             name, name.capitalize()
         )
-        ret = [
-            nodes.raw(text=which, format='html'),
-            nodes.inline(text=" "),
-            link,
-            nodes.inline(text=":")
-        ]
+        ret = [nodes.raw(text=which, format='html')]
+        if links:
+            ret += [nodes.inline(text=" ")] + links
+        ret.append(nodes.inline(text=":"))
     return ret, []
 
 for x in issue_types + ('issue',):
@@ -0,0 +1,192 @@
+"""
+Aggregated output: one block per distinct command output, across all hosts.
+
+When :ref:`env.aggregate <aggregate>` is set, `~fabric.operations.run` and
+`~fabric.operations.sudo` don't print their output as it arrives. Each result
+is handed to `aggregator` instead, which groups the hosts whose output (and
+exit code) was identical, and prints each group once, headed by a compressed
+host list (see `compress_hosts`), as soon as every host has reported.
+"""
+
+from __future__ import with_statement
+
+import hashlib
+import re
+import sys
+import threading
+
+
+def compress_hosts(hosts):
+    """
+    Return a short description of ``hosts``, e.g. ``"web[001-412],db1"``.
+
+    Hosts are grouped by the text around their last number; numbers within
+    each group are collapsed into ranges, keeping any zero-padding.
+    """
+    groups = {}
+    order = []
+    for host in hosts:
+        match = re.match(r'^(.*?)(\d+)(\D*)$', host)
+        if match is None:
+            key = (host, None)
+        else:
+            key = (match.group(1), match.group(3))
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        if match is not None:
+            groups[key].append(match.group(2))
+    parts = []
+    for prefix, suffix in order:
+        if suffix is None:
+            parts.append(prefix)
+            continue
+        digits = groups[(prefix, suffix)]
+        lengths = set(map(len, digits))
+        if len(lengths) == 1:
+            widths = {lengths.pop(): digits}
+        else:
+            # Zero-padded numbers only go together with their own width.
+            widths = {}
+            for number in digits:
+                width = len(number) if number.startswith('0') else 0
+                widths.setdefault(width, []).append(number)
+        for width in sorted(widths):
+            parts.append(prefix + _ranges(widths[width], width) + suffix)
+    return ",".join(parts)
+
+
+def _ranges(digits, width):
+    values = sorted(set(int(number) for number in digits))
+    if len(values) == 1:
+        return "%0*d" % (width, values[0])
+    ranges = []
+    start = end = values[0]
+    for value in values[1:] + [None]:
+        if value is not None and value == end + 1:
+            end = value
+            continue
+        if start == end:
+            ranges.append("%0*d" % (width, start))
+        else:
+            ranges.append("%0*d-%0*d" % (width, start, width, end))
+        start = end = value
+    return "[%s]" % ",".join(ranges)
+
+
+def format_group(hosts, label, stdout, stderr, return_code, expected=None):
+    """
+    Return the text printed for one group of hosts sharing the same output.
+    """
+    count = "%d host%s" % (len(hosts), "" if len(hosts) == 1 else "s")
+    if expected is not None and expected != len(hosts):
+        count = "%d of %d hosts" % (len(hosts), expected)
+    header = "[%s] %s (%s" % (compress_hosts(hosts), label, count)
+    if return_code:
+        header += ", exit %s" % return_code
+    lines = [header + ")"]
+    for text, name in ((stdout, "out"), (stderr, "err")):
+        for line in text.splitlines():
+            lines.append("    %s: %s" % (name, line))
+    return "\n".join(lines) + "\n"
+
+
+class Aggregator(object):
+    """
+    Collects command results from many hosts and prints them grouped.
+
+    Results are grouped per "slot": the n-th time a given command was run on
+    a host. A slot is printed once ``expected`` hosts have reported for it;
+    `flush` prints whatever's left.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.reset()
+        # Set in parallel-mode children, which hand results to the parent.
+        self.queue = None
+        self.name = None
+
+    def reset(self, expected=None):
+        self.expected = expected
+        # slot -> list of (digest, hosts, stdout, stderr, return_code)
+        self.slots = {}
+        self.order = []
+        self.seen = {}
+        self.active = 0
+
+    def start(self, hosts):
+        """
+        Begin aggregating for a task about to run on ``hosts``.
+        """
+        with self.lock:
+            if not self.active:
+                self.reset(len(hosts))
+            self.active += 1
+
+    def finish(self):
+        """
+        End aggregating for a task, printing any unsettled groups.
+        """
+        with self.lock:
+            self.active -= 1
+            last = not self.active
+        if last:
+            self.flush()
+
+    def record(self, host, which, command, stdout, stderr, return_code):
+        """
+        Add one host's result for ``command``.
+        """
+        result = (host, which, command, stdout, stderr, return_code)
+        if self.queue is not None:
+            self.queue.put({'name': self.name, 'aggregate': result})
+        else:
+            self.add(*result)
+
+    def add(self, host, which, command, stdout, stderr, return_code):
+        with self.lock:
+            key = (host, which, command)
+            occurrence = self.seen.get(key, 0)
+            self.seen[key] = occurrence + 1
+            slot = (which, command, occurrence)
+            if slot not in self.slots:
+                self.slots[slot] = []
+                self.order.append(slot)
+            digest = hashlib.sha1(
+                "\0".join([stdout, stderr, str(return_code)])
+            ).hexdigest()
+            groups = self.slots[slot]
+            for group in groups:
+                if group[0] == digest:
+                    group[1].append(host)
+                    break
+            else:
+                groups.append((digest, [host], stdout, stderr, return_code))
+            reported = sum(len(group[1]) for group in groups)
+            if self.expected is not None and reported >= self.expected:
+                self._print(slot)
+
+    def flush(self):
+        """
+        Print every group not printed yet.
+        """
+        with self.lock:
+            for slot in list(self.order):
+                self._print(slot)
+
+    def _print(self, slot):
+        groups = self.slots.pop(slot)
+        self.order.remove(slot)
+        which, command, occurrence = slot
+        stream = self.stream or sys.stdout
+        # Largest groups first; the odd ones out are usually what matters,
+        # and end up nearest the next prompt.
+        for digest, hosts, stdout, stderr, return_code in sorted(groups,
+            key=lambda group: -len(group[1])):
+            stream.write(format_group(hosts, "%s: %s" % (which, command),
+                stdout, stderr, return_code, self.expected))
+        stream.flush()
+
+
+aggregator = Aggregator()
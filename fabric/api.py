@@ -7,11 +7,12 @@ setup.py -- without triggering loads of most of the code. Which doesn't work so
 well when you're using setup.py to install e.g. ssh!
 """
 from fabric.context_managers import (cd, hide, settings, show, path, prefix,
-    lcd, quiet, warn_only, remote_tunnel, shell_env)
+    lcd, quiet, warn_only, remote_tunnel, shell_env, cached)
 from fabric.decorators import (hosts, roles, runs_once, with_settings, task,
-        serial, parallel)
+        serial, parallel, cached_query)
 from fabric.operations import (require, prompt, put, get, run, sudo, local,
-    reboot, open_shell)
+    local_many, reboot, open_shell, pipe, batch, run_async, sudo_async,
+    gather, run_all, broadcast_put)
 from fabric.state import env, output
 from fabric.utils import abort, warn, puts, fastprint
 from fabric.tasks import execute
@@ -0,0 +1,182 @@
+"""
+Relayed one-to-many file transfers, used by `~fabric.operations.broadcast_put`.
+
+In relay mode, Fabric only sends the file to a few hosts itself. Each of those
+runs a small helper script (see `SCRIPT`, run by whichever Python the host
+has) which writes the file to disk while forwarding it, as it arrives, to the
+hosts it's responsible for, over ``ssh`` (see :ref:`env.broadcast_ssh
+<broadcast-ssh>`). Those do the same for theirs, and so on down a tree
+planned by `relay_tree`. Every helper reports one result line per host in its
+subtree back up the same way, so Fabric learns how every host fared.
+
+The helper reads a one-line header, a Python literal with the
+``(name, path, mode, size, tree, ssh, command)`` of the transfer, then
+``size`` bytes of file data, from stdin. ``tree`` lists the hosts to forward
+to as ``(name, ssh_args, subtree)`` tuples, ``ssh`` is the command reaching
+them and ``command`` the remote command starting the helper itself.
+"""
+
+from __future__ import with_statement
+
+from fabric.network import normalize
+from fabric.utils import shell_quote
+
+
+SCRIPT = r"""
+import ast, os, subprocess, sys
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+def say(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+def names(tree):
+    for name, args, subtree in tree:
+        yield name
+        for child in names(subtree):
+            yield child
+name, path, mode, size, tree, ssh, command = ast.literal_eval(
+    stdin.readline().decode('utf-8'))
+path = os.path.expanduser(path)
+children = []
+for child, args, subtree in tree:
+    try:
+        process = subprocess.Popen(ssh + args + [command],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.stdin.write((repr((child, path, mode, size, subtree, ssh,
+            command)) + '\n').encode('utf-8'))
+    except (OSError, IOError):
+        for each in names([(child, args, subtree)]):
+            say('fail %s could not relay' % each)
+        continue
+    children.append((process, child, args, subtree))
+tmp = path + '.fabric-broadcast'
+try:
+    out = open(tmp, 'wb')
+except (OSError, IOError):
+    out = None
+    error = sys.exc_info()[1]
+received = 0
+while received < size:
+    data = stdin.read(min(65536, size - received))
+    if not data:
+        break
+    received += len(data)
+    if out is not None:
+        try:
+            out.write(data)
+        except (OSError, IOError):
+            out.close()
+            out = None
+            error = sys.exc_info()[1]
+    for process, child, args, subtree in children:
+        if process.stdin is not None:
+            try:
+                process.stdin.write(data)
+            except (OSError, IOError):
+                process.stdin = None
+for process, child, args, subtree in children:
+    if process.stdin is not None:
+        try:
+            process.stdin.close()
+        except (OSError, IOError):
+            pass
+if out is None:
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    say('fail %s %s' % (name, error))
+elif received != size:
+    out.close()
+    os.remove(tmp)
+    say('fail %s short read' % name)
+else:
+    out.close()
+    if mode is not None:
+        os.chmod(tmp, mode)
+    os.rename(tmp, path)
+    say('ok %s' % name)
+for process, child, args, subtree in children:
+    reported = set()
+    for line in process.stdout:
+        line = line.decode('utf-8').rstrip('\n')
+        parts = line.split(' ', 2)
+        if len(parts) >= 2:
+            reported.add(parts[1])
+            say(line)
+    status = process.wait()
+    for each in names([(child, args, subtree)]):
+        if each not in reported:
+            say('fail %s relay exited with status %s' % (each, status))
+"""
+
+
+def helper_command():
+    """
+    Return the remote command running `SCRIPT`.
+    """
+    return 'PY=$(command -v python3 || command -v python) && ' \
+        'exec "$PY" -c %s' % shell_quote(SCRIPT)
+
+
+def ssh_args(host_string):
+    """
+    Return the ``ssh`` arguments reaching ``host_string`` from its peers.
+    """
+    user, host, port = normalize(host_string)
+    args = []
+    if str(port) != '22':
+        args.extend(['-p', str(port)])
+    args.append('%s@%s' % (user, host))
+    return args
+
+
+def relay_tree(hosts, fanout):
+    """
+    Plan how ``hosts`` relay a file to one another.
+
+    Returns up to ``fanout`` ``(host, subtree)`` tuples, each host forwarding
+    to the roots of its own subtree (again, at most ``fanout`` of them), so
+    that the tree is about log(len(hosts)) hosts deep. A ``fanout`` of 1 makes
+    a chain.
+    """
+    fanout = max(int(fanout), 1)
+    size = -(-len(hosts) // fanout)
+    return [
+        (hosts[i], relay_tree(hosts[i + 1:i + size], fanout))
+        for i in range(0, len(hosts), size or 1)
+    ]
+
+
+def members(tree):
+    """
+    Return every host in ``tree`` (as returned by `relay_tree`), in order.
+    """
+    hosts = []
+    for host, subtree in tree:
+        hosts.append(host)
+        hosts.extend(members(subtree))
+    return hosts
+
+
+def header(name, path, mode, size, subtree, ssh):
+    """
+    Return the header line `SCRIPT` expects, for host ``name`` forwarding to
+    ``subtree`` (as returned by `relay_tree`.)
+    """
+    def plan(tree):
+        return [(host, ssh_args(host), plan(children))
+            for host, children in tree]
+    return repr((name, path, mode, size, plan(subtree), ssh,
+        helper_command())) + "\n"
+
+
+def parse_results(text):
+    """
+    Parse the result lines `SCRIPT` prints into a dict mapping host names to
+    None (success) or an error message.
+    """
+    results = {}
+    for line in text.splitlines():
+        parts = line.split(' ', 2)
+        if len(parts) >= 2 and parts[0] in ('ok', 'fail'):
+            results[parts[1]] = None if parts[0] == 'ok' \
+                else (parts[2:] or ['failed'])[0]
+    return results
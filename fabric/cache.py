@@ -0,0 +1,100 @@
+"""
+Memoization of read-only remote queries; see `~fabric.context_managers.cached`
+and `~fabric.decorators.cached_query`.
+"""
+
+from __future__ import with_statement
+
+import threading
+import time
+
+from fabric.network import normalize_to_string
+from fabric.state import env
+
+
+class QueryCache(object):
+    """
+    Results of read-only `run`/`sudo` calls, per host.
+
+    Keys are built by `key` from the host string, the fully wrapped command
+    and the settings affecting its outcome. ``stats`` counts cache hits,
+    misses and invalidations.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _get_queries(self):
+        return getattr(self.local, 'queries', 0)
+
+    def _set_queries(self, value):
+        self.local.queries = value
+
+    # Depth of cached_query() calls in progress, in the current thread only:
+    # other threads' commands aren't part of those queries.
+    queries = property(_get_queries, _set_queries)
+
+    def read_only(self):
+        """
+        Whether commands being run right now, by the current thread, are
+        marked as read-only queries.
+        """
+        return self.queries > 0
+
+    def key(self, which, wrapped_command, combine_stderr):
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+        return (
+            normalize_to_string(env.host_string), which, wrapped_command,
+            bool(combine_stderr), bool(env.warn_only), tuple(env.ok_ret_codes)
+        )
+
+    def get(self, key, ttl=None):
+        """
+        Return the result stored under ``key``, or None.
+
+        Entries older than ``ttl`` seconds (if given) are discarded.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                stored, result = entry
+                if ttl is None or time.time() - stored <= ttl:
+                    self.stats['hits'] += 1
+                    return result
+                del self.entries[key]
+            self.stats['misses'] += 1
+            return None
+
+    def set(self, key, result):
+        with self.lock:
+            self.entries[key] = (time.time(), result)
+
+    def invalidate(self, host_string=None):
+        """
+        Forget results for ``host_string``, or for all hosts if it's None.
+        """
+        with self.lock:
+            if host_string is None:
+                stale = self.entries.keys()
+            else:
+                host_string = normalize_to_string(host_string)
+                stale = [key for key in self.entries if key[0] == host_string]
+            for key in stale:
+                del self.entries[key]
+            if stale:
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        """
+        Forget all results and reset the statistics.
+        """
+        with self.lock:
+            self.entries.clear()
+            for key in self.stats:
+                self.stats[key] = 0
+
+
+query_cache = QueryCache()
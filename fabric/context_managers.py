@@ -465,6 +465,35 @@ def shell_env(**kw):
     return _setenv({'shell_env': kw})
 
 
+def cached(ttl=None):
+    """
+    Reuse the results of read-only remote queries within the wrapped block.
+
+    While active, `~fabric.operations.run`/`~fabric.operations.sudo` calls
+    made from within functions marked with `~fabric.decorators.cached_query`
+    -- such as `~fabric.contrib.files.exists` or
+    `~fabric.contrib.files.contains` -- are answered from a per-host cache if
+    an identical call (same host, same fully wrapped command, same
+    ``warn_only``/``ok_ret_codes`` settings) was already made. ``ttl``, if
+    given, is the maximum age in seconds of a cached result.
+
+    Any other `~fabric.operations.run`/`~fabric.operations.sudo` call, or a
+    `~fabric.operations.put`, is assumed to change the host and invalidates
+    its cached results, whether or not it happens inside this block. To
+    invalidate explicitly (e.g. after changing a host by other means), call
+    ``fabric.cache.query_cache.invalidate(host_string)``; hit/miss
+    statistics are kept in ``fabric.cache.query_cache.stats``. For example::
+
+        with cached(ttl=300):
+            for path in paths:
+                if not exists(path):
+                    run("mkdir -p %s" % path)
+
+    .. versionadded:: 1.8
+    """
+    return _setenv({'cache_queries': True, 'cache_ttl': ttl})
+
+
 def _forwarder(chan, sock):
     # Bidirectionally forward data between a socket and a Paramiko channel.
     while True:
@@ -14,6 +14,7 @@ from fabric.api import *
 from fabric.utils import apply_lcwd
 
 
+@cached_query
 def exists(path, use_sudo=False, verbose=False):
     """
     Return True if given path exists on the current remote host.
@@ -36,6 +37,7 @@ def exists(path, use_sudo=False, verbose=False):
         return not func(cmd).failed
 
 
+@cached_query
 def is_link(path, use_sudo=False, verbose=False):
     """
     Return True if the given path is a symlink on the current remote host.
@@ -200,8 +202,7 @@ def sed(filename, before, after, limit='', use_sudo=False, backup='.bak',
     }
     # Test the OS because of differences between sed versions
 
-    with hide('running', 'stdout'):
-        platform = run("uname")
+    platform = _platform()
     if platform in ('NetBSD', 'OpenBSD', 'QNX'):
         # Attempt to protect against failures/collisions
         hasher = hashlib.sha1()
@@ -304,6 +305,7 @@ def comment(filename, regex, use_sudo=False, char='#', backup='.bak',
     )
 
 
+@cached_query
 def contains(filename, text, exact=False, use_sudo=False, escape=True,
     shell=False):
     """
@@ -399,6 +401,21 @@ def append(filename, text, use_sudo=False, partial=False, escape=True,
         line = line.replace("'", r"'\\''") if escape else line
         func("echo '%s' >> %s" % (line, _expand_path(filename)))
 
+def _platform():
+    """
+    Return the remote OS name: the ``os`` fact if the host's facts were
+    gathered already, else the output of ``uname``.
+    """
+    platform = None
+    if env.host_string in env.facts:
+        platform = env.facts[env.host_string].os
+    return platform or _uname()
+
+@cached_query
+def _uname():
+    with hide('running', 'stdout'):
+        return run("uname")
+
 def _escape_for_regex(text):
     """Escape ``text`` to allow literal matching using egrep"""
     regex = re.escape(text)
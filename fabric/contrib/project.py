@@ -5,13 +5,16 @@ from __future__ import with_statement
 
 from os import getcwd, sep
 import os.path
+import posixpath
 from datetime import datetime
 from tempfile import mkdtemp
 
+from fabric import tarstream
 from fabric.network import needs_host, key_filenames, normalize
 from fabric.operations import local, run, sudo, put
-from fabric.state import env, output
+from fabric.state import env, output, connections
 from fabric.context_managers import cd
+from fabric.utils import error
 
 __all__ = ['rsync_project', 'upload_project']
 
@@ -149,7 +152,8 @@ def rsync_project(
     return local(cmd, capture=capture)
 
 
-def upload_project(local_dir=None, remote_dir="", use_sudo=False):
+def upload_project(local_dir=None, remote_dir="", use_sudo=False,
+    stream=False, compress='gz'):
     """
     Upload the current project to a remote system via ``tar``/``gzip``.
 
@@ -164,6 +168,18 @@ def upload_project(local_dir=None, remote_dir="", use_sudo=False):
     remotely. ``sudo`` will be used if use_sudo is True, otherwise ``run`` will
     be used.
 
+    By default, an archive of ``local_dir`` is created locally with ``tar``,
+    uploaded with `~fabric.operations.put`, then unpacked and removed
+    remotely. With ``stream=True``, the archive is instead built in-process
+    and piped straight into a remote ``tar -x`` (see `fabric.tarstream`), so
+    the project is only read once and no temporary archive is written on
+    either end. As the archive takes up ``tar``'s standard input, streaming
+    with ``use_sudo`` needs ``sudo`` to work without a password (e.g.
+    ``NOPASSWD`` or cached credentials.)
+
+    ``compress`` is the archive's compression: ``"gz"`` (the default),
+    ``"bz2"`` or None. Uncompressed streams are often faster on fast links.
+
     This function makes use of the ``tar`` and ``gzip`` programs/libraries,
     thus it will not work too well on Win32 systems unless one is using Cygwin
     or something similar. It will attempt to clean up the local and remote
@@ -174,6 +190,9 @@ def upload_project(local_dir=None, remote_dir="", use_sudo=False):
 
     .. versionchanged:: 1.7
         Added the ``use_sudo`` kwarg.
+
+    .. versionchanged:: 1.8
+        Added the ``stream`` and ``compress`` kwargs.
     """
     runner = use_sudo and sudo or run
 
@@ -183,18 +202,46 @@ def upload_project(local_dir=None, remote_dir="", use_sudo=False):
     local_dir = local_dir.rstrip(os.sep)
 
     local_path, local_name = os.path.split(local_dir)
-    tar_file = "%s.tar.gz" % local_name
+    compress = tarstream.compression(compress)
+
+    if stream:
+        return _stream_project(local_dir, local_name, remote_dir, use_sudo,
+            compress)
+
+    flag = tarstream.COMPRESSION.get(compress, '')
+    tar_file = "%s.tar%s" % (local_name, compress and "." + compress)
     target_tar = os.path.join(remote_dir, tar_file)
     tmp_folder = mkdtemp()
 
     try:
         tar_path = os.path.join(tmp_folder, tar_file)
-        local("tar -czf %s -C %s %s" % (tar_path, local_path, local_name))
+        local("tar -c%sf %s -C %s %s" % (flag, tar_path, local_path,
+            local_name))
         put(tar_path, target_tar, use_sudo=use_sudo)
         with cd(remote_dir):
             try:
-                runner("tar -xzf %s" % tar_file)
+                runner("tar -x%sf %s" % (flag, tar_file))
             finally:
                 runner("rm -f %s" % tar_file)
     finally:
         local("rm -rf %s" % tmp_folder)
+
+
+@needs_host
+def _stream_project(local_dir, local_name, remote_dir, use_sudo, compress):
+    # Honor cd(), as the non-streaming upload does
+    directory = remote_dir
+    if env.cwd and not posixpath.isabs(remote_dir) \
+        and not remote_dir.startswith('~'):
+        directory = posixpath.join(env.cwd, remote_dir)
+    if output.running:
+        print("[%s] upload_project: %s -> %s" % (
+            env.host_string, local_dir, directory or "~"
+        ))
+    transport = connections[env.host_string].get_transport()
+    status, stderr = tarstream.upload(transport,
+        tarstream.walk(local_dir, local_name), directory, compress, use_sudo)
+    if status != 0:
+        error("upload_project() could not unpack %s into %s (exit %s)" % (
+            local_dir, directory or "~", status
+        ), stderr=stderr)
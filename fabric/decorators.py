@@ -9,6 +9,7 @@ from functools import wraps
 from Crypto import Random
 
 from fabric import tasks
+from fabric.cache import query_cache
 from .context_managers import settings
 
 
@@ -216,3 +217,35 @@ def with_settings(*arg_settings, **kw_settings):
                 return func(*args, **kwargs)
         return _wrap_as_new(func, inner)
     return outer
+
+
+def cached_query(func):
+    """
+    Decorator marking the wrapped function as a read-only remote query.
+
+    Any `~fabric.operations.run`/`~fabric.operations.sudo` calls made by the
+    function are assumed not to change anything on the remote host, so within
+    a `~fabric.context_managers.cached` block their results may be reused by
+    later, identical calls instead of running the command again. Everything
+    else (including calls made outside the function) counts as a write, and
+    invalidates what's been cached for the host in question.
+
+    For example::
+
+        @cached_query
+        def kernel_version():
+            return run("uname -r")
+
+    Several helpers in `fabric.contrib.files`, such as
+    `~fabric.contrib.files.exists`, are cached queries.
+
+    .. versionadded:: 1.8
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        query_cache.queries += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            query_cache.queries -= 1
+    return _wrap_as_new(func, inner)
@@ -0,0 +1,201 @@
+"""
+Block-level delta transfers, in the style of rsync's rolling checksum.
+
+The remote copy of a file is split into fixed-size blocks, and a small helper
+script (see `SCRIPT`, run by whichever Python the remote host has) reports
+each block's weak (Adler-32) and strong (MD5) checksum. `instructions` then
+rolls a window over the local file, reusing remote blocks wherever the local
+data matches one, and sending literal data everywhere else. The same helper
+script rebuilds the file on the remote end from those instructions, checks
+the SHA1 of the result against the local file's and only then replaces the
+old file with it.
+"""
+
+from __future__ import with_statement
+
+import hashlib
+import math
+import struct
+import zlib
+
+from fabric.utils import shell_quote
+
+
+SCRIPT = r"""
+import hashlib, os, struct, sys, zlib
+mode, path, size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+def read(n):
+    data = stdin.read(n)
+    if len(data) != n:
+        sys.exit(2)
+    return data
+old = open(path, 'rb')
+if mode == 'sig':
+    while True:
+        block = old.read(size)
+        if not block:
+            break
+        stdout.write(('%d %s\n' % (zlib.adler32(block) & 0xffffffff,
+            hashlib.md5(block).hexdigest())).encode('ascii'))
+    sys.exit(0)
+expected = stdin.readline().strip().decode('ascii')
+tmp = path + '.fabric-delta'
+new = open(tmp, 'wb')
+digest = hashlib.sha1()
+while True:
+    op = stdin.read(1)
+    if not op:
+        break
+    if op == b'C':
+        old.seek(struct.unpack('>Q', read(8))[0] * size)
+        block = old.read(size)
+    else:
+        block = read(struct.unpack('>I', read(4))[0])
+    new.write(block)
+    digest.update(block)
+new.close()
+if digest.hexdigest() != expected:
+    os.remove(tmp)
+    stdout.write(b'mismatch\n')
+    sys.exit(1)
+os.chmod(tmp, os.stat(path).st_mode & 4095)
+os.rename(tmp, path)
+stdout.write(b'ok\n')
+"""
+
+# Largest chunk of literal data sent in one instruction
+LITERAL_MAX = 1 << 20
+
+
+def helper_command(mode, path, block_size):
+    """
+    Return the remote command running `SCRIPT` on ``path``.
+
+    ``mode`` is ``"sig"``, which prints the file's block signatures, or
+    ``"patch"``, which rebuilds the file from instructions on stdin.
+    """
+    return 'PY=$(command -v python3 || command -v python) && ' \
+        'exec "$PY" -c %s %s %s %d' % (
+            shell_quote(SCRIPT), mode, shell_quote(path), block_size
+        )
+
+
+def block_size_for(size):
+    """
+    Return the block size to use for a remote file of ``size`` bytes.
+
+    Like rsync, roughly the square root of the file size, so the number of
+    blocks grows no faster than their size; between 4KB and 1MB.
+    """
+    block = int(math.sqrt(size)) // 1024 * 1024
+    return max(4096, min(block, 1 << 20))
+
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def roll(checksum, out, into, block_size):
+    """
+    Return the Adler-32 ``checksum`` of a window moved one byte forward,
+    dropping byte ``out`` and taking in byte ``into`` (both as characters.)
+    """
+    a = checksum & 0xffff
+    b = checksum >> 16
+    a = (a - ord(out) + ord(into)) % 65521
+    b = (b - block_size * ord(out) - 1 + a) % 65521
+    return (b << 16) | a
+
+
+def signature(fd, block_size):
+    """
+    Return ``(weak, strong)`` checksums for each block of file object ``fd``.
+
+    The local equivalent of running `SCRIPT` in ``"sig"`` mode.
+    """
+    signatures = []
+    for block in iter(lambda: fd.read(block_size), ''):
+        signatures.append(
+            (weak_checksum(block), hashlib.md5(block).hexdigest())
+        )
+    return signatures
+
+
+def parse_signature(text):
+    """
+    Parse the output of `SCRIPT` in ``"sig"`` mode.
+    """
+    signatures = []
+    for line in text.splitlines():
+        weak, strong = line.split()
+        signatures.append((int(weak), strong))
+    return signatures
+
+
+def instructions(fd, signatures, block_size):
+    """
+    Yield instructions rebuilding file object ``fd`` from remote blocks.
+
+    Instructions are ``('copy', index)`` tuples, referring to the remote
+    block at ``index`` in ``signatures``, and ``('data', string)`` tuples
+    with literal data.
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    buf = ''
+    # Start of the current window, and of literal data not yet sent
+    start = literal = 0
+    weak = None
+    eof = False
+    while True:
+        if len(buf) - start < block_size and not eof:
+            chunk = fd.read(max(block_size * 4, LITERAL_MAX))
+            if chunk:
+                buf = buf[literal:] + chunk
+                start -= literal
+                literal = 0
+                continue
+            eof = True
+        window = buf[start:start + block_size]
+        if not window:
+            break
+        if weak is None:
+            weak = weak_checksum(window)
+        candidates = table.get(weak)
+        if candidates:
+            index = candidates.get(hashlib.md5(window).hexdigest())
+            if index is not None:
+                if literal < start:
+                    yield ('data', buf[literal:start])
+                yield ('copy', index)
+                start += len(window)
+                literal = start
+                weak = None
+                continue
+        # Only the remote file's last block may be short, and it didn't match
+        if len(window) < block_size:
+            break
+        if start + block_size < len(buf):
+            weak = roll(weak, buf[start], buf[start + block_size], block_size)
+        else:
+            weak = None
+        start += 1
+        if start - literal >= LITERAL_MAX:
+            yield ('data', buf[literal:start])
+            literal = start
+    if literal < len(buf):
+        yield ('data', buf[literal:])
+
+
+def encode(instructions):
+    """
+    Yield the wire format of ``instructions``, as read by `SCRIPT`.
+    """
+    for kind, value in instructions:
+        if kind == 'copy':
+            yield 'C' + struct.pack('>Q', value)
+        else:
+            yield 'D' + struct.pack('>I', len(value)) + value
@@ -0,0 +1,242 @@
+"""
+Host facts: basic information about remote hosts, gathered once per run.
+
+All facts for a host are collected by a single probe script (see `PROBE`), so
+gathering costs one command per host. ``env.facts`` is a `HostFacts` mapping
+from host strings to their facts; see :ref:`env.facts <facts>` for the facts
+available and the settings controlling how they're gathered.
+"""
+
+from __future__ import with_statement
+
+import cPickle
+import os
+import threading
+import time
+from Queue import Queue, Empty
+
+from fabric.network import normalize_to_string
+from fabric.utils import _AttributeDict, shell_quote, warn
+
+
+PROBE = r"""
+echo "os=$(uname -s)"
+echo "kernel=$(uname -r)"
+echo "arch=$(uname -m)"
+echo "hostname=$(uname -n)"
+if [ -r /etc/os-release ]; then
+    ( . /etc/os-release; echo "distro=$ID"; echo "distro_version=$VERSION_ID" )
+elif command -v lsb_release >/dev/null 2>&1; then
+    echo "distro=$(lsb_release -si)"
+    echo "distro_version=$(lsb_release -sr)"
+fi
+echo "cpus=$(getconf _NPROCESSORS_ONLN 2>/dev/null || nproc 2>/dev/null \
+    || sysctl -n hw.ncpu 2>/dev/null)"
+if [ -r /proc/meminfo ]; then
+    echo "memory=$(awk '/^MemTotal:/ { print $2 * 1024 }' /proc/meminfo)"
+else
+    echo "memory=$(sysctl -n hw.physmem 2>/dev/null \
+        || sysctl -n hw.memsize 2>/dev/null)"
+fi
+df -Pk / 2>/dev/null | awk 'NR == 2 {
+    print "disk_total=" $2 * 1024; print "disk_free=" $4 * 1024 }'
+if command -v sudo >/dev/null 2>&1; then
+    echo "sudo=1"
+    if sudo -n true 2>/dev/null; then
+        echo "sudo_nopasswd=1"
+    else
+        echo "sudo_nopasswd=0"
+    fi
+else
+    echo "sudo=0"
+    echo "sudo_nopasswd=0"
+fi
+"""
+
+INTEGERS = ('cpus', 'memory', 'disk_total', 'disk_free')
+BOOLEANS = ('sudo', 'sudo_nopasswd')
+FIELDS = ('os', 'kernel', 'arch', 'hostname', 'distro', 'distro_version') \
+    + INTEGERS + BOOLEANS
+
+
+def probe_command():
+    """
+    Return the command run on each host to gather its facts.
+    """
+    return "/bin/sh -c %s" % shell_quote(PROBE)
+
+
+def parse(text):
+    """
+    Turn the probe script's ``key=value`` output into an `_AttributeDict`.
+
+    Facts the host didn't report are None.
+    """
+    facts = _AttributeDict.fromkeys(FIELDS)
+    for line in text.splitlines():
+        key, sep, value = line.partition('=')
+        if not sep or key not in facts:
+            continue
+        value = value.strip()
+        if not value:
+            continue
+        if key in INTEGERS:
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+        elif key in BOOLEANS:
+            value = value == '1'
+        facts[key] = value
+    return facts
+
+
+def probe(host_string):
+    """
+    Run the probe script on ``host_string`` and return its parsed facts.
+
+    Uses the host's cached connection, but leaves ``env`` alone, so may be
+    called from several threads at once.
+    """
+    from fabric.state import connections, env
+    channel = connections[host_string].get_transport().open_session()
+    try:
+        if env.command_timeout:
+            channel.settimeout(env.command_timeout)
+        channel.exec_command(probe_command())
+        stdout = channel.makefile('rb').read()
+        status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if status != 0:
+        raise ValueError("probe exited with status %s" % status)
+    return parse(stdout)
+
+
+class HostFacts(dict):
+    """
+    Dict subclass mapping host strings to their facts, gathering on demand.
+
+    Looking up a host whose facts haven't been gathered yet gathers them on
+    the spot (or loads them from the :ref:`local cache <facts-cache>`). Use
+    `gather` to gather facts for many hosts at once, concurrently.
+    """
+    def __getitem__(self, key):
+        key = normalize_to_string(key)
+        if not dict.__contains__(self, key):
+            failures = self.gather([key], quiet=True)
+            if key in failures:
+                raise failures[key]
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        return dict.__setitem__(self, normalize_to_string(key), value)
+
+    def __delitem__(self, key):
+        return dict.__delitem__(self, normalize_to_string(key))
+
+    def __contains__(self, key):
+        return dict.__contains__(self, normalize_to_string(key))
+
+    def gather(self, hosts, quiet=False):
+        """
+        Gather facts for any of ``hosts`` not already known, concurrently.
+
+        Connections are opened first, one host at a time (so any password
+        prompts come one after the other), then at most :ref:`env.pool_size
+        <pool-size>` hosts (if set) are probed at the same time. Returns a
+        dict mapping hosts which couldn't be probed to the exception raised;
+        unless ``quiet`` is True, a warning is also printed for each of them.
+        """
+        from fabric.state import connections, env
+        todo = []
+        for host in hosts:
+            host = normalize_to_string(host)
+            if host not in self and host not in todo:
+                todo.append(host)
+        cached = self._load(todo)
+        with _lock:
+            self.update(cached)
+        todo = [host for host in todo if host not in cached]
+        failures = {}
+        for host in todo:
+            try:
+                connections[host]
+            except (Exception, SystemExit), e:
+                failures[host] = e
+        connected = [host for host in todo if host not in failures]
+
+        queue = Queue()
+        for host in connected:
+            queue.put(host)
+
+        def worker():
+            while True:
+                try:
+                    host = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    facts = probe(host)
+                except (Exception, SystemExit), e:
+                    failures[host] = e
+                else:
+                    with _lock:
+                        dict.__setitem__(self, host, facts)
+
+        workers = min(len(connected), env.pool_size or len(connected))
+        threads = [threading.Thread(target=worker) for i in range(workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self._save([host for host in todo if host not in failures])
+        if not quiet:
+            for host, e in sorted(failures.items()):
+                warn("Unable to gather facts for %s: %s" % (host, e))
+        return failures
+
+    def _load(self, hosts):
+        """
+        Return still-fresh facts for ``hosts`` from the local cache, if any.
+        """
+        from fabric.state import env
+        entries = _read_cache(env.facts_cache)
+        loaded = {}
+        for host in hosts:
+            entry = entries.get(host)
+            if entry and time.time() - entry['time'] <= env.facts_ttl:
+                loaded[host] = _AttributeDict(entry['facts'])
+        return loaded
+
+    def _save(self, hosts):
+        from fabric.state import env
+        if not (env.facts_cache and hosts):
+            return
+        entries = _read_cache(env.facts_cache)
+        now = time.time()
+        for host in hosts:
+            entries[host] = {'time': now, 'facts': dict(self[host])}
+        path = os.path.expanduser(env.facts_cache)
+        tmp = "%s.%d" % (path, os.getpid())
+        try:
+            with open(tmp, 'wb') as fd:
+                cPickle.dump(entries, fd, 2)
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            warn("Unable to write facts cache %s: %s" % (path, e))
+
+
+_lock = threading.Lock()
+
+
+def _read_cache(path):
+    if not path:
+        return {}
+    try:
+        with open(os.path.expanduser(path), 'rb') as fd:
+            return cPickle.load(fd)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return {}
@@ -4,6 +4,8 @@ import sys
 import time
 import re
 import socket
+import threading
+import zlib
 from select import select
 
 from fabric.state import env, output, win32
@@ -31,15 +33,109 @@ def output_loop(*args, **kwargs):
     OutputLooper(*args, **kwargs).loop()
 
 
+class GzipReader(object):
+    """
+    Wrap a channel read function, transparently un-gzipping what it returns.
+
+    Compressed chunks frequently decompress to nothing (the compressor is still
+    buffering), so we keep reading until there's real output to hand back: an
+    empty string must only ever mean end-of-stream to our callers.
+
+    Raises ``IOError`` if the channel's data ends before the end of the gzip
+    stream (e.g. gzip died, or was missing), rather than return part of the
+    output as if it were all of it.
+    """
+    def __init__(self, read_func):
+        self.read_func = read_func
+        # 16 + MAX_WBITS == expect a gzip header and trailer.
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def __call__(self, size):
+        while True:
+            data = self.read_func(size)
+            if data == '':
+                if not self._ended():
+                    raise IOError("Compressed output ended early")
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(data)
+            if data:
+                return data
+
+
+    def _ended(self):
+        # Data past the end of the gzip stream is left unused; anything
+        # else means the stream isn't over.
+        probe = self.decompressor.copy()
+        try:
+            probe.decompress('\0')
+        except zlib.error:
+            return False
+        return probe.unused_data == '\0'
+
+
+class MarkerReader(object):
+    """
+    Wrap a channel read function, cutting the first ``marker`` out of its data.
+
+    ``event`` is set once the marker has been seen. Data which might be the
+    beginning of a marker split across two reads is held back until the next
+    read settles the question, so the marker never reaches our callers.
+    """
+    def __init__(self, read_func, marker, event):
+        self.read_func = read_func
+        self.marker = marker
+        self.event = event
+        self.found = False
+        self.pending = ''
+
+    def _partial(self, data):
+        # Length of the longest tail of data which is a prefix of the marker.
+        for length in range(min(len(data), len(self.marker) - 1), 0, -1):
+            if data.endswith(self.marker[:length]):
+                return length
+        return 0
+
+    def __call__(self, size):
+        while not self.found:
+            data = self.read_func(size)
+            if data == '':
+                break
+            data = self.pending + data
+            index = data.find(self.marker)
+            if index != -1:
+                self.found = True
+                self.event.set()
+                self.pending = ''
+                data = data[:index] + data[index + len(self.marker):]
+            else:
+                keep = self._partial(data)
+                self.pending = data[len(data) - keep:]
+                data = data[:len(data) - keep]
+            if data:
+                return data
+        if self.pending:
+            data, self.pending = self.pending, ''
+            return data
+        return self.read_func(size)
+
+
 class OutputLooper(object):
-    def __init__(self, chan, attr, stream, capture, timeout):
+    def __init__(self, chan, attr, stream, capture, timeout, decompress=False,
+        marker=None, marker_event=None):
         self.chan = chan
         self.stream = stream
         self.capture = capture
         self.timeout = timeout
         self.read_func = getattr(chan, attr)
+        if decompress:
+            self.read_func = GzipReader(self.read_func)
+        if marker is not None:
+            self.read_func = MarkerReader(self.read_func, marker, marker_event)
+        # Remembered here so that a looper may outlive its env settings (e.g.
+        # when run in a thread of its own.)
+        self.host_string = env.host_string
         self.prefix = "[%s] %s: " % (
-            env.host_string,
+            self.host_string,
             "out" if attr == 'recv' else "err"
         )
         self.printing = getattr(output, 'stdout' if (attr == 'recv') else 'stderr')
@@ -163,7 +259,7 @@ class OutputLooper(object):
 
     def prompt(self):
         # Obtain cached password, if any
-        password = get_password(*normalize(env.host_string))
+        password = get_password(*normalize(self.host_string))
         # Remove the prompt itself from the capture buffer. This is
         # backwards compatible with Fabric 0.9.x behavior; the user
         # will still see the prompt on their screen (no way to avoid
@@ -189,7 +285,7 @@ class OutputLooper(object):
             )
             self.chan.input_enabled = True
             # Update env.password, env.passwords if necessary
-            user, host, port = normalize(env.host_string)
+            user, host, port = normalize(self.host_string)
             set_password(user, host, port, password)
             # Reset reprompt flag
             self.reprompt = False
@@ -221,3 +317,77 @@ def input_loop(chan, using_pty):
                 sys.stdout.write(byte)
                 sys.stdout.flush()
         time.sleep(ssh.io_sleep)
+
+
+def stdin_loop(chan, source, ready=None, chunk_size=32768):
+    """
+    Stream ``source`` into ``chan``'s stdin, then signal end-of-file.
+
+    ``source`` may be a file-like object (read ``chunk_size`` bytes at a time)
+    or any iterable of strings. Backpressure comes for free: ``sendall`` blocks
+    whenever the remote end's receive window is full.
+
+    If ``ready`` (a ``threading.Event``) is given, nothing is sent until it is
+    set, e.g. so that ``sudo`` gets to read its password from stdin first.
+    """
+    if ready is not None:
+        while not ready.isSet():
+            if chan.exit_status_ready():
+                return
+            ready.wait(ssh.io_sleep)
+    if hasattr(source, 'read') and callable(source.read):
+        chunks = iter(lambda: source.read(chunk_size), '')
+    else:
+        chunks = iter(source)
+    try:
+        for chunk in chunks:
+            if chunk:
+                chan.sendall(chunk)
+    except socket.error:
+        # Remote programs are free to exit without reading all of their input
+        # (think 'head'); only complain if that isn't what happened.
+        if not (chan.closed or chan.exit_status_ready()):
+            raise
+        return
+    chan.shutdown_write()
+
+
+def pump_loop(read_func, write_func, stop=None, chunk_size=32768):
+    """
+    Copy chunks from ``read_func`` to ``write_func`` until end-of-file.
+
+    ``read_func`` is e.g. a channel's ``recv``; read timeouts are retried.
+    The final empty string is handed to ``write_func`` too, so the consumer
+    learns about end-of-file. If ``stop`` (a ``threading.Event``) gets set,
+    copying ends early, without that final empty string.
+    """
+    while stop is None or not stop.isSet():
+        try:
+            chunk = read_func(chunk_size)
+        except socket.timeout:
+            continue
+        write_func(chunk)
+        if not chunk:
+            break
+
+
+# Held while writing a line in tee_loop, so that lines from concurrent
+# commands don't get interleaved.
+_line_lock = threading.Lock()
+
+
+def tee_loop(source, capture, stream=None, prefix=""):
+    """
+    Copy lines from file object ``source`` into list ``capture`` until EOF.
+
+    If ``stream`` is given, each line is also written to it (and flushed) as
+    soon as it's complete, preceded by ``prefix``.
+    """
+    for line in iter(source.readline, ''):
+        capture.append(line)
+        if stream is not None:
+            if not line.endswith('\n'):
+                line += '\n'
+            with _line_lock:
+                stream.write(prefix + line)
+                stream.flush()
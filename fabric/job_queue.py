@@ -9,6 +9,7 @@ from __future__ import with_statement
 import time
 import Queue
 
+from fabric.aggregate import aggregator
 from fabric.state import env
 from fabric.network import ssh
 from fabric.context_managers import settings
@@ -187,6 +188,9 @@ class JobQueue(object):
         while True:
             try:
                 datum = self._comms_queue.get_nowait()
+                if 'aggregate' in datum:
+                    aggregator.add(*datum['aggregate'])
+                    continue
                 results[datum['name']]['results'] = datum['result']
             except Queue.Empty:
                 break
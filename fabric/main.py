@@ -19,6 +19,7 @@ import types
 from fabric import api, state, colors
 from fabric.contrib import console, files, project
 
+from fabric.cache import query_cache
 from fabric.network import disconnect_all, ssh
 from fabric.state import env_options
 from fabric.tasks import Task, execute, get_task_details
@@ -744,6 +745,10 @@ Remember that -f can be used to specify fabfile path, and use -h for help.""")
             )
         # If we got here, no errors occurred, so print a final note.
         if state.output.status:
+            stats = query_cache.stats
+            if stats['hits'] or stats['misses']:
+                print("\nQuery cache: %(hits)s hits, %(misses)s misses, "
+                    "%(invalidations)s invalidations" % stats)
             print("\nDone.")
     except SystemExit:
         # a number of internal functions might raise this one.
@@ -0,0 +1,206 @@
+"""
+Parallel-mode output multiplexing.
+
+Parallel-mode children don't write to the terminal themselves. Their
+``sys.stdout`` and ``sys.stderr`` are replaced with `FrameWriter` objects,
+which send complete lines as frames over a pipe to a `Multiplexer` thread in
+the parent process. The multiplexer writes each host's output to its own log
+file (see :ref:`env.parallel_log <parallel-log>`) and prints the combined
+output to the console in batches, so a slow terminal never holds up the
+children.
+"""
+
+from __future__ import with_statement
+
+import errno
+import os
+import sys
+import threading
+import time
+import Queue
+
+
+class FrameWriter(object):
+    """
+    File-like object sending whole lines written to it over ``queue``.
+
+    Each frame is a ``(name, stream, data)`` tuple, where ``stream`` is
+    ``"stdout"`` or ``"stderr"``. Partial lines are held back until completed
+    or until `flush` is called.
+    """
+    def __init__(self, queue, name, stream):
+        self.queue = queue
+        self.name = name
+        self.stream = stream
+        self.buffer = ""
+
+    def write(self, data):
+        self.buffer += data
+        end = self.buffer.rfind("\n") + 1
+        if end:
+            self.queue.put((self.name, self.stream, self.buffer[:end]))
+            self.buffer = self.buffer[end:]
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.buffer:
+            self.queue.put((self.name, self.stream, self.buffer))
+            self.buffer = ""
+
+    def isatty(self):
+        return False
+
+
+class HostLog(object):
+    """
+    Append-only log file, rotated once it grows past ``max_bytes``.
+
+    Rotation works like `logging.handlers.RotatingFileHandler`: ``path``
+    becomes ``path.1``, ``path.1`` becomes ``path.2`` and so on, keeping at
+    most ``backups`` old files. A ``max_bytes`` of 0 disables rotation.
+    """
+    def __init__(self, path, max_bytes=0, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        directory = os.path.dirname(path)
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.fd = open(path, 'a')
+        self.size = self.fd.tell()
+
+    def write(self, data):
+        if self.max_bytes and self.size \
+            and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.fd.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.fd.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                source = "%s.%d" % (self.path, i)
+                if os.path.exists(source):
+                    os.rename(source, "%s.%d" % (self.path, i + 1))
+            os.rename(self.path, self.path + ".1")
+        self.fd = open(self.path, 'w')
+        self.size = 0
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+
+class Multiplexer(object):
+    """
+    Parent-side reader of the frames sent by parallel-mode children.
+
+    ``queue`` is handed to the children (see `FrameWriter`); `start` and
+    `stop` bracket the parallel run. Settings are read from ``env`` when the
+    multiplexer is created:
+
+    * :ref:`env.parallel_log <parallel-log>`: per-host log file path, which
+      may contain ``%(host)s``; no log files are written when it's None.
+    * :ref:`env.parallel_log_max_bytes <parallel-log-max-bytes>` and
+      :ref:`env.parallel_log_backups <parallel-log-backups>`: log rotation.
+    * :ref:`env.parallel_console_interval <parallel-console-interval>`: how
+      often the console is written to.
+    * :ref:`env.parallel_console_lines <parallel-console-lines>`: the most
+      lines printed to the console per interval.
+    """
+    def __init__(self, queue):
+        from fabric.state import env
+        self.queue = queue
+        self.log = env.parallel_log
+        self.max_bytes = env.parallel_log_max_bytes
+        self.backups = env.parallel_log_backups
+        self.interval = env.parallel_console_interval
+        self.limit = env.parallel_console_lines
+        self.logs = {}
+        self.pending = []
+        self.skipped = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Process every frame sent so far, then stop and close the log files.
+
+        Only call this once the children have exited, so that all their
+        frames have been sent.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        for log in self.logs.values():
+            log.close()
+        self.logs = {}
+
+    def loop(self):
+        last = time.time()
+        while True:
+            try:
+                frame = self.queue.get(timeout=self.interval)
+            except Queue.Empty:
+                frame = ()
+            if frame is None:
+                break
+            if frame:
+                self.handle(*frame)
+            now = time.time()
+            if now - last >= self.interval:
+                self.write_console()
+                last = now
+        self.write_console()
+
+    def handle(self, name, stream, data):
+        if self.log:
+            log = self.logs.get(name)
+            if log is None:
+                path = os.path.expanduser(self.log % {
+                    'host': name.replace(os.sep, '_')
+                })
+                log = self.logs[name] = HostLog(path, self.max_bytes,
+                    self.backups)
+            prefix = "[%s] " % name
+            log.write("".join(
+                line[len(prefix):] if line.startswith(prefix) else line
+                for line in data.splitlines(True)
+            ))
+            log.flush()
+        for line in data.splitlines(True):
+            if self.limit and len(self.pending) >= self.limit:
+                self.skipped += 1
+            else:
+                self.pending.append((stream, line))
+
+    def write_console(self):
+        pending, self.pending = self.pending, []
+        streams = set()
+        for stream, line in pending:
+            stream = getattr(sys, stream)
+            stream.write(line)
+            streams.add(stream)
+        if self.skipped:
+            sys.stdout.write("... %d line%s not shown%s\n" % (
+                self.skipped,
+                "" if self.skipped == 1 else "s",
+                " (see per-host logs)" if self.log else ""
+            ))
+            streams.add(sys.stdout)
+            self.skipped = 0
+        for stream in streams:
+            stream.flush()
@@ -11,6 +11,7 @@ import re
 import time
 import socket
 import sys
+import threading
 from StringIO import StringIO
 
 
@@ -85,6 +86,19 @@ class HostConnectionCache(dict):
     two different connections to the same host being made. If no port is given,
     22 is assumed, so ``example.com`` is equivalent to ``example.com:22``.
     """
+    def __init__(self, *args, **kwargs):
+        super(HostConnectionCache, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._host_locks = {}
+
+    def _host_lock(self, key):
+        """
+        Return the lock held while connecting to ``key``, so that threads
+        looking the same host up at once only connect to it once.
+        """
+        with self._lock:
+            return self._host_locks.setdefault(key, threading.Lock())
+
     def connect(self, key):
         """
         Force a new connection to ``key`` host string.
@@ -97,10 +111,12 @@ class HostConnectionCache(dict):
         if env.gateway:
             gateway = normalize_to_string(env.gateway)
             # Ensure initial gateway connection
-            if gateway not in self:
-                if output.debug:
-                    print "Creating new gateway connection to %r" % gateway
-                self[gateway] = connect(*normalize(gateway))
+            with self._host_lock(gateway):
+                if gateway not in self:
+                    if output.debug:
+                        print "Creating new gateway connection to %r" % (
+                            gateway)
+                    self[gateway] = connect(*normalize(gateway))
             # Now we should have an open gw connection and can ask it for a
             # direct-tcpip channel to the real target. (Bypass our own
             # __getitem__ override to avoid hilarity.)
@@ -109,13 +125,28 @@ class HostConnectionCache(dict):
             sock = ssh.ProxyCommand(proxy_command)
         self[key] = connect(user, host, port, sock)
 
+    def reconnect(self, key, stale):
+        """
+        Replace ``key``'s connection if it is still ``stale``, and return it.
+
+        Threads noticing the same dropped connection at once thus share one
+        new connection, instead of each opening (and leaking) their own.
+        """
+        key = normalize_to_string(key)
+        with self._host_lock(key):
+            if key not in self or dict.__getitem__(self, key) is stale:
+                self.connect(key)
+            return dict.__getitem__(self, key)
+
     def __getitem__(self, key):
         """
         Autoconnect + return connection object
         """
         key = normalize_to_string(key)
         if key not in self:
-            self.connect(key)
+            with self._host_lock(key):
+                if key not in self:
+                    self.connect(key)
         return dict.__getitem__(self, key)
 
     #
@@ -459,9 +490,16 @@ def connect(user, host, port, sock=None):
                 # which one raised the exception. Best not to try.
                 prompt = "[%s] Passphrase for private key"
                 text = prompt % env.host_string
-            password = prompt_for_password(text)
-            # Update env.password, env.passwords if empty
-            set_password(user, host, port, password)
+            # Connections made from several threads prompt one at a time,
+            # and try any password given meanwhile before prompting again.
+            with _prompt_lock:
+                latest = get_password(user, host, port)
+                if latest != password:
+                    password = latest
+                else:
+                    password = prompt_for_password(text)
+                    # Update env.password, env.passwords if empty
+                    set_password(user, host, port, password)
         # Ctrl-D / Ctrl-C for exit
         except (EOFError, TypeError):
             # Print a newline (in case user was sitting at prompt)
@@ -509,6 +547,9 @@ def connect(user, host, port, sock=None):
                 sock.close()
 
 
+_prompt_lock = threading.Lock()
+
+
 def _password_prompt(prompt, stream):
     # NOTE: Using encode-to-ascii to prevent (Windows, at least) getpass from
     # choking if given Unicode.
@@ -588,6 +629,8 @@ def disconnect_all():
     library users.
     """
     from fabric.state import connections, output
+    from fabric.sftp import sessions
+    sessions.clear()
     # Explicitly disconnect from all servers
     for key in connections.keys():
         if output.status:
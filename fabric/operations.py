@@ -5,21 +5,32 @@ Functions to be used in fabfiles and other non-core code, such as run()/sudo().
 
 from __future__ import with_statement
 
+import mmap
 import os
 import os.path
 import posixpath
+import Queue
+import random
 import re
+import shlex
 import subprocess
 import sys
+import threading
 import time
 from glob import glob
+from itertools import groupby
 from contextlib import closing, contextmanager
 
 from fabric.context_managers import (settings, char_buffered, hide,
     quiet as quiet_manager, warn_only as warn_only_manager)
-from fabric.io import output_loop, input_loop
+from fabric import broadcast, scp
+from fabric.aggregate import aggregator, Aggregator
+from fabric.cache import query_cache
+from fabric.io import (output_loop, input_loop, stdin_loop, pump_loop,
+    tee_loop, OutputLooper)
 from fabric.network import needs_host, ssh, ssh_config
-from fabric.sftp import SFTP
+from fabric.sftp import SFTP, VERIFY_ALGORITHMS, open_sftp
+from fabric.shell import shell_channel, shell_code
 from fabric.state import env, connections, output, win32, default_channel
 from fabric.thread_handling import ThreadHandler
 from fabric.utils import (
@@ -29,7 +40,8 @@ from fabric.utils import (
     indent,
     _pty_size,
     warn,
-    apply_lcwd
+    apply_lcwd,
+    shell_quote
 )
 
 
@@ -252,7 +264,9 @@ def prompt(text, key=None, default='', validate=None):
 
 @needs_host
 def put(local_path=None, remote_path=None, use_sudo=False,
-    mirror_local_mode=False, mode=None, use_glob=True, temp_dir=""):
+    mirror_local_mode=False, mode=None, use_glob=True, temp_dir="",
+    sync=False, checksum=False, delete=False, delta=False, resume=False,
+    backend=None, verify=None):
     """
     Upload one or more files to a remote host.
 
@@ -290,6 +304,13 @@ def put(local_path=None, remote_path=None, use_sudo=False,
     (defaults to remote user's ``$HOME``; this may be overridden via
     ``temp_dir``), and then use `sudo` to move them to ``remote_path``.
 
+    Directories are uploaded with ``use_sudo=True`` into a single staging
+    directory in ``temp_dir``, then one `sudo` call runs a shell script
+    creating the remote directories and moving every file into place,
+    applying any ``mode``. Files which can't be moved are reported one by
+    one, listed in the return value's ``.failed``, and left in the staging
+    directory.
+
     In some use cases, it is desirable to force a newly uploaded file to match
     the mode of its local counterpart (such as when uploading executable
     scripts). To do this, specify ``mirror_local_mode=True``.
@@ -297,6 +318,56 @@ def put(local_path=None, remote_path=None, use_sudo=False,
     Alternately, you may use the ``mode`` kwarg to specify an exact mode, in
     the same vein as ``os.chmod`` or the Unix ``chmod`` command.
 
+    Give ``sync=True`` to only upload local files which differ from their
+    remote counterparts, a little like ``rsync`` but without needing it on
+    either end. Files are considered unchanged when their size and
+    modification time match (uploads made with ``sync=True`` copy the local
+    modification time over); with ``checksum=True``, when their size and
+    SHA1 hash match instead, the remote hashes being computed by a single
+    ``sha1sum`` command. The remote side of a directory upload is listed in
+    one go (one request per directory) rather than file by file. When
+    uploading directories, ``delete=True`` also removes remote files and
+    directories which don't exist locally. Skipped and removed remote paths
+    are available on the return value as ``.skipped`` and ``.deleted``.
+
+    For large files which change little between uploads, give ``delta=True``
+    to send only the parts of each file which changed, rsync-style (see
+    `fabric.delta`.) This needs Python on the remote host; the result is
+    checked against the local file's SHA1 hash, and whenever a delta
+    transfer isn't possible or doesn't verify, the whole file is uploaded as
+    usual instead. ``delta`` is ignored when ``use_sudo`` is given.
+
+    Directory trees with many small files (see :ref:`env.put_stream_threshold
+    <put-stream-threshold>`) are sent as a single ``tar`` stream, unpacked by
+    the remote ``tar``, rather than file by file.
+
+    With ``resume=True``, each file is uploaded to a ``.fabric-partial`` file
+    next to its destination, and only renamed into place once complete. If
+    the connection drops, Fabric reconnects and carries on from the end of
+    the partial file, once its contents are confirmed to match the local file
+    (by hashing both, remotely with ``head`` and ``sha1sum``), up to
+    :ref:`env.transfer_retries <transfer-retries>` times per file. A partial
+    file left over by an earlier, failed ``put`` is resumed the same way.
+
+    Hosts without an SFTP server, or where many small files make SFTP's
+    per-file round trips add up, may use the SCP protocol instead: give
+    ``backend='scp'`` (or set :ref:`env.transfer_backend
+    <transfer-backend>`) to send everything over a single remote ``scp``
+    (see `fabric.scp`.) ``sync``, ``delete``, ``delta`` and ``resume``
+    aren't available then. With ``use_sudo``, files go to a staging
+    directory and are moved into place as above.
+
+    Give ``verify='sha256'`` (or ``'md5'``, ``'sha1'``, ``'sha224'``,
+    ``'sha384'`` or ``'sha512'``) to check that uploads arrived intact: each
+    file is hashed as it's read for sending, and the remote copies are then
+    hashed by one ``sha256sum`` (or counterpart) command for the whole call,
+    run with `sudo` when ``use_sudo`` is given. The return value then also
+    has ``.hashes``, a dict mapping the remote paths uploaded to their hex
+    digests, and ``.verified``, mapping them to whether their remote copies
+    matched. Files which didn't are also listed in ``.failed``. ``verify``
+    can't be combined with ``delta`` or ``resume``, and keeps directories
+    from being sent as tar streams.
+
     `~fabric.operations.put` will honor `~fabric.context_managers.cd`, so
     relative values in ``remote_path`` will be prepended by the current remote
     working directory, if applicable. Thus, for example, the below snippet
@@ -335,7 +406,19 @@ def put(local_path=None, remote_path=None, use_sudo=False,
         Allow a ``name`` attribute on file-like objects for log output
     .. versionchanged:: 1.7
         Added ``use_glob`` option to allow disabling of globbing.
+    .. versionchanged:: 1.8
+        Multiple files (from globs or directories) are uploaded concurrently,
+        over up to :ref:`env.sftp_channels <sftp-channels>` SFTP channels.
+    .. versionadded:: 1.8
+        The ``sync``, ``checksum``, ``delete``, ``delta``, ``resume``,
+        ``backend`` and ``verify`` options.
     """
+    if _transfer_backend('put', backend) == 'scp' \
+        and (sync or delete or delta or resume):
+        raise ValueError("put() can't sync, delete, delta or resume over scp")
+    if _verify_algorithm('put', verify) and (delta or resume):
+        raise ValueError("put() can't verify delta or resumed transfers")
+
     # Handle empty local path
     local_path = local_path or os.getcwd()
 
@@ -343,10 +426,19 @@ def put(local_path=None, remote_path=None, use_sudo=False,
     local_is_path = not (hasattr(local_path, 'read') \
         and callable(local_path.read))
 
+    # Uploads change the host, so cached query results can't be trusted.
+    query_cache.invalidate(env.host_string)
+
+    if _transfer_backend('put', backend) == 'scp':
+        return _put_scp(_local_names(local_path, local_is_path, use_glob),
+            local_is_path, remote_path, use_sudo, mirror_local_mode, mode,
+            temp_dir, verify)
+
     ftp = SFTP(env.host_string)
+    ftp.verify = verify
 
     with closing(ftp) as ftp:
-        home = ftp.normalize('.')
+        home = ftp.home()
 
         # Empty remote path implies cwd
         remote_path = remote_path or home
@@ -359,45 +451,59 @@ def put(local_path=None, remote_path=None, use_sudo=False,
         if not os.path.isabs(remote_path) and env.get('cwd'):
             remote_path = env.cwd.rstrip('/') + '/' + remote_path
 
-        if local_is_path:
-            # Apply lcwd, expand tildes, etc
-            local_path = os.path.expanduser(local_path)
-            local_path = apply_lcwd(local_path, env)
-            if use_glob:
-                # Glob local path
-                names = glob(local_path)
-            else:
-                # Check if file exists first so ValueError gets raised
-                if os.path.exists(local_path):
-                    names = [local_path]
-                else:
-                    names = []
-        else:
-            names = [local_path]
-
-        # Make sure local arg exists
-        if local_is_path and not names:
-            err = "'%s' is not a valid local path or glob." % local_path
-            raise ValueError(err)
+        names = _local_names(local_path, local_is_path, use_glob)
 
         # Sanity check and wierd cases
         if ftp.exists(remote_path):
             if local_is_path and len(names) != 1 and not ftp.isdir(remote_path):
                 raise ValueError("'%s' is not a directory" % remote_path)
 
+        # Upload plain files concurrently, up front; directories are handled
+        # (and parallelized) one at a time by put_dir.
+        files = [lpath for lpath in names
+            if not (local_is_path and os.path.isdir(lpath))]
+        # Fetch what sync compares against in one go: remote attributes with
+        # one listing per directory, and remote hashes with one command
+        attrs = hashes = None
+        if sync and local_is_path and files:
+            into = ftp.isdir(remote_path)
+            targets = [posixpath.join(remote_path, os.path.basename(lpath))
+                if into else remote_path for lpath in files]
+            attrs = ftp.lstat_many(targets)
+            if checksum:
+                hashes = ftp.remote_hashes(targets, use_sudo)
+        def upload(sftp, lpath):
+            return sftp.put(lpath, remote_path, use_sudo, mirror_local_mode,
+                mode, local_is_path, temp_dir, sync, checksum, delta, resume,
+                hashes=hashes, attrs=attrs)
+        uploaded = dict(zip(files, ftp.map(upload, files, False)))
+
         # Iterate over all given local files
         remote_paths = []
         failed_local_paths = []
         for lpath in names:
             try:
-                if local_is_path and os.path.isdir(lpath):
+                if lpath in uploaded:
+                    p, exc_info = uploaded[lpath]
+                    if exc_info:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    # Skipped by sync
+                    if p is not None:
+                        remote_paths.append(p)
+                else:
                     p = ftp.put_dir(lpath, remote_path, use_sudo,
-                        mirror_local_mode, mode, temp_dir)
+                        mirror_local_mode, mode, temp_dir, sync, checksum,
+                        delete, delta, resume)
                     remote_paths.extend(p)
-                else:
-                    p = ftp.put(lpath, remote_path, use_sudo, mirror_local_mode,
-                        mode, local_is_path, temp_dir)
-                    remote_paths.append(p)
+                    # Files sudo couldn't move into place
+                    if ftp.failed:
+                        failed_local_paths.extend(
+                            local for local, remote, reason in ftp.failed)
+                        error(message="put() couldn't move %d file(s) from "
+                            "'%s' into place:\n%s" % (len(ftp.failed), lpath,
+                            "\n".join("    %s: %s" % (remote, reason)
+                            for local, remote, reason in ftp.failed)))
+                        del ftp.failed[:]
             except Exception, e:
                 msg = "put() encountered an exception while uploading '%s'"
                 failure = lpath if local_is_path else "<StringIO>"
@@ -407,11 +513,159 @@ def put(local_path=None, remote_path=None, use_sudo=False,
         ret = _AttributeList(remote_paths)
         ret.failed = failed_local_paths
         ret.succeeded = not ret.failed
+        ret.skipped = ftp.skipped
+        ret.deleted = ftp.deleted
+        if verify:
+            _verify_transfers('put', ret, ftp.hashed, verify, use_sudo)
         return ret
 
 
+def _local_names(local_path, local_is_path, use_glob):
+    """
+    Return the local files `put` is to upload for ``local_path``.
+    """
+    if not local_is_path:
+        return [local_path]
+    # Apply lcwd, expand tildes, etc
+    local_path = os.path.expanduser(local_path)
+    local_path = apply_lcwd(local_path, env)
+    if use_glob:
+        # Glob local path
+        names = glob(local_path)
+    else:
+        # Check if file exists first so ValueError gets raised
+        if os.path.exists(local_path):
+            names = [local_path]
+        else:
+            names = []
+    # Make sure local arg exists
+    if not names:
+        err = "'%s' is not a valid local path or glob." % local_path
+        raise ValueError(err)
+    return names
+
+
+def _verify_algorithm(function, verify):
+    """
+    Check ``verify``, as given to ``function``, and return it.
+    """
+    if verify and verify not in VERIFY_ALGORITHMS:
+        raise ValueError("%s() can verify with %s, not %r" % (function,
+            ", ".join(VERIFY_ALGORITHMS), verify))
+    return verify
+
+
+def _verify_transfers(function, ret, hashed, algorithm, use_sudo):
+    """
+    Check the files `put` or `get` (``function``) transferred against their
+    remote copies, hashed by one remote command, and update their return
+    value ``ret`` accordingly.
+
+    ``hashed`` holds the ``(local_path, remote_path, hex digest)`` of each
+    file, hashed on its way through. Adds the ``.hashes`` and ``.verified``
+    dicts to ``ret``, keyed by the paths it lists (remote paths, for file
+    objects `get` wrote to), and lists files which don't match in
+    ``ret.failed``.
+    """
+    uploading = function == 'put'
+    files = []
+    for local, remote, digest in hashed:
+        if uploading:
+            key, label = remote, local
+            # Uploads which couldn't be moved into place with sudo
+            if remote not in ret:
+                continue
+        else:
+            key, label = local, remote
+        if not isinstance(local, basestring):
+            key = remote
+            if uploading:
+                label = "<StringIO>"
+        files.append((key, label, remote, digest))
+    remote_hashes = SFTP.remote_hashes(
+        sorted(set(remote for key, label, remote, digest in files)),
+        use_sudo, algorithm)
+    ret.hashes = {}
+    ret.verified = {}
+    mismatched = []
+    for key, label, remote, digest in files:
+        ret.hashes[key] = digest
+        ret.verified[key] = remote_hashes.get(remote) == digest
+        if not ret.verified[key]:
+            mismatched.append((remote, "hash mismatch" if remote in
+                remote_hashes else "couldn't hash remote file"))
+            ret.failed.append(label)
+    ret.succeeded = not ret.failed
+    if mismatched:
+        error(message="%s() couldn't verify %d file(s) with %s:\n%s" % (
+            function, len(mismatched), algorithm, "\n".join(
+                "    %s: %s" % mismatch for mismatch in mismatched)))
+
+
+def _transfer_backend(function, backend):
+    """
+    Return the transfer backend ``function`` is to use: ``backend``, or
+    :ref:`env.transfer_backend <transfer-backend>` if not given.
+    """
+    backend = backend or env.transfer_backend
+    if backend not in ('sftp', 'scp'):
+        raise ValueError("%s() backend must be 'sftp' or 'scp', not %r" % (
+            function, backend))
+    return backend
+
+
+def _put_scp(names, local_is_path, remote_path, use_sudo, mirror_local_mode,
+    mode, temp_dir, verify=None):
+    """
+    Upload ``names`` (as found by `_local_names`) over a single remote
+    ``scp``, through a `fabric.scp.SCP` object.
+    """
+    remote_paths = []
+    failed_local_paths = []
+
+    def report(failed, message):
+        failed_local_paths.extend(local if local_is_path else "<StringIO>"
+            for local, remote, reason in failed)
+        error(message="%s:\n%s" % (message, "\n".join("    %s: %s" % (
+            remote, reason) for local, remote, reason in failed)))
+        del failed[:]
+
+    transfer = scp.SCP(env.host_string)
+    transfer.verify = verify
+    with closing(transfer):
+        transfer.start_put(names, local_is_path, remote_path, use_sudo,
+            mirror_local_mode, mode, temp_dir)
+        for lpath in names:
+            label = lpath if local_is_path else "<StringIO>"
+            try:
+                remote_paths.extend(transfer.put(lpath))
+                # Files the remote end refused
+                if transfer.failed:
+                    report(transfer.failed, "put() couldn't upload %d "
+                        "file(s) from '%s'" % (len(transfer.failed), label))
+            except Exception, e:
+                msg = "put() encountered an exception while uploading '%s'"
+                failed_local_paths.append(label)
+                error(message=msg % lpath, exception=e)
+        remote_paths.extend(transfer.finish_put())
+        # Files sudo couldn't move into place
+        if transfer.failed:
+            report(transfer.failed, "put() couldn't move %d file(s) into "
+                "place" % len(transfer.failed))
+
+    ret = _AttributeList(remote_paths)
+    ret.failed = failed_local_paths
+    ret.succeeded = not ret.failed
+    ret.skipped = []
+    ret.deleted = []
+    if verify:
+        _verify_transfers('put', ret, transfer.hashed, verify, use_sudo)
+    return ret
+
+
 @needs_host
-def get(remote_path, local_path=None):
+def get(remote_path, local_path=None, mode='sftp', compress=None,
+    resume=False, backend=None, verify=None):
     """
     Download one or more files from a remote host.
 
@@ -496,6 +750,32 @@ def get(remote_path, local_path=None):
         will be used in Fabric's printed output instead of the default
         ``<file obj>``
 
+    Directories are downloaded file by file over SFTP by default. Give
+    ``mode='stream'`` to have the remote ``tar`` send each directory as a
+    single archive instead, unpacked locally as it arrives (see
+    `fabric.tarstream`), which is much faster for trees of many small files.
+    ``compress`` may then be ``"gz"`` or ``"bz2"`` to compress the archive
+    in transit. Local paths and the return value are the same either way;
+    plain files are always downloaded over SFTP.
+
+    With ``resume=True``, files downloaded to local paths are written to a
+    ``.fabric-partial`` file first, which later attempts carry on from after
+    the connection drops, or after an earlier ``get`` failed; see
+    `~fabric.operations.put` for details.
+
+    Give ``backend='scp'`` (or set :ref:`env.transfer_backend
+    <transfer-backend>`) to download over the SCP protocol instead of SFTP,
+    everything matching ``remote_path`` coming over a single remote ``scp``
+    (see `fabric.scp`.) ``mode='stream'`` and ``resume`` aren't available
+    then, and globs are expanded by the remote shell.
+
+    ``verify`` checks downloads the way it does uploads (see
+    `~fabric.operations.put`): files are hashed as they're written, their
+    remote copies all at once afterwards, and the return value gets
+    ``.hashes`` and ``.verified`` dicts keyed by local path (or by remote
+    path, for file-like objects.) Files which don't match are listed in
+    ``.failed``. ``verify`` can't be combined with ``resume``.
+
     .. versionchanged:: 1.0
         Now honors the remote working directory as manipulated by
         `~fabric.context_managers.cd`, and the local working directory as
@@ -513,7 +793,21 @@ def get(remote_path, local_path=None):
         also exhibits the ``.failed`` and ``.succeeded`` attributes.
     .. versionchanged:: 1.5
         Allow a ``name`` attribute on file-like objects for log output
+    .. versionchanged:: 1.8
+        Directory trees are listed and downloaded concurrently, over up to
+        :ref:`env.sftp_channels <sftp-channels>` SFTP channels.
+    .. versionchanged:: 1.8
+        Added the ``mode``, ``compress``, ``resume``, ``backend`` and
+        ``verify`` kwargs.
     """
+    if mode not in ('sftp', 'stream'):
+        raise ValueError("get() mode must be 'sftp' or 'stream', not %r"
+            % (mode,))
+    scp_backend = _transfer_backend('get', backend) == 'scp'
+    if scp_backend and (mode == 'stream' or resume):
+        raise ValueError("get() can't stream or resume over scp")
+    if _verify_algorithm('get', verify) and resume:
+        raise ValueError("get() can't verify resumed transfers")
     # Handle empty local path / default kwarg value
     local_path = local_path or "%(host)s/%(path)s"
 
@@ -525,10 +819,14 @@ def get(remote_path, local_path=None):
     if local_is_path:
         local_path = apply_lcwd(local_path, env)
 
+    if scp_backend:
+        return _get_scp(remote_path, local_path, local_is_path, verify)
+
     ftp = SFTP(env.host_string)
+    ftp.verify = verify
 
     with closing(ftp) as ftp:
-        home = ftp.normalize('.')
+        home = ftp.home()
         # Expand home directory markers (tildes, etc)
         if remote_path.startswith('~'):
             remote_path = remote_path.replace('~', home, 1)
@@ -562,14 +860,19 @@ def get(remote_path, local_path=None):
 
             for remote_path in names:
                 if ftp.isdir(remote_path):
-                    result = ftp.get_dir(remote_path, local_path)
+                    if mode == 'stream':
+                        result = ftp.get_dir_stream(remote_path, local_path,
+                            compress)
+                    else:
+                        result = ftp.get_dir(remote_path, local_path,
+                            resume)
                     local_files.extend(result)
                 else:
                     # Perform actual get. If getting to real local file path,
                     # add result (will be true final path value) to
                     # local_files. File-like objects are omitted.
                     result = ftp.get(remote_path, local_path, local_is_path,
-                        os.path.basename(remote_path))
+                        os.path.basename(remote_path), resume)
                     if local_is_path:
                         local_files.append(result)
 
@@ -581,9 +884,207 @@ def get(remote_path, local_path=None):
         ret = _AttributeList(local_files if local_is_path else [])
         ret.failed = failed_remote_files
         ret.succeeded = not ret.failed
+        if verify:
+            _verify_transfers('get', ret, ftp.hashed, verify, False)
         return ret
 
 
+def _get_scp(remote_path, local_path, local_is_path, verify=None):
+    """
+    Download ``remote_path`` over a single remote ``scp``, through a
+    `fabric.scp.SCP` object.
+    """
+    local_files = []
+    failed_remote_files = []
+    transfer = scp.SCP(env.host_string)
+    transfer.verify = verify
+    try:
+        transfer.get(remote_path, local_path, local_is_path, local_files)
+    except Exception, e:
+        failed_remote_files.append(remote_path)
+        msg = "get() encountered an exception while downloading '%s'"
+        error(message=msg % remote_path, exception=e)
+
+    ret = _AttributeList(local_files if local_is_path else [])
+    ret.failed = failed_remote_files
+    ret.succeeded = not ret.failed
+    if verify:
+        _verify_transfers('get', ret, transfer.hashed, verify, False)
+    return ret
+
+
+def broadcast_put(local_path, remote_path, hosts=None, mode=None, relay=None,
+    pool_size=None):
+    """
+    Upload one local file to many hosts at once, reading it only once.
+
+    Unlike calling `put` from a task in :doc:`parallel mode
+    </usage/parallel>`, which has every forked process read the file on its
+    own, the file is memory-mapped once and written from that single copy to
+    every one of ``hosts`` (default: :ref:`env.hosts <hosts>`) at once, over
+    up to ``pool_size`` connections at a time (default: :ref:`env.pool_size
+    <pool-size>`, or 64.) ``remote_path`` is the path of the file on every
+    host; relative paths honor `~fabric.context_managers.cd` as in `put`.
+    ``mode`` sets the remote file's permissions, like `put`'s.
+
+    With many hosts, the local uplink carries one copy of the file per host.
+    Give ``relay=N`` to have hosts pass the file on to one another instead:
+    Fabric only sends it to ``N`` hosts, each of which forwards it to ``N``
+    more while writing it to disk, and so on (see `fabric.broadcast`), so
+    that ``relay=2`` reaches 300 hosts 8 hops deep while only sending two
+    copies; ``relay=1`` chains all hosts one after the other. Relaying needs
+    Python on every host, and every host able to ``ssh`` to the others
+    without a prompt (e.g. with :ref:`env.forward_agent <forward-agent>`),
+    using :ref:`env.broadcast_ssh <broadcast-ssh>`.
+
+    Returns a list of the hosts which received the file, with the failed
+    ones on its ``.failed`` attribute, their error messages on ``.errors``
+    (a dict keyed by host) and ``.succeeded`` being ``not .failed``. Unless
+    ``warn_only`` is set, any failure then causes an abort::
+
+        broadcast_put('dist/app.tar.gz', '/srv/app.tar.gz', hosts=fleet,
+            relay=2)
+
+    .. versionadded:: 1.8
+    """
+    if hosts is None:
+        hosts = env.hosts
+    hosts = list(hosts)
+    local_path = apply_lcwd(os.path.expanduser(local_path), env)
+    if not (posixpath.isabs(remote_path) or remote_path.startswith('~')) \
+        and env.get('cwd'):
+        remote_path = env.cwd.rstrip('/') + '/' + remote_path
+    if isinstance(mode, basestring):
+        mode = int(mode, 8)
+    if output.running:
+        print("[%d hosts] broadcast_put: %s -> %s" % (len(hosts), local_path,
+            remote_path))
+    results = dict((host, "not attempted") for host in hosts)
+
+    with open(local_path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        data = ''
+        if size:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if relay:
+                _broadcast_relay(data, size, remote_path, mode,
+                    broadcast.relay_tree(hosts, relay), results, pool_size)
+            else:
+                _broadcast_direct(data, size, remote_path, mode, hosts,
+                    results, pool_size)
+        finally:
+            if size:
+                data.close()
+
+    ret = _AttributeList(host for host in hosts if results[host] is None)
+    ret.failed = [host for host in hosts if results[host] is not None]
+    ret.errors = dict((host, results[host]) for host in ret.failed)
+    ret.succeeded = not ret.failed
+    if ret.failed:
+        error(message="broadcast_put() failed on %d of %d hosts: %s" % (
+            len(ret.failed), len(hosts), ", ".join(
+                "%s (%s)" % (host, results[host]) for host in ret.failed
+            )
+        ))
+    return ret
+
+
+def _broadcast_threads(items, function, results, pool_size):
+    """
+    Call ``function(item)`` for each of ``items``, in up to ``pool_size``
+    threads at a time; if it fails, record the error in ``results`` under
+    ``item``.
+    """
+    todo = Queue.Queue()
+    for item in items:
+        todo.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                function(item)
+            except (Exception, SystemExit), e:
+                results[item] = str(e) or e.__class__.__name__
+
+    workers = [
+        ThreadHandler('broadcast-%d' % i, worker)
+        for i in range(min(len(items), pool_size or env.pool_size or 64))
+    ]
+    for handler in workers:
+        handler.thread.join()
+
+
+def _broadcast_direct(data, size, remote_path, mode, hosts, results,
+    pool_size):
+    # The SFTP server resolves relative paths against the home directory
+    if remote_path.startswith('~/'):
+        remote_path = remote_path[2:]
+
+    def send(host):
+        ftp = open_sftp(connections[host])
+        try:
+            remote = ftp.open(remote_path, 'wb')
+            try:
+                remote.set_pipelined(True)
+                for offset in xrange(0, size, 32768):
+                    remote.write(data[offset:offset + 32768])
+            finally:
+                remote.close()
+            if mode is not None:
+                ftp.chmod(remote_path, mode)
+        finally:
+            ftp.close()
+        results[host] = None
+    _broadcast_threads(hosts, send, results, pool_size)
+
+
+def _broadcast_relay(data, size, remote_path, mode, tree, results,
+    pool_size):
+    subtrees = dict(tree)
+    ssh_command = shlex.split(env.broadcast_ssh)
+
+    def send(root):
+        subtree = subtrees[root]
+        channel = connections[root].get_transport().open_session()
+        forward = None
+        config_agent = ssh_config(root).get('forwardagent', 'no').lower() \
+            == 'yes'
+        if env.forward_agent or config_agent:
+            forward = ssh.agent.AgentRequestHandler(channel)
+        try:
+            channel.exec_command(broadcast.helper_command())
+            channel.sendall(broadcast.header(root, remote_path, mode, size,
+                subtree, ssh_command))
+            for offset in xrange(0, size, 65536):
+                channel.sendall(data[offset:offset + 65536])
+            channel.shutdown_write()
+            reported = broadcast.parse_results(channel.makefile('rb').read())
+            stderr = channel.makefile_stderr('rb').read().strip()
+            status = channel.recv_exit_status()
+        finally:
+            if forward:
+                forward.close()
+            channel.close()
+        for host in [root] + broadcast.members(subtree):
+            results[host] = reported.get(host, stderr
+                or "relay exited with status %s" % status)
+
+    def send_tree(root):
+        try:
+            send(root)
+        except (Exception, SystemExit), e:
+            # Nobody further down got anything either
+            for host in [root] + broadcast.members(subtrees[root]):
+                results[host] = str(e) or e.__class__.__name__
+    _broadcast_threads([root for root, subtree in tree], send_tree, results,
+        pool_size)
+
+
 def _sudo_prefix_argument(argument, value):
     if value is None:
         return ""
@@ -631,6 +1132,30 @@ def _shell_wrap(command, shell_escape, shell=True, sudo_prefix=None):
     return sudo_prefix + shell + command
 
 
+def _compress_wrap(command, combine_stderr=False):
+    """
+    Pipe ``command``'s stdout through ``gzip`` while preserving its exit code.
+
+    A plain ``command | gzip`` would report gzip's exit status instead of the
+    command's, and ``pipefail`` isn't available in every shell, so both
+    statuses are handed back out-of-band on file descriptor 3. The wrapper
+    exits with the command's status, unless gzip failed (e.g. wasn't found),
+    in which case it exits with gzip's: the output is lost either way.
+
+    When ``combine_stderr`` is True, stderr is merged into the compressed
+    stream on the remote end, since merging it on our end would interleave
+    plain text with gzip data.
+    """
+    redirect = " 2>&1" if combine_stderr else ""
+    return (
+        "exec 4>&1; _fab_st=$({ { ( %s )%s 3>&- 4>&-; echo c$? >&3; }"
+        " | { gzip -c >&4 3>&- 4>&-; echo g$? >&3; }; } 3>&1);"
+        " for _fab_s in $_fab_st; do case $_fab_s in"
+        " c*) _fab_rc=${_fab_s#c};; g*) _fab_gz=${_fab_s#g};; esac; done;"
+        " [ \"$_fab_gz\" = 0 ] || exit ${_fab_gz:-1}; exit ${_fab_rc:-1}"
+    ) % (command, redirect)
+
+
 def _prefix_commands(command, which):
     """
     Prefixes ``command`` with all prefixes found in ``env.command_prefixes``.
@@ -705,7 +1230,8 @@ def _prefix_env_vars(command, local=False):
 
 
 def _execute(channel, command, pty=True, combine_stderr=None,
-    invoke_shell=False, stdout=None, stderr=None, timeout=None):
+    invoke_shell=False, stdout=None, stderr=None, timeout=None,
+    compress=False, stdin=None, stdin_marker=None):
     """
     Execute ``command`` over ``channel``.
 
@@ -720,6 +1246,14 @@ def _execute(channel, command, pty=True, combine_stderr=None,
     ``invoke_shell`` (plus a handful of other things, such as always forcing a
     pty.)
 
+    ``compress`` indicates that ``command`` writes a gzip stream to its stdout
+    (see `_compress_wrap`), which will be decompressed as it is read.
+
+    ``stdin``, if given, is streamed to the remote program instead of the local
+    terminal's input (see `~fabric.io.stdin_loop`). If ``stdin_marker`` is also
+    given, streaming waits until that string has been seen (and removed) on
+    one of the output streams.
+
     Returns a three-tuple of (``stdout``, ``stderr``, ``status``), where
     ``stdout``/``stderr`` are captured output strings and ``status`` is the
     program's return code, if applicable.
@@ -771,12 +1305,26 @@ def _execute(channel, command, pty=True, combine_stderr=None,
         if invoke_shell:
             stdout_buf = stderr_buf = None
 
+        # Input comes either from the local terminal or from the given stdin
+        # source, the latter possibly waiting on a marker in the output.
+        stdin_ready = None
+        if stdin_marker is not None:
+            stdin_ready = threading.Event()
+        if stdin is None:
+            in_worker = ThreadHandler('in', input_loop, channel, using_pty)
+        else:
+            in_worker = ThreadHandler('in', stdin_loop, channel, stdin,
+                stdin_ready)
+
         workers = (
             ThreadHandler('out', output_loop, channel, "recv",
-                capture=stdout_buf, stream=stdout, timeout=timeout),
+                capture=stdout_buf, stream=stdout, timeout=timeout,
+                decompress=compress, marker=stdin_marker,
+                marker_event=stdin_ready),
             ThreadHandler('err', output_loop, channel, "recv_stderr",
-                capture=stderr_buf, stream=stderr, timeout=timeout),
-            ThreadHandler('in', input_loop, channel, using_pty)
+                capture=stderr_buf, stream=stderr, timeout=timeout,
+                marker=stdin_marker, marker_event=stdin_ready),
+            in_worker
         )
 
         if remote_interrupt is None:
@@ -870,12 +1418,27 @@ def _noop():
     yield
 
 
+def _stdin_marker():
+    """
+    Return a unique string for a command to announce it's reading stdin.
+    """
+    return "__fabric_stdin_%x__" % random.getrandbits(64)
+
+
 def _run_command(command, shell=True, pty=True, combine_stderr=True,
     sudo=False, user=None, quiet=False, warn_only=False, stdout=None,
-    stderr=None, group=None, timeout=None, shell_escape=None):
+    stderr=None, group=None, timeout=None, shell_escape=None, compress=False,
+    stdin=None, background=False):
     """
     Underpinnings of `run` and `sudo`. See their docstrings for more info.
+
+    If ``background`` is True, the command is started on a channel of its own
+    and a `RemoteFuture` is returned (see `run_async`).
     """
+    # The compression pipeline is shell code, which sudo can't run by itself.
+    if compress and sudo and not (shell and env.use_shell):
+        abort("sudo(compress=True) needs a shell: it can't be combined with "
+            "shell=False or env.use_shell = False")
     manager = _noop
     if warn_only:
         manager = warn_only_manager
@@ -890,63 +1453,166 @@ def _run_command(command, shell=True, pty=True, combine_stderr=True,
         if shell_escape is None:
             shell_escape = env.get('shell_escape', True)
 
-        # Handle context manager modifications, and shell wrapping
-        wrapped_command = _shell_wrap(
-            _prefix_commands(_prefix_env_vars(command), 'remote'),
-            shell_escape,
-            shell,
-            _sudo_prefix(user, group) if sudo else None
-        )
-        # Execute info line
+        # Handle context manager modifications
+        command = _prefix_commands(_prefix_env_vars(command), 'remote')
+
+        # Read-only queries may be answered from the cache; anything else may
+        # change the host, so forget what we know about it.
         which = 'sudo' if sudo else 'run'
+        cache_key = None
+        if not query_cache.read_only():
+            query_cache.invalidate(env.host_string)
+        elif env.cache_queries and stdin is None and not background:
+            cache_key = query_cache.key(which, _shell_wrap(
+                command, shell_escape, shell,
+                _sudo_prefix(user, group) if sudo else None
+            ), combine_stderr)
+            result = query_cache.get(cache_key, env.cache_ttl)
+            if result is not None:
+                if output.running:
+                    print("[%s] %s: %s (cached)" % (env.host_string, which,
+                        given_command))
+                return result
+
+        # Within batch(), defer the command unless it needs a channel of its
+        # own, in which case whatever was deferred so far goes first.
+        if _batches:
+            if (stdin is None and not compress and timeout is None
+                and not background):
+                return _batches[-1].record(given_command, command, shell,
+                    shell_escape, _sudo_prefix(user, group) if sudo else None,
+                    combine_stderr, stdout, stderr)
+            _batches[-1].flush()
+
+        # Compressed output is binary until we decompress it, so it can't go
+        # through a pty (which would mangle line endings) and any stream
+        # combining has to happen on the remote end.
+        if compress:
+            if combine_stderr is None:
+                combine_stderr = env.combine_stderr
+            command = _compress_wrap(command, combine_stderr)
+            pty = combine_stderr = False
+
+        # Streamed stdin mustn't go through a pty either. sudo reads its
+        # password from the same stdin, so when it's involved, have the command
+        # itself print a marker once sudo is out of the way, and only start
+        # streaming after that. (This needs the shell wrapper; otherwise the
+        # marker would run as sudo's command, and the real one as ourselves.)
+        stdin_marker = None
+        if stdin is not None:
+            pty = False
+            if sudo and shell and env.use_shell:
+                stdin_marker = _stdin_marker()
+                command = "printf %s >&2; %s" % (stdin_marker, command)
+
+        # Persistent shells are fed shell code directly, so there's no shell
+        # to wrap in -- except under sudo, which needs to run something. They
+        # don't do pty or stdin; see fabric.shell.
+        persistent = (env.persistent_shell and shell and env.use_shell
+            and stdin is None and not background)
+        if persistent:
+            pty = False
+            if sudo:
+                # Authentication happens up front, so sudo itself mustn't
+                # prompt (and send us a password it wouldn't read.)
+                with settings(sudo_prompt=''):
+                    wrapped_command = _shell_wrap(command, shell_escape, shell,
+                        _sudo_prefix(user, group))
+            else:
+                wrapped_command = command
+        # Shell wrapping
+        else:
+            wrapped_command = _shell_wrap(
+                command,
+                shell_escape,
+                shell,
+                _sudo_prefix(user, group) if sudo else None
+            )
+        # With aggregated output, output is printed later (grouped with that
+        # of other hosts) instead.
+        aggregating = env.aggregate and output.stdout and not background
+
+        # Execute info line
         if output.debug:
             print("[%s] %s: %s" % (env.host_string, which, wrapped_command))
-        elif output.running:
+        elif output.running and not aggregating:
             print("[%s] %s: %s" % (env.host_string, which, given_command))
 
+        if background:
+            return RemoteFuture(which, given_command, wrapped_command,
+                combine_stderr, stdout, stderr, timeout, compress, stdin,
+                stdin_marker)
+
         # Actual execution, stdin/stdout/stderr handling, and termination
-        result_stdout, result_stderr, status = _execute(
-            channel=default_channel(), command=wrapped_command, pty=pty,
-            combine_stderr=combine_stderr, invoke_shell=False, stdout=stdout,
-            stderr=stderr, timeout=timeout)
-
-        # Assemble output string
-        out = _AttributeString(result_stdout)
-        err = _AttributeString(result_stderr)
-
-        # Error handling
-        out.failed = False
-        out.command = given_command
-        out.real_command = wrapped_command
-        if status not in env.ok_ret_codes:
-            out.failed = True
-            msg = "%s() received nonzero return code %s while executing" % (
-                which, status
+        if persistent:
+            channel = shell_channel()
+            executed = shell_code(wrapped_command, sudo)
+        else:
+            channel = default_channel()
+            executed = wrapped_command
+        with (hide('stdout', 'stderr') if aggregating else _noop()):
+            result_stdout, result_stderr, status = _execute(
+                channel=channel, command=executed, pty=pty,
+                combine_stderr=combine_stderr, invoke_shell=False,
+                stdout=stdout, stderr=stderr, timeout=timeout,
+                compress=compress, stdin=stdin, stdin_marker=stdin_marker)
+        if aggregating:
+            aggregator.record(env.host_string, which, given_command,
+                result_stdout, result_stderr, status)
+
+        result = _command_result(which, given_command, wrapped_command,
+            result_stdout, result_stderr, status)
+        if cache_key is not None:
+            query_cache.set(cache_key, result)
+        return result
+
+
+def _command_result(which, given_command, wrapped_command, stdout, stderr,
+    status):
+    """
+    Turn the outcome of a `run` or `sudo` call into its return value.
+
+    Also handles nonzero return codes as per ``env.warn_only`` and
+    ``env.ok_ret_codes``.
+    """
+    # Assemble output string
+    out = _AttributeString(stdout)
+    err = _AttributeString(stderr)
+
+    # Error handling
+    out.failed = False
+    out.command = given_command
+    out.real_command = wrapped_command
+    if status not in env.ok_ret_codes:
+        out.failed = True
+        msg = "%s() received nonzero return code %s while executing" % (
+            which, status
+        )
+        if env.warn_only:
+            msg += " '%s'!" % given_command
+        else:
+            msg += "!\n\nRequested: %s\nExecuted: %s" % (
+                given_command, wrapped_command
             )
-            if env.warn_only:
-                msg += " '%s'!" % given_command
-            else:
-                msg += "!\n\nRequested: %s\nExecuted: %s" % (
-                    given_command, wrapped_command
-                )
-            error(message=msg, stdout=out, stderr=err)
+        error(message=msg, stdout=out, stderr=err)
 
-        # Attach return code to output string so users who have set things to
-        # warn only, can inspect the error code.
-        out.return_code = status
+    # Attach return code to output string so users who have set things to
+    # warn only, can inspect the error code.
+    out.return_code = status
 
-        # Convenience mirror of .failed
-        out.succeeded = not out.failed
+    # Convenience mirror of .failed
+    out.succeeded = not out.failed
 
-        # Attach stderr for anyone interested in that.
-        out.stderr = err
+    # Attach stderr for anyone interested in that.
+    out.stderr = err
 
-        return out
+    return out
 
 
 @needs_host
 def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
-    warn_only=False, stdout=None, stderr=None, timeout=None, shell_escape=None):
+    warn_only=False, stdout=None, stderr=None, timeout=None, shell_escape=None,
+    compress=False, stdin=None):
     """
     Run a shell command on a remote host.
 
@@ -1006,12 +1672,33 @@ def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
     If you want to disable Fabric's automatic attempts at escaping quotes,
     dollar signs etc., specify ``shell_escape=False``.
 
+    When pulling large amounts of text over a slow link, specify
+    ``compress=True``: the remote program's output is then piped through
+    ``gzip`` on the remote end and decompressed on the fly as it arrives, so
+    the printed and returned output are the same as usual. This requires
+    ``gzip`` on the remote host, and implies ``pty=False`` (binary data can't
+    travel over a pseudo-terminal); if ``combine_stderr`` is in effect, stderr
+    is merged into the compressed stream remotely.
+
+    To feed data to the remote program, give ``stdin`` a file-like object (such
+    as the result of ``open('dump.sql')``) or any iterable of strings. It will
+    be streamed to the remote end as the program consumes it, with no
+    temporary copy on either side, and the remote stdin is closed once it's
+    exhausted. Local terminal input is not forwarded in this mode, and
+    ``pty=False`` is implied.
+
+    Scripts running many short commands may benefit from
+    :ref:`env.persistent_shell <persistent-shell>`, which runs them all in one
+    long-lived remote shell.
+
     Examples::
 
         run("ls /var/www/")
         run("ls /home/myuser", shell=False)
         output = run('ls /var/www/site1')
         run("take_a_long_time", timeout=5)
+        logs = run("journalctl -u nginx", compress=True)
+        run("psql mydb", stdin=open("dump.sql"))
 
     .. versionadded:: 1.0
         The ``succeeded`` and ``stderr`` return value attributes, the
@@ -1036,16 +1723,19 @@ def run(command, shell=True, pty=True, combine_stderr=None, quiet=False,
 
     .. versionadded:: 1.7
         The ``shell_escape`` argument.
+
+    .. versionadded:: 1.8
+        The ``compress`` and ``stdin`` arguments.
     """
     return _run_command(command, shell, pty, combine_stderr, quiet=quiet,
         warn_only=warn_only, stdout=stdout, stderr=stderr, timeout=timeout,
-        shell_escape=shell_escape)
+        shell_escape=shell_escape, compress=compress, stdin=stdin)
 
 
 @needs_host
 def sudo(command, shell=True, pty=True, combine_stderr=None, user=None,
     quiet=False, warn_only=False, stdout=None, stderr=None, group=None,
-    timeout=None, shell_escape=None):
+    timeout=None, shell_escape=None, compress=False, stdin=None):
     """
     Run a shell command on a remote host, with superuser privileges.
 
@@ -1087,16 +1777,797 @@ def sudo(command, shell=True, pty=True, combine_stderr=None, user=None,
 
     .. versionadded:: 1.7
         The ``shell_escape`` argument.
+
+    .. versionadded:: 1.8
+        The ``compress`` and ``stdin`` arguments. Both need a shell to run in
+        when combined with ``sudo``: the compression pipeline can't work
+        without one (Fabric aborts otherwise), and with ``shell=False``
+        the ``stdin`` data is sent right away, so ``sudo`` must not need to
+        prompt for a password.
     """
     return _run_command(
         command, shell, pty, combine_stderr, sudo=True,
         user=user if user else env.sudo_user,
         group=group, quiet=quiet, warn_only=warn_only, stdout=stdout,
         stderr=stderr, timeout=timeout, shell_escape=shell_escape,
+        compress=compress, stdin=stdin,
+    )
+
+
+class RemoteFuture(object):
+    """
+    The eventual result of a `run_async` or `sudo_async` call.
+
+    The command runs on a channel of its own, over the host's existing
+    connection, while the caller carries on. `result` waits for it and returns
+    what `run`/`sudo` would have, handling failures according to the settings
+    in effect when the command was started.
+    """
+    def __init__(self, which, given_command, wrapped_command, combine_stderr,
+        stdout, stderr, timeout, compress, stdin, stdin_marker):
+        self.which = which
+        self.command = given_command
+        self.real_command = wrapped_command
+        self.host_string = env.host_string
+        self.warn_only = env.warn_only
+        self.ok_ret_codes = list(env.ok_ret_codes)
+        self.output = dict(output)
+        self._result = None
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+        if timeout is None:
+            timeout = env.command_timeout
+        self.channel = channel = default_channel()
+        channel.set_combine_stderr(combine_stderr)
+        config_agent = ssh_config().get('forwardagent', 'no').lower() == 'yes'
+        self.forward = None
+        if env.forward_agent or config_agent:
+            self.forward = ssh.agent.AgentRequestHandler(channel)
+        channel.exec_command(command=wrapped_command)
+        self.stdout_buf, self.stderr_buf = [], []
+        ready = None
+        if stdin_marker is not None:
+            ready = threading.Event()
+        self.workers = []
+        for name, attr, stream, capture, decompress in (
+            ('out', 'recv', stdout, self.stdout_buf, compress),
+            ('err', 'recv_stderr', stderr, self.stderr_buf, False),
+        ):
+            looper = OutputLooper(channel, attr, stream or getattr(sys,
+                'std' + name), capture, timeout, decompress=decompress,
+                marker=stdin_marker, marker_event=ready)
+            # Other commands are likely printing at the same time.
+            looper.linewise = True
+            self.workers.append(ThreadHandler(name, looper.loop))
+        if stdin is not None:
+            self.workers.append(ThreadHandler('in', stdin_loop, channel,
+                stdin, ready))
+
+    def done(self):
+        """
+        Return True if the command has finished.
+        """
+        return not any(worker.thread.isAlive() for worker in self.workers)
+
+    def wait(self):
+        """
+        Wait for the command to finish, without handling its outcome.
+        """
+        for worker in self.workers:
+            while worker.thread.isAlive():
+                worker.thread.join(ssh.io_sleep)
+                if worker.exception:
+                    break
+            if worker.exception:
+                # E.g. a timeout; nothing more will come of this channel.
+                self._close()
+                worker.raise_if_needed()
+
+    def result(self):
+        """
+        Wait for the command to finish and return its result.
+
+        The result is the same as `run`/`sudo` would have returned; a failure
+        causes an abort, unless ``warn_only`` was in effect when the command
+        was started.
+        """
+        if self._result is None:
+            self.wait()
+            status = self.channel.recv_exit_status()
+            self._close()
+            with settings(host_string=self.host_string,
+                warn_only=self.warn_only, ok_ret_codes=self.ok_ret_codes):
+                with _output_state(self.output):
+                    self._result = _command_result(self.which, self.command,
+                        self.real_command,
+                        ''.join(self.stdout_buf).strip(),
+                        ''.join(self.stderr_buf).strip(), status)
+        return self._result
+
+    def _close(self):
+        self.channel.close()
+        if self.forward is not None:
+            self.forward.close()
+            self.forward = None
+
+
+@needs_host
+def run_async(command, shell=True, combine_stderr=None, quiet=False,
+    warn_only=False, stdout=None, stderr=None, timeout=None,
+    shell_escape=None, compress=False, stdin=None):
+    """
+    Start a shell command on a remote host, returning without waiting for it.
+
+    Takes the same arguments as `run` (except ``pty``: background commands
+    never get one), but returns a `RemoteFuture`; its ``result()`` method
+    waits for the command and returns what `run` would have. Each command
+    gets a channel of its own on the host's existing connection, so several
+    of them may run on the same host at once::
+
+        futures = [run_async("tar xzf %s" % archive) for archive in archives]
+        results = gather(*futures)
+
+    Output is printed as it arrives, one whole line at a time. Background
+    commands don't read the local terminal; use ``stdin`` if they need input.
+
+    .. seealso:: `gather`, `sudo_async`
+    .. versionadded:: 1.8
+    """
+    return _run_command(command, shell, False, combine_stderr, quiet=quiet,
+        warn_only=warn_only, stdout=stdout, stderr=stderr, timeout=timeout,
+        shell_escape=shell_escape, compress=compress, stdin=stdin,
+        background=True)
+
+
+@needs_host
+def sudo_async(command, shell=True, combine_stderr=None, user=None,
+    quiet=False, warn_only=False, stdout=None, stderr=None, group=None,
+    timeout=None, shell_escape=None, compress=False, stdin=None):
+    """
+    Start a command with superuser privileges, without waiting for it.
+
+    Is to `sudo` what `run_async` is to `run`. Password prompts are answered
+    as usual, though if several commands prompt at the same time, it's best
+    for the password to be known beforehand (e.g. via :ref:`env.password
+    <password>`).
+
+    .. seealso:: `gather`, `run_async`
+    .. versionadded:: 1.8
+    """
+    return _run_command(
+        command, shell, False, combine_stderr, sudo=True,
+        user=user if user else env.sudo_user,
+        group=group, quiet=quiet, warn_only=warn_only, stdout=stdout,
+        stderr=stderr, timeout=timeout, shell_escape=shell_escape,
+        compress=compress, stdin=stdin, background=True,
+    )
+
+
+def gather(*futures):
+    """
+    Wait for all given `RemoteFuture` objects and return their results.
+
+    Results come back as a list, in the same order as ``futures``. Every
+    command gets to finish before any failure is handled; after that, the
+    first failing command (in that order) aborts, unless it was started with
+    ``warn_only`` in effect.
+
+    .. versionadded:: 1.8
+    """
+    for future in futures:
+        future.wait()
+    return [future.result() for future in futures]
+
+
+class RunAllResults(dict):
+    """
+    Results of a `run_all` call: a dict mapping host strings to results.
+
+    Each result is a string (the host's output) with the same attributes as
+    `run`'s return value, plus ``elapsed`` (the command's run time, in
+    seconds). Hosts which couldn't be reached, or whose command timed out,
+    have a ``return_code`` of None and an explanation in ``stderr``.
+    """
+    def __init__(self, command, hosts):
+        super(RunAllResults, self).__init__()
+        self.command = command
+        self.hosts = hosts
+
+    @property
+    def failed(self):
+        """
+        The host strings, in order, whose command failed or didn't run.
+        """
+        return [host for host in self.hosts if self[host].failed]
+
+    def table(self, width=79):
+        """
+        Return a one-line-per-host summary, as printed by `run_all`.
+        """
+        host_width = max([len("host")] + map(len, self.hosts))
+        header = "%-*s  %-7s  %7s  %s" % (host_width, "host", "status",
+            "time", "output")
+        lines = [header]
+        for host in self.hosts:
+            result = self[host]
+            if result.return_code is None:
+                status = result.status
+            else:
+                status = str(result.return_code)
+            text = (result or result.stderr).strip()
+            first = text.splitlines()[0] if text else ""
+            line = "%-*s  %-7s  %6.2fs  %s" % (host_width, host, status,
+                result.elapsed, first)
+            lines.append(line[:width])
+        return "\n".join(lines)
+
+
+def _run_all_result(command, real_command, stdout, stderr, return_code,
+    elapsed, status=None):
+    out = _AttributeString(stdout.strip())
+    out.stderr = _AttributeString(stderr.strip())
+    out.command = command
+    out.real_command = real_command
+    out.return_code = return_code
+    out.elapsed = elapsed
+    out.status = status
+    out.failed = return_code not in env.ok_ret_codes
+    out.succeeded = not out.failed
+    return out
+
+
+def run_all(command, hosts=None, shell=True, combine_stderr=None,
+    timeout=None, shell_escape=None, pool_size=None):
+    """
+    Run ``command`` on many hosts at once, from a single process.
+
+    Meant for quick, read-only commands across a whole fleet: rather than one
+    process per host (as in :doc:`parallel mode </usage/parallel>`), a single
+    loop drives every host's channel, reusing Fabric's cached connections.
+    ``hosts`` defaults to :ref:`env.hosts <hosts>`. Connections are made by up
+    to ``pool_size`` threads at a time (default: :ref:`env.pool_size
+    <pool-size>`, or 64), with any password prompts coming one at a time, and
+    each host's command starts as soon as its connection is up.
+
+    ``shell``, ``combine_stderr``, ``timeout`` (per host) and
+    ``shell_escape`` work as they do for `run`; prefixes such as
+    `~fabric.context_managers.cd` apply too. There's no pty, no input and no
+    ``sudo``. Output isn't printed as it arrives; instead, once every host is
+    done, a table summarizing each host's exit code, run time and first line
+    of output is printed (see `RunAllResults.table`) -- or, with
+    :ref:`env.aggregate <aggregate>`, each distinct output, once.
+
+    Returns a `RunAllResults` dict mapping host strings to results. Unless
+    ``warn_only`` is set, failures on any host (including connection errors
+    and timeouts) then cause an abort::
+
+        results = run_all("cat /etc/debian_version", hosts=fleet)
+        outdated = [host for host, version in results.items()
+            if version < "7"]
+
+    .. versionadded:: 1.8
+    """
+    if hosts is None:
+        hosts = env.hosts
+    hosts = list(hosts)
+    if shell_escape is None:
+        shell_escape = env.get('shell_escape', True)
+    if combine_stderr is None:
+        combine_stderr = env.combine_stderr
+    if timeout is None:
+        timeout = env.command_timeout
+    wrapped_command = _shell_wrap(
+        _prefix_commands(_prefix_env_vars(command), 'remote'), shell_escape,
+        shell
     )
+    if output.debug:
+        print("[%d hosts] run_all: %s" % (len(hosts), wrapped_command))
+    elif output.running:
+        print("[%d hosts] run_all: %s" % (len(hosts), command))
+    results = RunAllResults(command, hosts)
+    if not hosts:
+        return results
+
+    # Connecting blocks, so it happens in threads; connected hosts are then
+    # picked up by the loop below.
+    todo, connected = Queue.Queue(), Queue.Queue()
+    for host in hosts:
+        todo.put(host)
+
+    def connect():
+        while True:
+            try:
+                host = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                connections[host]
+            except (Exception, SystemExit), e:
+                connected.put((host, e))
+            else:
+                connected.put((host, None))
+
+    workers = min(len(hosts), pool_size or env.pool_size or 64)
+    for i in range(workers):
+        ThreadHandler('connect-%d' % i, connect)
+
+    running = {}
+    remaining = len(hosts)
+    while remaining:
+        busy = False
+        while True:
+            try:
+                host, e = connected.get_nowait()
+            except Queue.Empty:
+                break
+            busy = True
+            if e is None:
+                try:
+                    with settings(host_string=host):
+                        channel = default_channel()
+                    channel.set_combine_stderr(combine_stderr)
+                    channel.exec_command(wrapped_command)
+                    running[host] = (channel, [], [], time.time())
+                    continue
+                except Exception, e:
+                    pass
+            results[host] = _run_all_result(command, wrapped_command, "",
+                str(e) or e.__class__.__name__, None, 0.0, "error")
+            remaining -= 1
+        now = time.time()
+        for host, (channel, stdout, stderr, start) in running.items():
+            # Output always arrives ahead of the exit status, so once that's
+            # in, one last read gets everything.
+            finished = channel.exit_status_ready()
+            while channel.recv_ready():
+                stdout.append(channel.recv(32768))
+                busy = True
+            while channel.recv_stderr_ready():
+                stderr.append(channel.recv_stderr(32768))
+                busy = True
+            if finished:
+                return_code, status = channel.recv_exit_status(), None
+            elif timeout is not None and now - start > timeout:
+                return_code, status = None, "timeout"
+                stderr.append("\nTimed out after %s seconds" % timeout)
+            else:
+                continue
+            channel.close()
+            del running[host]
+            remaining -= 1
+            results[host] = _run_all_result(command, wrapped_command,
+                "".join(stdout), "".join(stderr), return_code, now - start,
+                status)
+        if not busy:
+            time.sleep(ssh.io_sleep)
+
+    if output.stdout:
+        if env.aggregate:
+            grouped = Aggregator()
+            grouped.reset(len(hosts))
+            for host in hosts:
+                result = results[host]
+                grouped.add(host, 'run', command, result, result.stderr,
+                    result.status or result.return_code)
+        else:
+            print(results.table())
+    failed = results.failed
+    if failed:
+        msg = "run_all() failed on %d of %d hosts: %s" % (len(failed),
+            len(hosts), ", ".join(failed))
+        error(message=msg)
+    return results
+
+
+class _LazyResult(object):
+    """
+    Placeholder for the result of a `run`/`sudo` call recorded by `batch`.
+
+    Once the batch has run, it behaves like the real result (i.e. a string
+    with ``.failed``, ``.return_code`` etc.); before that, using it raises
+    ``ValueError``.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.result = None
+
+    def _get(self):
+        if self.result is None:
+            raise ValueError("Result of %r is not available until the batch"
+                " it's part of has run" % self.command)
+        return self.result
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __str__(self):
+        return str(self._get())
+
+    def __repr__(self):
+        if self.result is None:
+            return "<pending result of %r>" % self.command
+        return repr(self.result)
+
+    def __eq__(self, other):
+        return self._get() == other
+
+    def __ne__(self, other):
+        return self._get() != other
+
+    def __nonzero__(self):
+        return bool(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __contains__(self, item):
+        return item in self._get()
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __add__(self, other):
+        return self._get() + other
+
+    def __radd__(self, other):
+        return other + self._get()
+
+
+@contextmanager
+def _output_state(state):
+    """
+    Temporarily set the `~fabric.state.output` levels to ``state``.
+    """
+    previous = dict(output)
+    output.update(state)
+    try:
+        yield
+    finally:
+        output.update(previous)
+
+
+def _print_lines(stream, prefix, text):
+    for line in text.splitlines():
+        stream.write(prefix + line + "\n")
+    stream.flush()
+
+
+class _BatchedCommand(object):
+    """
+    A `run`/`sudo` call recorded by `batch`, along with the settings in effect
+    at the time.
+    """
+    def __init__(self, given_command, code, sudo, combine_stderr, stdout,
+        stderr):
+        self.given_command = given_command
+        self.code = code
+        self.which = 'sudo' if sudo else 'run'
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+        self.combine_stderr = combine_stderr
+        self.stdout = stdout or sys.stdout
+        self.stderr = stderr or sys.stderr
+        self.host_string = env.host_string
+        self.warn_only = env.warn_only
+        self.ok_ret_codes = list(env.ok_ret_codes)
+        self.output = dict(output)
+        self.result = _LazyResult(given_command)
+
+    def script(self, token, index):
+        """
+        Shell code running this command, followed by its markers.
+
+        Unless ``warn_only`` is in effect, a failure ends the script right
+        there, as an abort would have.
+        """
+        lines = [
+            "( eval %s )%s" % (
+                shell_quote(self.code), " 2>&1" if self.combine_stderr else ""
+            ),
+            "_fab_rc=$?",
+            "printf '%s:%d:%%d\\n' $_fab_rc" % (token, index),
+            "printf '%s:%d\\n' >&2" % (token, index),
+        ]
+        if not self.warn_only:
+            ok = " %s " % " ".join(map(str, self.ok_ret_codes))
+            lines.append('case %s in *" $_fab_rc "*) ;; *) exit ;; esac'
+                % shell_quote(ok))
+        return "\n".join(lines)
+
+    def finish(self, stdout, stderr, status):
+        """
+        Print this command's output and fill in its result, as `run` would.
+        """
+        with settings(host_string=self.host_string, warn_only=self.warn_only,
+            ok_ret_codes=self.ok_ret_codes):
+            with _output_state(self.output):
+                if output.debug:
+                    print("[%s] %s: %s" % (env.host_string, self.which,
+                        self.code))
+                elif output.running:
+                    print("[%s] %s: %s" % (env.host_string, self.which,
+                        self.given_command))
+                for text, stream, level, name in (
+                    (stdout, self.stdout, output.stdout, 'out'),
+                    (stderr, self.stderr, output.stderr, 'err'),
+                ):
+                    if level and text:
+                        prefix = ""
+                        if env.output_prefix:
+                            prefix = "[%s] %s: " % (env.host_string, name)
+                        _print_lines(stream, prefix, text)
+                self.result.result = _command_result(self.which,
+                    self.given_command, self.code, stdout.strip(),
+                    stderr.strip(), status)
+
+
+class _Batch(object):
+    """
+    The commands recorded within one `batch` block.
+    """
+    def __init__(self):
+        self.commands = []
+
+    def record(self, given_command, command, shell, shell_escape,
+        sudo_prefix, combine_stderr, stdout, stderr):
+        # The script runs in a shell already; only sudo needs another one.
+        code = command
+        if sudo_prefix is not None:
+            code = _shell_wrap(command, shell_escape, shell, sudo_prefix)
+        recorded = _BatchedCommand(given_command, code,
+            sudo_prefix is not None, combine_stderr, stdout, stderr)
+        self.commands.append(recorded)
+        return recorded.result
+
+    def flush(self):
+        """
+        Run the commands recorded so far.
+        """
+        recorded, self.commands = self.commands, []
+        # Consecutive commands on the same host share a script. Take the
+        # batch out of action meanwhile, so the scripts themselves do run.
+        index = _batches.index(self) if self in _batches else None
+        if index is not None:
+            del _batches[index]
+        try:
+            for host_string, commands in groupby(recorded,
+                lambda command: command.host_string):
+                self._run_script(host_string, list(commands))
+        finally:
+            if index is not None:
+                _batches.insert(index, self)
+
+    def _run_script(self, host_string, commands):
+        token = "__fabric_batch_%x__" % random.getrandbits(64)
+        script = "\n".join(
+            command.script(token, index)
+            for index, command in enumerate(commands)
+        )
+        # Prefixes, cwd etc. were applied to each command when recorded.
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+            host_string=host_string, warn_only=True, command_prefixes=[],
+            cwd='', path='', shell_env={}):
+            result = _run_command(script, pty=False, combine_stderr=False)
+        stdouts, statuses = {}, {}
+        start = 0
+        for match in re.finditer(re.escape(token) + r':(\d+):(\d+)\n?',
+            result):
+            index = int(match.group(1))
+            stdouts[index] = result[start:match.start()]
+            statuses[index] = int(match.group(2))
+            start = match.end()
+        stderrs = {}
+        start = 0
+        for match in re.finditer(re.escape(token) + r':(\d+)\n?',
+            result.stderr):
+            stderrs[int(match.group(1))] = result.stderr[start:match.start()]
+            start = match.end()
+        for index, command in enumerate(commands):
+            if index not in statuses:
+                with settings(host_string=host_string,
+                    warn_only=command.warn_only):
+                    error("batch() script ended before running '%s'!" % (
+                        command.given_command), stdout=result,
+                        stderr=result.stderr)
+                return
+            command.finish(stdouts[index], stderrs.get(index, ''),
+                statuses[index])
+
+
+# Stack of active batch() blocks; only the outermost one does anything.
+_batches = []
+
+
+@contextmanager
+def batch():
+    """
+    Context manager collecting `run` and `sudo` calls into a single round trip.
+
+    Within the block, `run`/`sudo` don't execute right away; instead, they are
+    recorded and return a placeholder. When the block ends, the recorded
+    commands are sent to their host as one generated script, which runs them in
+    order and reports each one's output and return code. Then, in the order
+    the commands were issued, output is printed and placeholders are filled in
+    with the usual results -- nonzero return codes abort or warn just as they
+    would have, according to the settings in effect when each command was
+    issued. (On abort, the remaining commands don't run.)
+
+    This is meant for runs of independent commands, where waiting for each
+    one in turn mostly means waiting on the network::
+
+        with batch():
+            run("mkdir -p /srv/app/releases /srv/app/shared")
+            sudo("chown -R deploy /srv/app")
+            run("ln -sfn /srv/app/releases/42 /srv/app/current")
+
+    Keep in mind:
+
+    * Results can't be inspected until the block has ended (doing so raises
+      ``ValueError``), so a command can't depend on an earlier one's output.
+    * Only `run` and `sudo` are deferred: anything else, such as
+      `~fabric.operations.put` or `~fabric.operations.local`, happens as soon
+      as it's called. So do calls using the ``stdin``, ``compress`` or
+      ``timeout`` arguments, which need a channel of their own, though any
+      commands recorded before them are run first so as to preserve ordering.
+    * Batched commands run without a pseudo-terminal; each one runs in its own
+      subshell, with `~fabric.context_managers.cd` etc. applied as usual.
+    * If the block raises an exception, recorded commands aren't run.
+    * Commands may target different hosts (e.g. by changing
+      ``env.host_string``); each consecutive run of commands on one host is
+      sent as one script.
+
+    Nested ``batch()`` blocks simply become part of the outermost one.
+
+    .. versionadded:: 1.8
+    """
+    if _batches:
+        yield
+        return
+    recorder = _Batch()
+    _batches.append(recorder)
+    try:
+        yield
+    finally:
+        _batches.pop()
+    recorder.flush()
 
 
-def local(command, capture=False, shell=None):
+def pipe(src, dst, quiet=False, warn_only=False, max_buffer=4 * 1024 * 1024,
+    timeout=None):
+    """
+    Stream the stdout of a command on one host into a command on another.
+
+    ``src`` and ``dst`` are ``(host_string, command)`` tuples. Both commands
+    run at the same time; the source's standard output travels through this
+    process -- never touching local disk -- into the destination's standard
+    input, which is closed once the source is done. At most ``max_buffer``
+    bytes are held locally: when the destination falls behind, reading from
+    the source pauses until it catches up.
+
+    The source's standard error is printed (and captured) as usual, under the
+    source's host string. The destination runs exactly as
+    `~fabric.operations.run` with ``stdin`` would, and the return value is its
+    result, plus:
+
+    * ``bytes``: the number of bytes piped across;
+    * ``elapsed``: how long the transfer took, in seconds;
+    * ``throughput``: ``bytes`` per second;
+    * ``src_return_code`` and ``src_stderr``: the source command's exit code
+      (``None`` if the destination exited before the source was done) and
+      standard error.
+
+    A nonzero exit code from either command is handled as in
+    `~fabric.operations.run`, as are ``quiet``, ``warn_only`` and
+    ``timeout``; ``.failed`` covers both commands.
+
+    Examples::
+
+        pipe(src=('db1', 'pg_dump app'), dst=('db2', 'psql app'))
+        pipe(('build', 'tar -C dist -c .'), ('web1', 'tar -C /srv/app -x'))
+
+    .. versionadded:: 1.8
+    """
+    src_host, src_command = src
+    dst_host, dst_command = dst
+    manager = _noop
+    if warn_only:
+        manager = warn_only_manager
+    if quiet:
+        manager = quiet_manager
+    with manager():
+        with settings(host_string=src_host):
+            wrapped_command = _shell_wrap(
+                _prefix_commands(_prefix_env_vars(src_command), 'remote'),
+                env.get('shell_escape', True)
+            )
+            if output.debug:
+                print("[%s] pipe: %s" % (env.host_string, wrapped_command))
+            elif output.running:
+                print("[%s] pipe: %s" % (env.host_string, src_command))
+            channel = default_channel()
+            channel.set_combine_stderr(False)
+            channel.exec_command(command=wrapped_command)
+            # Constructed here so its output prefix names the source host.
+            stderr_buf = []
+            err_looper = OutputLooper(channel, 'recv_stderr', sys.stderr,
+                stderr_buf, env.command_timeout if timeout is None else timeout)
+
+        chunk_size = 32768
+        chunks = Queue.Queue(maxsize=max(1, max_buffer // chunk_size))
+        stop = threading.Event()
+        eof = threading.Event()
+
+        def enqueue(chunk):
+            while not stop.isSet():
+                try:
+                    chunks.put(chunk, timeout=ssh.io_sleep)
+                    return
+                except Queue.Full:
+                    pass
+
+        transferred = [0]
+
+        def dequeue():
+            while True:
+                try:
+                    chunk = chunks.get(timeout=ssh.io_sleep)
+                except Queue.Empty:
+                    # Surface source-side errors in the consuming thread.
+                    out_worker.raise_if_needed()
+                    continue
+                if not chunk:
+                    eof.set()
+                    return
+                transferred[0] += len(chunk)
+                yield chunk
+
+        out_worker = ThreadHandler('pipe', pump_loop, channel.recv,
+            enqueue, stop, chunk_size)
+        err_worker = ThreadHandler('pipe-err', err_looper.loop)
+        start = time.time()
+        try:
+            with settings(host_string=dst_host):
+                result = _run_command(dst_command, stdin=dequeue(),
+                    timeout=timeout)
+        finally:
+            stop.set()
+            # A destination which quit early leaves the source with nowhere
+            # to write to; don't wait around for it.
+            if not eof.isSet():
+                channel.close()
+            for worker in (out_worker, err_worker):
+                worker.thread.join()
+        elapsed = time.time() - start
+        src_status = None
+        if eof.isSet():
+            src_status = channel.recv_exit_status()
+            channel.close()
+        for worker in (out_worker, err_worker):
+            worker.raise_if_needed()
+
+        result.bytes = transferred[0]
+        result.elapsed = elapsed
+        result.throughput = transferred[0] / elapsed if elapsed else 0.0
+        result.src_return_code = src_status
+        result.src_stderr = _AttributeString(''.join(stderr_buf).strip())
+        if output.running:
+            print("[%s] pipe: %.1f MB from %s in %.2fs (%.2f MB/s)" % (
+                dst_host, result.bytes / 1048576.0, src_host, elapsed,
+                result.throughput / 1048576.0
+            ))
+        if src_status is not None and src_status not in env.ok_ret_codes:
+            result.failed = True
+            result.succeeded = False
+            msg = "pipe() source received nonzero return code %s" % src_status
+            msg += " while executing '%s' on %s!" % (src_command, src_host)
+            error(message=msg, stderr=result.src_stderr)
+        return result
+
+
+def local(command, capture=False, shell=None, stream=False):
     """
     Run a command on the local system.
 
@@ -1110,10 +2581,10 @@ def local(command, capture=False, shell=None):
     linked documentation, on Unix the default behavior is to use ``/bin/sh``,
     so this option is useful for setting that value to e.g.  ``/bin/bash``.
 
-    `local` is not currently capable of simultaneously printing and
-    capturing output, as `~fabric.operations.run`/`~fabric.operations.sudo`
-    do. The ``capture`` kwarg allows you to switch between printing and
-    capturing as necessary, and defaults to ``False``.
+    By default, `local` doesn't simultaneously print and capture output, as
+    `~fabric.operations.run`/`~fabric.operations.sudo` do. The ``capture``
+    kwarg allows you to switch between printing and capturing as necessary,
+    and defaults to ``False``.
 
     When ``capture=False``, the local subprocess' stdout and stderr streams are
     hooked up directly to your terminal, though you may use the global
@@ -1123,32 +2594,53 @@ def local(command, capture=False, shell=None):
 
     When ``capture=True``, you will not see any output from the subprocess in
     your terminal, but the return value will contain the captured
-    stdout/stderr.
+    stdout/stderr -- unless ``stream=True`` is also given, in which case
+    output is both captured and printed, line by line and prefixed like that
+    of `~fabric.operations.run` (e.g. ``[localhost] out:``).
 
     In either case, as with `~fabric.operations.run` and
     `~fabric.operations.sudo`, this return value exhibits the ``return_code``,
     ``stderr``, ``failed`` and ``succeeded`` attributes. See `run` for details.
+    Its ``elapsed`` attribute holds the command's wall-clock run time, in
+    seconds.
 
     `~fabric.operations.local` will honor the `~fabric.context_managers.lcd`
     context manager, allowing you to control its current working directory
     independently of the remote end (which honors
     `~fabric.context_managers.cd`).
 
+    .. seealso:: `local_many`, for running several commands at once.
+
     .. versionchanged:: 1.0
         Added the ``succeeded`` and ``stderr`` attributes.
     .. versionchanged:: 1.0
         Now honors the `~fabric.context_managers.lcd` context manager.
     .. versionchanged:: 1.0
         Changed the default value of ``capture`` from ``True`` to ``False``.
+    .. versionchanged:: 1.8
+        Added the ``stream`` argument and the ``elapsed`` attribute.
+    """
+    out = _local(command, capture, shell, stream)
+    if out.failed:
+        error(message=_local_error(out), stdout=out, stderr=out.stderr)
+    return out
+
+
+def _local(command, capture, shell, stream, name='localhost'):
+    """
+    Run ``command`` locally and return its result, without checking it.
+
+    ``name`` is shown in place of a host string in output prefixes. Safe to
+    call from several threads at once.
     """
     given_command = command
     # Apply cd(), path() etc
     with_env = _prefix_env_vars(command, local=True)
     wrapped_command = _prefix_commands(with_env, 'local')
     if output.debug:
-        print("[localhost] local: %s" % (wrapped_command))
+        print("[%s] local: %s" % (name, wrapped_command))
     elif output.running:
-        print("[localhost] local: " + given_command)
+        print("[%s] local: %s" % (name, given_command))
     # Tie in to global output controls as best we can; our capture argument
     # takes precedence over the output settings.
     dev_null = None
@@ -1160,6 +2652,7 @@ def local(command, capture=False, shell=None):
         # Non-captured, hidden streams are discarded.
         out_stream = None if output.stdout else dev_null
         err_stream = None if output.stderr else dev_null
+    start = time.time()
     try:
         cmd_arg = wrapped_command if win32 else [wrapped_command]
         if shell is not None:
@@ -1168,25 +2661,130 @@ def local(command, capture=False, shell=None):
         else:
             p = subprocess.Popen(cmd_arg, shell=True, stdout=out_stream,
                                  stderr=err_stream)
-        (stdout, stderr) = p.communicate()
+        if capture and stream:
+            (stdout, stderr) = _tee(p, name)
+        else:
+            (stdout, stderr) = p.communicate()
     finally:
         if dev_null is not None:
             dev_null.close()
     # Handle error condition (deal with stdout being None, too)
     out = _AttributeString(stdout.strip() if stdout else "")
     err = _AttributeString(stderr.strip() if stderr else "")
-    out.failed = False
+    out.command = given_command
     out.return_code = p.returncode
     out.stderr = err
-    if p.returncode not in env.ok_ret_codes:
-        out.failed = True
-        msg = "local() encountered an error (return code %s) while executing '%s'" % (p.returncode, command)
-        error(message=msg, stdout=out, stderr=err)
+    out.elapsed = time.time() - start
+    out.failed = p.returncode not in env.ok_ret_codes
     out.succeeded = not out.failed
-    # If we were capturing, this will be a string; otherwise it will be None.
+    # If we were capturing, this will be a string; otherwise it will be empty.
     return out
 
 
+def _tee(process, name):
+    """
+    Capture ``process``' stdout and stderr while printing them line by line.
+    """
+    streams = (
+        (process.stdout, sys.stdout if output.stdout else None, 'out'),
+        (process.stderr, sys.stderr if output.stderr else None, 'err'),
+    )
+    captured = []
+    workers = []
+    for source, stream, label in streams:
+        capture = []
+        prefix = "[%s] %s: " % (name, label) if env.output_prefix else ""
+        captured.append(capture)
+        workers.append(ThreadHandler(label, tee_loop, source, capture,
+            stream, prefix))
+    for worker in workers:
+        worker.thread.join()
+        worker.raise_if_needed()
+    process.wait()
+    return ["".join(capture) for capture in captured]
+
+
+def _local_error(out):
+    return "local() encountered an error (return code %s) while executing " \
+        "'%s'" % (out.return_code, out.command)
+
+
+def local_many(commands, max_workers=None, capture=True, stream=True,
+    shell=None):
+    """
+    Run several local commands at once, returning their results.
+
+    ``commands`` is a list of command strings, or a dict mapping names to
+    command strings; the return value is a list (in the same order) or dict
+    (with the same keys) of results, as returned by `local`. At most
+    ``max_workers`` commands (by default, the number of local CPUs) run at a
+    time.
+
+    ``capture``, ``stream`` and ``shell`` are handed to `local`, so by default
+    output is both printed and captured. Printed lines are prefixed with the
+    command's name (or its position in the list) rather than ``localhost``,
+    and are never mixed up with those of other commands. For example::
+
+        results = local_many({
+            'css': "make css",
+            'js': "make js",
+            'docs': "make -C docs html",
+        }, max_workers=2)
+        print("Docs took %.1fs" % results['docs'].elapsed)
+
+    All commands are run, even if some fail; failures are then reported
+    together, as a single error which respects ``warn_only``.
+
+    .. versionadded:: 1.8
+    """
+    if isinstance(commands, dict):
+        names = commands.keys()
+    else:
+        names = range(len(commands))
+    if not names:
+        return {} if isinstance(commands, dict) else []
+    if max_workers is None:
+        try:
+            import multiprocessing
+            max_workers = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            max_workers = 1
+    todo = Queue.Queue()
+    for name in names:
+        todo.put(name)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                name = todo.get_nowait()
+            except Queue.Empty:
+                return
+            label = name if isinstance(commands, dict) else \
+                "localhost:%d" % (name + 1)
+            results[name] = _local(commands[name], capture, shell, stream,
+                str(label))
+
+    workers = [
+        ThreadHandler('local-%d' % i, worker)
+        for i in range(min(max_workers, len(names)))
+    ]
+    for handler in workers:
+        handler.thread.join()
+        handler.raise_if_needed()
+
+    failed = [results[name] for name in names if results[name].failed]
+    if failed:
+        msg = "local_many() encountered errors in %d of %d commands:\n\n%s" % (
+            len(failed), len(names),
+            "\n".join("    " + _local_error(out) for out in failed)
+        )
+        error(message=msg)
+    if isinstance(commands, dict):
+        return results
+    return [results[name] for name in names]
+
+
 @needs_host
 def reboot(wait=120):
     """
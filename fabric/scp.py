@@ -0,0 +1,559 @@
+"""
+File transfers over the SCP protocol, for hosts without an SFTP subsystem.
+
+Instead of an SFTP session, each transfer runs ``scp`` on the remote end over
+an exec channel: ``scp -t`` to receive files (see `Sink`) and ``scp -f`` to
+send them (see `download`). Fabric speaks the other end of the protocol
+itself, so no local ``scp`` is needed. Each file is announced by a one-line
+record (``C<mode> <size> <name>``; ``D`` and ``E`` enter and leave
+directories, ``T`` sets modification times) followed by its data, and each
+record is acknowledged by the other end with a null byte, or an error
+message. Any number of files thus go over one channel, with one round trip
+apiece and none to open, stat or close them.
+
+Selected by :ref:`env.transfer_backend <transfer-backend>`, or the
+``backend`` argument of `~fabric.operations.put` and `~fabric.operations.get`,
+which then transfer files through an `SCP` object.
+"""
+
+from __future__ import with_statement
+
+import os
+import posixpath
+import re
+import shutil
+import socket
+from contextlib import closing
+from StringIO import StringIO
+
+from fabric.sftp import (SFTP, HashedFile, finalize_script, requested_mode,
+    run_finalize_script, staged_path, _format_local)
+from fabric.state import connections, env, output
+from fabric.tarstream import remote_path
+
+
+def glob_path(path):
+    """
+    Quote remote ``path`` for the shell, leaving glob characters, and a
+    leading ``~``, for the remote shell to expand.
+    """
+    prefix = ''
+    if path == '~' or path.startswith('~/'):
+        prefix, path = '~', path[1:]
+    def quote(match):
+        char = match.group(0)
+        return "'\n'" if char == '\n' else '\\' + char
+    return prefix + re.sub(r'[^\w/.*?\[\]~+,:@%-]', quote, path)
+
+
+def _target(path):
+    # Keep remote scp from taking a path for an option
+    return './' + path if path.startswith('-') else path
+
+
+def sink_command(target, preserve=False, probe=None, create=False):
+    """
+    Return the remote command receiving files into ``target``.
+
+    Before running ``scp -t``, it prints the remote home directory on a line
+    of its own, then ``d`` or ``f``: whether ``probe`` (by default,
+    ``target`` itself) is an existing directory. With ``create``,
+    ``target`` is created first, as a directory. With ``preserve``, ``scp``
+    applies the permissions records carry as they are, instead of masking
+    them with its umask (and leaving those of existing files alone.)
+    """
+    return "printf '%%s\\n' \"$HOME\"; if [ -d %s ]; then printf d; " \
+        "else printf f; fi; %sexec scp -r%s -t %s" % (
+            remote_path(_target(probe or target)),
+            "mkdir -p %s && " % remote_path(target) if create else "",
+            "p" if preserve else "", remote_path(_target(target))
+        )
+
+
+def source_command(path):
+    """
+    Return the remote command sending ``path`` (a file, directory or glob.)
+    """
+    return "scp -r -f %s" % glob_path(_target(path))
+
+
+def _check_name(name):
+    if not name or '/' in name or '\n' in name or name in ('.', '..'):
+        raise IOError("Refusing to transfer %r over scp" % name)
+
+
+class _Connection(object):
+    """
+    One end of an SCP exchange over ``channel``, running ``command``.
+    """
+    def __init__(self, transport, command):
+        # Records are small and each waits for an answer; don't let Nagle's
+        # algorithm hold them back.
+        try:
+            transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                1)
+        except (AttributeError, socket.error):
+            pass
+        self.channel = transport.open_session()
+        self.channel.exec_command(command)
+        self.stdout = self.channel.makefile('rb')
+        # Whether the other end reported errors about single records
+        self.refused = False
+
+    def fail(self):
+        stderr = self.channel.makefile_stderr('rb').read().strip()
+        raise IOError("remote scp exited with status %s%s" % (
+            self.channel.recv_exit_status(), ": " + stderr if stderr else ""
+        ))
+
+    def read(self, size):
+        data = self.stdout.read(size)
+        if len(data) != size:
+            self.fail()
+        return data
+
+    def line(self):
+        line = self.stdout.readline()
+        if not line.endswith('\n'):
+            self.fail()
+        return line[:-1]
+
+    def response(self):
+        """
+        Return None once the other end acknowledges the last record, or its
+        message if it reports an error about that record. Raises
+        ``IOError`` for fatal errors.
+        """
+        code = self.read(1)
+        if code == '\0':
+            return None
+        message = self.line()
+        if code == '\1':
+            self.refused = True
+            return message
+        raise IOError(message if code == '\2' else code + message)
+
+    def record(self, line):
+        self.channel.sendall(line)
+        return self.response()
+
+    def close(self):
+        self.channel.close()
+
+
+class Sink(_Connection):
+    """
+    A remote ``scp -t`` (see `sink_command`) receiving files.
+
+    ``home`` is the remote home directory, where relative paths start from,
+    and ``is_dir`` tells whether the probed path is an existing directory.
+    Methods sending files or directories return None, or the remote end's
+    message if it refused them; fatal errors raise ``IOError``.
+
+    Given a ``hashlib`` ``algorithm``, `send_tree` hashes files as it sends
+    them, and records their hex digests in ``digests``, keyed by the paths
+    it returns.
+    """
+    def __init__(self, transport, command, algorithm=None):
+        super(Sink, self).__init__(transport, command)
+        self.algorithm = algorithm
+        self.digests = {}
+        self.home = self.line()
+        self.is_dir = self.read(1) == 'd'
+        error = self.response()
+        if error:
+            raise IOError(error)
+
+    def send_file(self, fd, size, name, mode):
+        """
+        Send ``size`` bytes of file object ``fd`` as ``name``, with
+        permissions ``mode``.
+        """
+        _check_name(name)
+        error = self.record("C%04o %d %s\n" % (mode & 07777, size, name))
+        if error:
+            return error
+        remaining = size
+        while remaining:
+            block = fd.read(min(32768, remaining))
+            if not block:
+                raise IOError("%s changed size while being sent" % name)
+            remaining -= len(block)
+            # The null byte ending the file goes along with its last block
+            self.channel.sendall(block if remaining else block + '\0')
+        if not size:
+            self.channel.sendall('\0')
+        return self.response()
+
+    def send_tree(self, local_path, name, mode_for, prefix=''):
+        """
+        Send local directory ``local_path`` as ``name``, recursively.
+
+        ``mode_for(path)`` returns the permissions to give each file and
+        directory (``path`` being local.) Returns the paths (relative to the
+        receiving directory) of the files sent, and ``(path, message)``
+        tuples for those refused.
+        """
+        path = posixpath.join(prefix, name)
+        _check_name(name)
+        error = self.record("D%04o 0 %s\n" % (mode_for(local_path) & 07777,
+            name))
+        if error:
+            return [], [(path, error)]
+        sent, failed = [], []
+        for entry in sorted(os.listdir(local_path)):
+            child = os.path.join(local_path, entry)
+            if os.path.isdir(child):
+                more, errors = self.send_tree(child, entry, mode_for, path)
+                sent.extend(more)
+                failed.extend(errors)
+                continue
+            with open(child, 'rb') as fd:
+                if self.algorithm:
+                    fd = HashedFile(fd, self.algorithm)
+                error = self.send_file(fd, os.fstat(fd.fileno()).st_size,
+                    entry, mode_for(child))
+            if error:
+                failed.append((posixpath.join(path, entry), error))
+            else:
+                sent.append(posixpath.join(path, entry))
+                if self.algorithm:
+                    self.digests[sent[-1]] = fd.hexdigest()
+        error = self.record("E\n")
+        if error:
+            failed.append((path, error))
+        return sent, failed
+
+    def finish(self):
+        """
+        Tell the remote end there's nothing more to send, and wait for it.
+
+        Raises ``IOError`` if it then fails, unless that's only for files it
+        refused (whose reasons were returned already.)
+        """
+        self.channel.shutdown_write()
+        if self.channel.recv_exit_status() != 0 and not self.refused:
+            self.fail()
+        self.close()
+
+
+class _Limited(object):
+    """
+    The next ``size`` bytes ``connection`` receives, as a file-like object.
+    """
+    def __init__(self, connection, size):
+        self.connection = connection
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        data = self.connection.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        while self.read(32768):
+            pass
+
+
+def download(transport, path):
+    """
+    Yield the files a remote ``scp -f`` sends for ``path`` as they arrive.
+
+    ``path`` may be a file, a directory (sent recursively) or a glob. Each
+    file is a ``(name, fd)`` tuple, where ``name`` is the file's name,
+    prefixed with those of the directories it's in, and ``fd`` a file object
+    to read it from, valid until the next file is yielded. Errors about
+    single files (e.g. one which can't be read) don't keep the others from
+    arriving, and are raised together, as an ``IOError``, at the end.
+    """
+    connection = _Connection(transport, source_command(path))
+    errors = []
+    directories = []
+    try:
+        connection.channel.sendall('\0')
+        while True:
+            code = connection.stdout.read(1)
+            if not code:
+                break
+            line = connection.line()
+            if code in '\1\2':
+                errors.append(line)
+                if code == '\2':
+                    break
+                continue
+            if code == 'C':
+                mode, size, name = line.split(' ', 2)
+                _check_name(name)
+                connection.channel.sendall('\0')
+                fd = _Limited(connection, int(size))
+                yield posixpath.join(*(directories + [name])), fd
+                fd.drain()
+                error = connection.response()
+                if error:
+                    errors.append(error)
+            elif code == 'D':
+                name = line.split(' ', 2)[2]
+                _check_name(name)
+                directories.append(name)
+            elif code == 'E':
+                directories.pop()
+            elif code != 'T':
+                raise IOError("Unexpected scp record %r" % (code + line))
+            connection.channel.sendall('\0')
+        if connection.channel.recv_exit_status() != 0 and not errors:
+            connection.fail()
+    finally:
+        connection.close()
+    if errors:
+        raise IOError("; ".join(errors))
+
+
+class SCP(object):
+    """
+    The SCP counterpart of `fabric.sftp.SFTP`, through which
+    `~fabric.operations.put` and `~fabric.operations.get` transfer files with
+    ``host_string``.
+
+    An upload goes over a single `Sink`: `start_put` starts it, `put` sends
+    each local path given to `~fabric.operations.put`, and `finish_put` ends
+    it. Remote paths are resolved as over SFTP, except that relative ones
+    are left for the remote ``scp`` to find in the home directory.
+
+    As on `SFTP` objects, ``verify`` names the ``hashlib`` algorithm files
+    are hashed with on their way through, if any, and ``hashed`` collects
+    their ``(local_path, remote_path, hex digest)``; ``failed`` holds the
+    ``(local_path, remote_path, reason)`` of files the remote end refused,
+    or sudo couldn't move into place.
+    """
+    def __init__(self, host_string):
+        self.host_string = host_string
+        self.transport = connections[host_string].get_transport()
+        self.verify = None
+        self.hashed = []
+        self.failed = []
+        self.sink = None
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+
+    def start_put(self, names, local_is_path, remote_path, use_sudo,
+        mirror_local_mode, mode, temp_dir):
+        """
+        Start the remote ``scp`` receiving ``names`` (local paths as found by
+        `~fabric.operations.put`, or one file object) into ``remote_path``.
+        """
+        # Empty remote path implies the home directory, where scp starts out
+        remote_path = remote_path or '~'
+        # Honor cd() (assumes Unix style file paths on remote end)
+        if not (posixpath.isabs(remote_path) or remote_path.startswith('~')) \
+            and env.get('cwd'):
+            remote_path = env.cwd.rstrip('/') + '/' + remote_path
+        self.local_is_path = local_is_path
+        self.use_sudo = use_sudo
+        self.mirror_local_mode = mirror_local_mode and local_is_path
+        self.mode = mode
+        self.trees = [lpath for lpath in names
+            if local_is_path and os.path.isdir(lpath)]
+        # Have scp apply modes as sent, instead of masking them with its umask
+        self.preserve = self.mirror_local_mode or mode is not None
+        # (local file, remote file, digest) of files staged for sudo, the
+        # moves finalizing them, and directories those need
+        self.staged = []
+        self.moves = []
+        self.directories = []
+        if use_sudo:
+            # Files go to one staging directory, to be moved into place (and
+            # their directories created) by a single sudo call at the end.
+            self.staging = staged_path(temp_dir, remote_path) + '.fabric-put'
+            self.sink = Sink(self.transport, sink_command(self.staging,
+                probe=remote_path, create=True), self.verify)
+        else:
+            self.sink = Sink(self.transport, sink_command(remote_path,
+                self.preserve, create=bool(self.trees)), self.verify)
+        # Relative to the remote home directory, as remote_path is
+        if remote_path == '~' or remote_path.startswith('~/'):
+            self.target = self.sink.home + remote_path[1:]
+        else:
+            self.target = posixpath.join(self.sink.home, remote_path)
+        self.into = self.sink.is_dir or bool(self.trees)
+        if len(names) > 1 and not self.into:
+            raise ValueError("'%s' is not a directory" % remote_path)
+        if self.into and not local_is_path:
+            raise ValueError("'%s' is a directory" % remote_path)
+
+    def _mode_for(self, lpath):
+        lmode = requested_mode(lpath, self.mirror_local_mode, self.mode)
+        if self.local_is_path and os.path.isdir(lpath):
+            # mode only applies to files
+            if self.mirror_local_mode:
+                return lmode
+            return 0755 if self.preserve else 0777
+        return 0666 if lmode is None else lmode
+
+    def _send(self, lpath, name, lmode):
+        """
+        Send ``lpath`` as ``name``. Returns the remote end's reason for
+        refusing it, if any, and its hex digest, if verifying.
+        """
+        if self.local_is_path:
+            with open(lpath, 'rb') as fd:
+                size = os.fstat(fd.fileno()).st_size
+                if self.verify:
+                    fd = HashedFile(fd, self.verify)
+                reason = self.sink.send_file(fd, size, name, lmode)
+        else:
+            # Send the whole file-like object, then restore its seek pointer
+            old_pointer = lpath.tell()
+            lpath.seek(0, os.SEEK_END)
+            size = lpath.tell()
+            lpath.seek(0)
+            fd = HashedFile(lpath, self.verify) if self.verify else lpath
+            try:
+                reason = self.sink.send_file(fd, size, name, lmode)
+            finally:
+                lpath.seek(old_pointer)
+        return reason, fd.hexdigest() if self.verify else None
+
+    def put(self, lpath):
+        """
+        Send ``lpath``, one of the names given to `start_put`, and return the
+        remote paths of the files uploaded. Files sent with sudo are only
+        staged; `finish_put` returns them once they're in place.
+        """
+        if lpath in self.trees:
+            top = os.path.basename(lpath.rstrip(os.sep))
+            rtop = posixpath.join(self.target, top)
+            files = []
+            for context, dirs, fnames in os.walk(lpath):
+                relative = context[len(lpath):].strip(os.sep)
+                rcontext = posixpath.join(rtop,
+                    relative.replace(os.sep, '/')).rstrip('/')
+                self.directories.append(rcontext)
+                files.extend((os.path.join(context, f),
+                    posixpath.join(rcontext, f)) for f in fnames)
+        elif self.into:
+            rtop = posixpath.join(self.target, os.path.basename(lpath))
+            files = [(lpath, rtop)]
+        else:
+            rtop = self.target
+            files = [(lpath, rtop)]
+        if output.running:
+            print("[%s] put: %s -> %s" % (self.host_string,
+                _format_local(lpath, self.local_is_path), rtop))
+
+        remote_paths = []
+        if lpath in self.trees and not self.use_sudo:
+            sent, refused = self.sink.send_tree(lpath, top, self._mode_for)
+            parent = os.path.dirname(lpath.rstrip(os.sep))
+            local = lambda path: os.path.join(parent, *path.split('/'))
+            for path in sent:
+                rpath = posixpath.join(self.target, path)
+                remote_paths.append(rpath)
+                if self.verify:
+                    self.hashed.append((local(path), rpath,
+                        self.sink.digests[path]))
+            self.failed.extend((local(path), posixpath.join(self.target,
+                path), reason) for path, reason in refused)
+            return remote_paths
+        for source, rpath in files:
+            if self.use_sudo:
+                name = posixpath.basename(staged_path(self.staging, rpath))
+                lmode = 0666
+            else:
+                name = posixpath.basename(rpath)
+                lmode = self._mode_for(source)
+            reason, digest = self._send(source, name, lmode)
+            if reason:
+                self.failed.append((source, rpath, reason))
+            elif self.use_sudo:
+                self.staged.append((source, rpath, digest))
+                self.moves.append((staged_path(self.staging, rpath), rpath,
+                    requested_mode(source, self.mirror_local_mode,
+                    self.mode)))
+            else:
+                remote_paths.append(rpath)
+                self.hashed.append((source, rpath, digest))
+        return remote_paths
+
+    def finish_put(self):
+        """
+        End the upload `start_put` started. With sudo, moves the staged files
+        into place, and returns the remote paths of those which made it.
+        """
+        if not self.use_sudo:
+            self.sink.finish()
+            return []
+        if self.trees:
+            self.directories.insert(0, self.target)
+        script = finalize_script(self.staging, self.directories, self.moves)
+        reason = self.sink.send_file(StringIO(script), len(script),
+            'finalize.sh', 0600)
+        if reason:
+            raise IOError(reason)
+        self.sink.finish()
+        failures = run_finalize_script(self.staging)
+        remote_paths = []
+        for index, (source, rpath, digest) in enumerate(self.staged):
+            if index in failures:
+                self.failed.append((source, rpath, failures[index]))
+            else:
+                remote_paths.append(rpath)
+                self.hashed.append((source, rpath, digest))
+        return remote_paths
+
+    def get(self, remote_path, local_path, local_is_path, local_files):
+        """
+        Download ``remote_path`` (a file, directory or glob), laid out
+        locally as `SFTP.get`/`SFTP.get_dir` would, appending the local
+        paths written (or, for a file object, the remote names read) to
+        ``local_files`` as they arrive.
+        """
+        if local_is_path:
+            local_path = os.path.expanduser(local_path)
+        # Honor cd() (assumes Unix style file paths on remote end); other
+        # relative paths are left for the remote scp to find in the home
+        # directory.
+        if not (posixpath.isabs(remote_path) or remote_path.startswith('~')) \
+            and env.get('cwd'):
+            remote_path = env.cwd.rstrip('/').replace('\\ ', ' ') + '/' \
+                + remote_path
+        parent = posixpath.dirname(remote_path.rstrip('/'))
+
+        def receive(rremote, fd, out, lpath):
+            out = HashedFile(out, self.verify) if self.verify else out
+            shutil.copyfileobj(fd, out)
+            if self.verify:
+                # The remote shell, running in the home directory, hashes them
+                rpath = posixpath.join(parent, rremote)
+                if rpath.startswith('~/'):
+                    rpath = rpath[2:]
+                self.hashed.append((lpath, rpath, out.hexdigest()))
+
+        with closing(download(self.transport, remote_path)) as downloads:
+            for rremote, fd in downloads:
+                if not local_is_path:
+                    if local_files or '/' in rremote:
+                        raise ValueError("%s is a glob or directory, but "
+                            "local_path is a file object!" % remote_path)
+                    SFTP.announce_download(local_path, False,
+                        posixpath.join(parent, rremote))
+                    local_path.seek(0)
+                    receive(rremote, fd, local_path, local_path)
+                    local_files.append(rremote)
+                    continue
+                # Files within directories are laid out as by get_dir()
+                lpath = local_path
+                if '/' in rremote and "%(path)s" not in local_path \
+                    and "%(dirname)s" not in local_path:
+                    lpath = os.path.join(local_path, *rremote.split('/'))
+                lpath = SFTP.local_target(lpath, rremote)
+                SFTP.announce_download(lpath, True,
+                    posixpath.join(parent, rremote))
+                with open(lpath, 'wb') as out:
+                    receive(rremote, fd, out, lpath)
+                local_files.append(lpath)
@@ -1,17 +1,34 @@
 from __future__ import with_statement
 
+import errno
 import hashlib
 import os
 import posixpath
 import stat
+import sys
 import re
+import shutil
+import socket
+import threading
 from fnmatch import filter as fnfilter
+from StringIO import StringIO
+from Queue import Queue, Empty
 
+from fabric import tarstream
+from fabric.delta import block_size_for, encode, helper_command, \
+    instructions, parse_signature
+from fabric.network import ssh
 from fabric.state import output, connections, env
-from fabric.utils import warn
+from fabric.thread_handling import ThreadHandler
+from fabric.utils import shell_quote, warn
 from fabric.context_managers import settings
 
 
+# Transfers may run in several threads at once; keeps their printed lines and
+# sudo() calls (which go through the global env) from interfering.
+_lock = threading.RLock()
+
+
 def _format_local(local_path, local_is_path):
     """Format a path for log output"""
     if local_is_path:
@@ -22,18 +39,380 @@ def _format_local(local_path, local_is_path):
         return getattr(local_path, 'name', '<file obj>')
 
 
+def _local_hash(path, length=None):
+    """
+    Return the SHA1 hex digest of the file at ``path``, or of its first
+    ``length`` bytes.
+    """
+    hasher = hashlib.sha1()
+    remaining = length
+    with open(path, 'rb') as fd:
+        while remaining is None or remaining > 0:
+            block = fd.read(65536 if remaining is None
+                else min(65536, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return hasher.hexdigest()
+
+
+# Algorithms put() and get() can verify transfers with, as they're named by
+# hashlib and by the coreutils command hashing files with them
+VERIFY_ALGORITHMS = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+
+
+class HashedFile(object):
+    """
+    File object ``fd``, hashing the data read from or written to it with
+    ``hashlib`` algorithm ``algorithm`` on the way.
+    """
+    def __init__(self, fd, algorithm):
+        self.fd = fd
+        self.hasher = hashlib.new(algorithm)
+
+    def __getattr__(self, attr):
+        return getattr(self.fd, attr)
+
+    def read(self, *args):
+        data = self.fd.read(*args)
+        self.hasher.update(data)
+        return data
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.fd.write(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+# Errors meaning the connection went away, after which resumable transfers
+# reconnect and carry on.
+_dropped = (socket.error, EOFError, ssh.SSHException)
+
+# Suffix of the files resumable transfers write to until they're complete
+PARTIAL = '.fabric-partial'
+
+
+def open_sftp(client):
+    """
+    Open an SFTP session over connected ``SSHClient`` ``client``.
+
+    The session's channel uses :ref:`env.sftp_window_size
+    <sftp-window-size>` and :ref:`env.sftp_max_packet_size
+    <sftp-max-packet-size>`, where set.
+    """
+    window, packet = env.sftp_window_size, env.sftp_max_packet_size
+    if window or packet:
+        try:
+            return ssh.SFTPClient.from_transport(client.get_transport(),
+                window_size=window or None, max_packet_size=packet or None)
+        except TypeError:
+            # Paramiko before 1.15 can't size SFTP channels
+            pass
+    return client.open_sftp()
+
+
+class SessionCache(object):
+    """
+    Idle SFTP sessions, and remote home directories, per connection.
+
+    `SFTP` objects take their session from here, and hand it back when
+    closed, so that consecutive `~fabric.operations.put` and
+    `~fabric.operations.get` calls don't each pay for starting the SFTP
+    subsystem and finding the remote home directory.
+
+    Entries are keyed by the connection's ``SSHClient`` object, so nothing
+    opened over a connection which has since been replaced (e.g. after it
+    dropped) is handed out again, and they're discarded once that
+    connection's transport is no longer active. A session is only used by
+    one `SFTP` object at a time: `acquire` opens a new one when all of a
+    connection's sessions are in use.
+    """
+    def __init__(self):
+        self.idle = {}
+        self.homes = {}
+        self.lock = threading.Lock()
+
+    def _key(self, client):
+        # Sessions opened with other channel settings can't be reused.
+        return (client, env.sftp_window_size, env.sftp_max_packet_size)
+
+    def _prune(self):
+        for key in self.idle.keys():
+            if not _active(key[0]):
+                for ftp in self.idle.pop(key):
+                    _close_quietly(ftp)
+        for client in self.homes.keys():
+            if not _active(client):
+                del self.homes[client]
+
+    def acquire(self, client):
+        """
+        Return an SFTP session over ``client`` for the caller's sole use.
+        """
+        with self.lock:
+            self._prune()
+            sessions = self.idle.get(self._key(client))
+            if sessions:
+                return sessions.pop()
+        return open_sftp(client)
+
+    def release(self, client, ftp):
+        """
+        Make ``ftp``, a session acquired over ``client``, available again.
+        """
+        # Undo any chdir(); this makes no request.
+        ftp.chdir(None)
+        if _active(client) and not ftp.sock.closed:
+            with self.lock:
+                self.idle.setdefault(self._key(client), []).append(ftp)
+        else:
+            _close_quietly(ftp)
+
+    def home(self, client, ftp):
+        """
+        Return the remote home directory of ``client``'s user, asking
+        session ``ftp`` the first time.
+        """
+        with self.lock:
+            home = self.homes.get(client)
+        if home is None:
+            home = ftp.normalize('.')
+            with self.lock:
+                self.homes[client] = home
+        return home
+
+    def clear(self):
+        """
+        Close all idle sessions and forget all home directories.
+        """
+        with self.lock:
+            for sessions in self.idle.values():
+                for ftp in sessions:
+                    _close_quietly(ftp)
+            self.idle.clear()
+            self.homes.clear()
+
+
+def _active(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+def _close_quietly(ftp):
+    try:
+        ftp.close()
+    except Exception:
+        pass
+
+
+sessions = SessionCache()
+
+
+# Moves a staged file into place (see finalize_script), reporting failures
+_MOVE = r"""fabric_move() {
+    e=$({ [ -z "$4" ] || chmod -- "$4" "$2"; } 2>&1 &&
+        mv -f -- "$2" "$3" 2>&1) && return
+    status=1
+    printf 'failed %s %s\n' "$1" "$(printf %s "$e" | tr '\n' ' ')"
+}
+status=0
+"""
+
+
+def finalize_script(staging, directories, moves):
+    """
+    Return a shell script moving files uploaded to ``staging`` into place.
+
+    It creates ``directories`` (with ``mkdir -p``), then carries out each of
+    ``moves``, ``(staged_path, remote_path, mode)`` tuples, with ``chmod``
+    (unless ``mode`` is None) and ``mv``. For each move that fails, it
+    prints ``failed <index> <reason>``, and leaves the staged file where it
+    is; ``staging`` is removed if nothing is left in it. See
+    `parse_failures`.
+    """
+    lines = [_MOVE]
+    for i in range(0, len(directories), 200):
+        lines.append("mkdir -p -- %s\n" % " ".join(
+            shell_quote(path) for path in directories[i:i + 200]
+        ))
+    for index, (staged, remote_path, mode) in enumerate(moves):
+        lines.append("fabric_move %d %s %s %s\n" % (index,
+            shell_quote(staged), shell_quote(remote_path),
+            "" if mode is None else "%o" % mode))
+    lines.append("rm -f -- %s\nrmdir -- %s 2>/dev/null\nexit $status\n" % (
+        shell_quote(posixpath.join(staging, 'finalize.sh')),
+        shell_quote(staging)))
+    return "".join(lines)
+
+
+def run_finalize_script(staging):
+    """
+    Run the `finalize_script` script uploaded to ``staging`` (as
+    ``finalize.sh``) with sudo, and return its `parse_failures` results.
+
+    Raises ``IOError`` if the script failed as a whole.
+    """
+    from fabric.api import sudo, hide
+    with _lock:
+        with settings(hide('everything'), cwd="", warn_only=True):
+            result = sudo("sh %s" % shell_quote(
+                posixpath.join(staging, 'finalize.sh')))
+    failures = parse_failures(result)
+    if result.failed and not failures:
+        raise IOError("Couldn't move files from %s into place: %s" % (
+            staging, result))
+    return failures
+
+
+def requested_mode(local_path, mirror_local_mode, mode):
+    """
+    Return the permissions `~fabric.operations.put` should give the upload
+    of ``local_path``, if any, given its ``mirror_local_mode`` and ``mode``
+    arguments.
+    """
+    if mirror_local_mode:
+        mode = os.stat(local_path).st_mode
+    # Cast to octal integer in case of string
+    if isinstance(mode, basestring):
+        mode = int(mode, 8)
+    return None if mode is None else mode & 07777
+
+
+def parse_failures(text):
+    """
+    Parse the output of a `finalize_script` script into a dict mapping the
+    indexes of failed moves to the reason.
+    """
+    failures = {}
+    for line in text.splitlines():
+        parts = line.split(' ', 2)
+        if len(parts) >= 2 and parts[0] == 'failed' and parts[1].isdigit():
+            failures[int(parts[1])] = (parts[2:] or ['failed'])[0].strip()
+    return failures
+
+
+def _tune(remote):
+    """
+    Apply :ref:`env.sftp_chunk_size <sftp-chunk-size>` to SFTP file
+    ``remote``, and return the number of requests allowed in flight.
+    """
+    if env.sftp_chunk_size:
+        remote.MAX_REQUEST_SIZE = int(env.sftp_chunk_size)
+    return max(int(env.sftp_max_requests or 1), 1)
+
+
+def send_file(remote, fd):
+    """
+    Write the rest of file object ``fd`` to SFTP file ``remote``, at the
+    latter's current position. Returns the number of bytes written.
+
+    Writes are pipelined: up to :ref:`env.sftp_max_requests
+    <sftp-max-requests>` of them, of :ref:`env.sftp_chunk_size
+    <sftp-chunk-size>` bytes each, go out before waiting for the server's
+    acknowledgements, so each round trip moves that many chunks instead of
+    one.
+    """
+    limit = _tune(remote)
+    sent = 0
+    for count, block in enumerate(
+        iter(lambda: fd.read(remote.MAX_REQUEST_SIZE), ''), 1):
+        # Paramiko itself only collects acknowledgements once over a hundred
+        # writes are pending, whatever they add up to; an unpipelined write
+        # makes it collect all of them.
+        remote.set_pipelined(count % limit != 0)
+        remote.write(block)
+        sent += len(block)
+    return sent
+
+
+def receive_file(remote, fd, offset, size):
+    """
+    Read SFTP file ``remote``, from ``offset`` up to ``size``, into file
+    object ``fd``. Returns the number of bytes read.
+
+    Reads are issued ahead of time, :ref:`env.sftp_max_requests
+    <sftp-max-requests>` chunks of :ref:`env.sftp_chunk_size
+    <sftp-chunk-size>` bytes at a time, so that at most that much of the file
+    is buffered in memory.
+    """
+    limit = _tune(remote)
+    received = 0
+    while offset < size:
+        batch = []
+        while offset < size and len(batch) < limit:
+            length = min(remote.MAX_REQUEST_SIZE, size - offset)
+            batch.append((offset, length))
+            offset += length
+        if limit > 1:
+            blocks = remote.readv(batch)
+        else:
+            remote.seek(batch[0][0])
+            blocks = [remote.read(batch[0][1])]
+        for block in blocks:
+            fd.write(block)
+            received += len(block)
+    return received
+
+
+def staged_path(directory, remote_path):
+    """
+    Return where in ``directory`` to upload ``remote_path`` for moving into
+    place with sudo.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(env.host_string)
+    hasher.update(remote_path)
+    return posixpath.join(directory, hasher.hexdigest())
+
+
 class SFTP(object):
     """
     SFTP helper class, which is also a facade for ssh.SFTPClient.
     """
-    def __init__(self, host_string):
-        self.ftp = connections[host_string].open_sftp()
+    def __init__(self, host_string, ftp=None):
+        self.host_string = host_string
+        self.client = connections[host_string]
+        # Whether self.ftp came from (and goes back to) the session cache
+        self.cached = ftp is None
+        self.ftp = ftp or sessions.acquire(self.client)
+        # Extra channels used by map(), kept open for reuse until close().
+        self.clients = []
+        # Remote paths left alone, or removed, by put(sync=True) calls.
+        self.skipped = []
+        self.deleted = []
+        # (local_path, remote_path, reason) of files put_dir couldn't move
+        # into place with sudo.
+        self.failed = []
+        # With verify set to one of VERIFY_ALGORITHMS, the (local_path,
+        # remote_path, hex digest) of each file put() or get() transferred,
+        # hashed on the way.
+        self.verify = None
+        self.hashed = []
 
     # Recall that __getattr__ is the "fallback" attribute getter, and is thus
     # pretty safe to use for facade-like behavior as we're doing here.
     def __getattr__(self, attr):
         return getattr(self.ftp, attr)
 
+    def close(self):
+        for sftp in self.clients:
+            sftp.close()
+        self.clients = []
+        if self.cached:
+            sessions.release(self.client, self.ftp)
+        else:
+            self.ftp.close()
+
+    def home(self):
+        """
+        Return the remote user's home directory (see `SessionCache.home`.)
+        """
+        return sessions.home(self.client, self.ftp)
+
     def isdir(self, path):
         try:
             return stat.S_ISDIR(self.ftp.lstat(path).st_mode)
@@ -68,54 +447,449 @@ class SFTP(object):
         return ret
 
     def walk(self, top, topdown=True, onerror=None, followlinks=False):
-        from os.path import join
+        """
+        Remote equivalent of ``os.walk``, yielding ``(dirpath, dirnames,
+        filenames)`` tuples.
 
-        # We may not have read permission for top, in which case we can't get a
-        # list of the files the directory contains. os.path.walk always
-        # suppressed the exception then, rather than blow up for a minor reason
-        # when (say) a thousand readable directories are still left to visit.
-        # That logic is copied here.
-        try:
-            # Note that listdir and error are globals in this module due to
-            # earlier import-*.
-            names = self.ftp.listdir(top)
-        except Exception, err:
-            if onerror is not None:
-                onerror(err)
-            return
+        Symbolic links are always listed among ``filenames``, so
+        ``followlinks`` has no effect. See `walk_attr` for details.
+        """
+        for top, dirs, nondirs, attrs in self.walk_attr(top, topdown,
+            onerror):
+            yield top, dirs, nondirs
 
-        dirs, nondirs = [], []
-        for name in names:
-            if self.isdir(join(top, name)):
-                dirs.append(name)
-            else:
-                nondirs.append(name)
+    def walk_attr(self, top, topdown=True, onerror=None):
+        """
+        Like `walk`, but also yields a dict mapping each name in the directory
+        to its ``SFTPAttributes`` (size, mode, mtime and so forth.)
 
-        if topdown:
-            yield top, dirs, nondirs
+        Each directory is listed with a single ``listdir_attr`` request, and
+        the subdirectories of a directory are listed concurrently (see
+        `map`). As with ``os.walk``, a ``topdown`` caller may prune the
+        directory names in place to skip them; errors listing a directory are
+        passed to ``onerror``, if given, and the directory is skipped.
+        """
+        listing = self._list([top], onerror)[0]
+        if listing is not None:
+            for entry in self._walk(top, listing, topdown, onerror):
+                yield entry
 
-        for name in dirs:
-            path = join(top, name)
-            if followlinks or not self.islink(path):
-                for x in self.walk(path, topdown, onerror, followlinks):
-                    yield x
+    def _walk(self, top, listing, topdown, onerror):
+        dirs, nondirs, attrs = listing
+        if topdown:
+            yield top, dirs, nondirs, attrs
+        paths = [posixpath.join(top, name) for name in dirs]
+        for path, listing in zip(paths, self._list(paths, onerror)):
+            if listing is not None:
+                for entry in self._walk(path, listing, topdown, onerror):
+                    yield entry
         if not topdown:
-            yield top, dirs, nondirs
+            yield top, dirs, nondirs, attrs
+
+    def _list(self, paths, onerror):
+        """
+        List ``paths`` concurrently, returning a ``(dirs, nondirs, attrs)``
+        tuple, or None on error, for each.
+        """
+        def list_one(sftp, path):
+            dirs, nondirs, attrs = [], [], {}
+            for attr in sftp.ftp.listdir_attr(path):
+                attrs[attr.filename] = attr
+                if stat.S_ISDIR(attr.st_mode or 0):
+                    dirs.append(attr.filename)
+                else:
+                    nondirs.append(attr.filename)
+            return dirs, nondirs, attrs
+        listings = []
+        # We may not have read permission for a directory, in which case we
+        # can't get a list of the files it contains. os.path.walk always
+        # suppressed the exception then, rather than blow up for a minor
+        # reason when (say) a thousand readable directories are still left to
+        # visit. That logic is copied here.
+        for listing, error in self.map(list_one, paths, False):
+            if error and onerror is not None:
+                onerror(error[1])
+            listings.append(listing)
+        return listings
+
+    def manifest(self, top):
+        """
+        Return a dict mapping each path below ``top`` to its attributes.
+
+        The tree is listed with `walk_attr`, i.e. one request per directory.
+        Returns an empty dict if ``top`` doesn't exist.
+        """
+        manifest = {}
+        for dirpath, dirs, files, attrs in self.walk_attr(top):
+            for name, attr in attrs.iteritems():
+                manifest[posixpath.join(dirpath, name)] = attr
+        return manifest
+
+    def lstat_many(self, paths):
+        """
+        Return a dict mapping each of ``paths`` to its `lstat` attributes, or
+        None if it doesn't exist.
+
+        Each parent directory is listed once, concurrently, rather than making
+        one request per path; paths in directories which can't be listed are
+        looked up one at a time instead.
+        """
+        parents = sorted(set(posixpath.dirname(path) or '.' for path in paths))
+        listings = dict(zip(parents, self._list(parents, None)))
+        attrs = {}
+        for path in paths:
+            listing = listings[posixpath.dirname(path) or '.']
+            if listing is not None:
+                attrs[path] = listing[2].get(posixpath.basename(path))
+                continue
+            try:
+                attrs[path] = self.ftp.lstat(path)
+            except IOError:
+                attrs[path] = None
+        return attrs
+
+    @staticmethod
+    def remote_hashes(paths, use_sudo, algorithm='sha1'):
+        """
+        Return a dict mapping ``paths`` to their hex digests, by default
+        SHA1 ones.
+
+        Hashes are computed on the remote end by ``sha1sum`` (or the
+        ``algorithm`` counterpart, e.g. ``sha256sum``), run once per few
+        hundred paths. Paths which couldn't be hashed are left out.
+        """
+        from fabric.api import run, sudo, hide
+        hashes = {}
+        for i in range(0, len(paths), 200):
+            chunk = paths[i:i + 200]
+            command = "%ssum -- %s" % (algorithm,
+                " ".join(map(shell_quote, chunk)))
+            with _lock:
+                with settings(hide('everything'), warn_only=True, cwd=""):
+                    out = (sudo if use_sudo else run)(command)
+            for line in out.splitlines():
+                digest, sep, path = line.partition("  ")
+                if sep and path in chunk:
+                    hashes[path] = digest
+        return hashes
+
+    def remote_prefix_hash(self, path, length):
+        """
+        Return the SHA1 hex digest of the first ``length`` bytes of remote
+        file ``path``, or None if it couldn't be computed.
+        """
+        from fabric.api import run, hide
+        command = "head -c %d -- %s | sha1sum" % (length, shell_quote(path))
+        with _lock:
+            with settings(hide('everything'), warn_only=True, cwd=""):
+                out = run(command)
+        return out.split()[0] if out.succeeded and out.strip() else None
 
     def mkdir(self, path, use_sudo):
         from fabric.api import sudo, hide
         if use_sudo:
-            with hide('everything'):
-                sudo('mkdir %s' % path)
+            with _lock:
+                with hide('everything'):
+                    sudo('mkdir %s' % path)
         else:
             self.ftp.mkdir(path)
 
-    def get(self, remote_path, local_path, local_is_path, rremote=None):
+    def mkdirs(self, paths, use_sudo):
+        """
+        Create whichever of ``paths`` don't exist yet, parents first.
+
+        With ``use_sudo``, a single ``mkdir -p`` (per few hundred paths) does
+        the lot. Otherwise the directories are created a level at a time,
+        each level concurrently (see `map`), and without checking first for
+        those whose parent had to be created.
+        """
+        from fabric.api import sudo, hide
+        if not paths:
+            return
+        if use_sudo:
+            for i in range(0, len(paths), 200):
+                with _lock:
+                    with settings(hide('everything'), cwd=""):
+                        sudo("mkdir -p -- %s" % " ".join(
+                            map(shell_quote, paths[i:i + 200])))
+            return
+        levels = {}
+        for path in paths:
+            path = path.rstrip('/') or '/'
+            levels.setdefault(path.count('/'), []).append(path)
+        created = set()
+
+        def mkdir(sftp, path):
+            if posixpath.dirname(path) in created or not sftp.exists(path):
+                sftp.mkdir(path, False)
+                return path
+        for depth in sorted(levels):
+            for path, error in self.map(mkdir, levels[depth]):
+                if error:
+                    raise error[0], error[1], error[2]
+                created.add(path)
+
+    def map(self, function, items, stop_on_error=True):
+        """
+        Call ``function(sftp, item)`` for each of ``items``, concurrently.
+
+        Calls are spread over up to :ref:`env.sftp_channels <sftp-channels>`
+        SFTP channels on this connection, each with its own `SFTP` object
+        (``self``, plus extra ones kept open for reuse until `close` is
+        called). Returns a list with one ``(result,
+        exc_info)`` pair per item, in order; ``exc_info`` is None unless the
+        call raised an exception. With ``stop_on_error``, no further calls are
+        started once one has failed, and the items never tried get None for
+        both.
+        """
+        results = [(None, None)] * len(items)
+        count = min(len(items), max(env.sftp_channels or 1, 1))
+        if count <= 1:
+            for i, item in enumerate(items):
+                try:
+                    results[i] = (function(self, item), None)
+                except Exception:
+                    results[i] = (None, sys.exc_info())
+                    if stop_on_error:
+                        break
+            return results
+
+        queue = Queue()
+        for pair in enumerate(items):
+            queue.put(pair)
+        failed = []
+
+        def worker(sftp):
+            while not (stop_on_error and failed):
+                try:
+                    i, item = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[i] = (function(sftp, item), None)
+                except Exception:
+                    results[i] = (None, sys.exc_info())
+                    failed.append(i)
+
+        while len(self.clients) < count - 1:
+            client = SFTP(self.host_string)
+            client.skipped, client.deleted = self.skipped, self.deleted
+            client.failed = self.failed
+            client.verify, client.hashed = self.verify, self.hashed
+            self.clients.append(client)
+        workers = [
+            ThreadHandler('sftp%d' % i, worker, sftp)
+            for i, sftp in enumerate([self] + self.clients[:count - 1])
+        ]
+        for handler in workers:
+            handler.thread.join()
+        for handler in workers:
+            handler.raise_if_needed()
+        return results
+
+    def get(self, remote_path, local_path, local_is_path, rremote=None,
+        resume=False):
         # rremote => relative remote path, so get(/var/log) would result in
         # this function being called with
         # remote_path=/var/log/apache2/access.log and
         # rremote=apache2/access.log
         rremote = rremote if rremote is not None else remote_path
+        if local_is_path:
+            local_path = self.local_target(local_path, rremote)
+        self.announce_download(local_path, local_is_path, remote_path)
+        # File-like objects: reset to file seek 0 (to ensure full overwrite)
+        # and then download into them directly
+        if not local_is_path:
+            local_path.seek(0)
+            fd = self._hashing(local_path)
+            self._download(remote_path, fd)
+            self._hashed(fd, local_path, remote_path)
+        elif resume:
+            self._get_resumable(remote_path, local_path)
+        else:
+            with open(local_path, 'wb') as out:
+                fd = self._hashing(out)
+                self._download(remote_path, fd)
+            self._hashed(fd, local_path, remote_path)
+        # Return local_path object for posterity. (If mutated, caller will want
+        # to know.)
+        return local_path
+
+    def _hashing(self, fd):
+        """
+        Return file object ``fd``, hashed on the way if ``self.verify`` is
+        set; see `_hashed`.
+        """
+        if not self.verify:
+            return fd
+        return HashedFile(fd, self.verify)
+
+    def _hashed(self, fd, local_path, remote_path):
+        """
+        Record the digest of ``fd`` (as returned by `_hashing`) in
+        ``self.hashed``, once ``local_path`` is completely transferred to or
+        from ``remote_path``.
+        """
+        if isinstance(fd, HashedFile):
+            self.hashed.append((local_path, remote_path, fd.hexdigest()))
+
+    def _download(self, remote_path, fd):
+        """
+        Download ``remote_path`` into file object ``fd`` (see `receive_file`.)
+        """
+        remote = self.ftp.open(remote_path, 'rb')
+        try:
+            size = remote.stat().st_size
+            received = receive_file(remote, fd, 0, size)
+        finally:
+            remote.close()
+        if received != size:
+            raise IOError("size mismatch in get!  %d != %d" % (received,
+                size))
+
+    def _upload(self, fd, remote_path):
+        """
+        Upload file object ``fd`` to ``remote_path`` (see `send_file`.)
+        Returns the remote file's attributes.
+        """
+        remote = self.ftp.open(remote_path, 'wb')
+        try:
+            sent = send_file(remote, fd)
+        finally:
+            remote.close()
+        rattrs = self.ftp.stat(remote_path)
+        if rattrs.st_size != sent:
+            raise IOError("size mismatch in put!  %d != %d" % (
+                rattrs.st_size, sent))
+        return rattrs
+
+    def reconnect(self):
+        """
+        Replace this object's connection and SFTP session with new ones.
+
+        The old session is closed, in case its connection is still up (e.g.
+        after a timeout.)
+        """
+        _close_quietly(self.ftp)
+        self.client = connections.reconnect(self.host_string, self.client)
+        self.cached = True
+        self.ftp = sessions.acquire(self.client)
+
+    def _resumable(self, transfer, description):
+        """
+        Call ``transfer()`` until it completes, reconnecting whenever the
+        connection drops, at most :ref:`env.transfer_retries
+        <transfer-retries>` times.
+        """
+        retries = env.transfer_retries
+        while True:
+            try:
+                return transfer()
+            except _dropped, e:
+                if retries <= 0:
+                    raise
+                retries -= 1
+                warn("%s was interrupted (%s), resuming" % (description,
+                    e or e.__class__.__name__))
+                self.reconnect()
+
+    def _resume_offset(self, remote_path, local_path, done):
+        """
+        Return how much of a partial transfer can be kept: ``done`` bytes if
+        the first ``done`` bytes of ``remote_path`` and ``local_path`` have
+        the same SHA1 hash, or 0.
+        """
+        if not done:
+            return 0
+        if self.remote_prefix_hash(remote_path, done) \
+            != _local_hash(local_path, done):
+            return 0
+        if output.debug:
+            print("[%s] resuming transfer of %s at byte %d" % (
+                env.host_string, remote_path, done
+            ))
+        return done
+
+    def _get_resumable(self, remote_path, local_path):
+        """
+        Download ``remote_path`` into ``local_path`` through a partial file,
+        which later attempts carry on from.
+        """
+        partial = local_path + PARTIAL
+        size = self.ftp.stat(remote_path).st_size
+
+        def transfer():
+            done = 0
+            if os.path.exists(partial):
+                done = os.path.getsize(partial)
+                if done <= size:
+                    done = self._resume_offset(remote_path, partial, done)
+                else:
+                    done = 0
+            with open(partial, 'r+b' if done else 'wb') as fd:
+                fd.seek(done)
+                fd.truncate()
+                remote = self.ftp.open(remote_path, 'rb')
+                try:
+                    receive_file(remote, fd, done, size)
+                finally:
+                    remote.close()
+        self._resumable(transfer, "Download of %s" % remote_path)
+        if os.path.getsize(partial) != size:
+            raise IOError("size mismatch in get!  %d != %d" % (
+                os.path.getsize(partial), size))
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        os.rename(partial, local_path)
+
+    def _put_resumable(self, local_path, remote_path):
+        """
+        Upload ``local_path`` to ``remote_path`` through a partial file, which
+        later attempts carry on from. Returns the remote file's attributes.
+        """
+        partial = remote_path + PARTIAL
+        size = os.path.getsize(local_path)
+
+        def transfer():
+            try:
+                done = self.ftp.stat(partial).st_size
+            except IOError:
+                done = 0
+            if done <= size:
+                done = self._resume_offset(partial, local_path, done)
+            else:
+                done = 0
+            with open(local_path, 'rb') as fd:
+                fd.seek(done)
+                remote = self.ftp.open(partial, 'r+b' if done else 'wb')
+                try:
+                    remote.seek(done)
+                    send_file(remote, fd)
+                finally:
+                    remote.close()
+        self._resumable(transfer, "Upload of %s" % local_path)
+        if self.ftp.stat(partial).st_size != size:
+            raise IOError("size mismatch in put!  %d != %d" % (
+                self.ftp.stat(partial).st_size, size))
+        try:
+            self.ftp.rename(partial, remote_path)
+        except IOError:
+            # SFTP servers may refuse to rename over an existing file
+            self.ftp.remove(remote_path)
+            self.ftp.rename(partial, remote_path)
+        return self.ftp.stat(remote_path)
+
+    @staticmethod
+    def local_target(local_path, rremote):
+        """
+        Return where remote file ``rremote`` (relative to the directory being
+        downloaded, if any) goes locally, creating local directories as
+        needed.
+
+        ``local_path`` may use the ``%(host)s``, ``%(basename)s``,
+        ``%(dirname)s`` and ``%(path)s`` variables (see
+        `~fabric.operations.get`.)
+        """
         # Handle format string interpolation (e.g. %(dirname)s)
         path_vars = {
             'host': env.host_string.replace(':', '-'),
@@ -123,40 +897,43 @@ class SFTP(object):
             'dirname': os.path.dirname(rremote),
             'path': rremote
         }
-        if local_is_path:
-            # Naive fix to issue #711
-            escaped_path = re.sub(r'(%[^()]*\w)', r'%\1', local_path)
-            local_path = os.path.abspath(escaped_path % path_vars )
-
-            # Ensure we give ssh.SFTPCLient a file by prepending and/or
-            # creating local directories as appropriate.
-            dirpath, filepath = os.path.split(local_path)
-            if dirpath and not os.path.exists(dirpath):
+        # Naive fix to issue #711
+        escaped_path = re.sub(r'(%[^()]*\w)', r'%\1', local_path)
+        local_path = os.path.abspath(escaped_path % path_vars )
+
+        # Ensure we give ssh.SFTPCLient a file by prepending and/or
+        # creating local directories as appropriate.
+        dirpath, filepath = os.path.split(local_path)
+        if dirpath and not os.path.exists(dirpath):
+            try:
                 os.makedirs(dirpath)
-            if os.path.isdir(local_path):
-                local_path = os.path.join(local_path, path_vars['basename'])
+            except OSError, e:
+                # Another download may have just created it.
+                if e.errno != errno.EEXIST:
+                    raise
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path, path_vars['basename'])
+        return local_path
+
+    @staticmethod
+    def announce_download(local_path, local_is_path, remote_path):
+        """
+        Print that ``remote_path`` is being downloaded to ``local_path``, and
+        warn if that overwrites a local file.
+        """
         if output.running:
-            print("[%s] download: %s <- %s" % (
-                env.host_string,
-                _format_local(local_path, local_is_path),
-                remote_path
-            ))
+            with _lock:
+                print("[%s] download: %s <- %s" % (
+                    env.host_string,
+                    _format_local(local_path, local_is_path),
+                    remote_path
+                ))
         # Warn about overwrites, but keep going
         if local_is_path and os.path.exists(local_path):
             msg = "Local file %s already exists and is being overwritten."
             warn(msg % local_path)
-        # File-like objects: reset to file seek 0 (to ensure full overwrite)
-        # and then use Paramiko's getfo() directly
-        getter = self.ftp.get
-        if not local_is_path:
-            local_path.seek(0)
-            getter = self.ftp.getfo
-        getter(remote_path, local_path)
-        # Return local_path object for posterity. (If mutated, caller will want
-        # to know.)
-        return local_path
 
-    def get_dir(self, remote_path, local_path):
+    def get_dir(self, remote_path, local_path, resume=False):
         # Decide what needs to be stripped from remote paths so they're all
         # relative to the given remote_path
         if os.path.basename(remote_path):
@@ -164,8 +941,8 @@ class SFTP(object):
         else:
             strip = os.path.dirname(os.path.dirname(remote_path))
 
-        # Store all paths gotten so we can return them when done
-        result = []
+        # Collect all downloads first, so they can run concurrently
+        downloads = []
         # Use our facsimile of os.walk to find all files within remote_path
         for context, dirs, files in self.walk(remote_path):
             # Normalize current directory to be relative
@@ -192,41 +969,115 @@ class SFTP(object):
                     lpath = local_path
                 # Now we can make a call to self.get() with specific file paths
                 # on both ends.
-                result.append(self.get(rpath, lpath, True, rremote))
+                downloads.append((rpath, lpath, rremote))
+
+        def download(sftp, (rpath, lpath, rremote)):
+            return sftp.get(rpath, lpath, True, rremote, resume)
+        # Store all paths gotten so we can return them when done
+        result = []
+        for path, error in self.map(download, downloads):
+            if error:
+                raise error[0], error[1], error[2]
+            result.append(path)
+        return result
+
+    def get_dir_stream(self, remote_path, local_path, compress=None):
+        """
+        Download directory ``remote_path`` like `get_dir`, but as a single
+        ``tar`` stream (see `fabric.tarstream`), unpacked as it arrives.
+        """
+        parent, name = posixpath.split(remote_path.rstrip('/') or '/')
+        transport = connections[self.host_string].get_transport()
+        result = []
+        for rremote, fd in tarstream.download(transport, parent,
+            [name or '.'], compress):
+            # Same layout as get_dir()
+            if "%(path)s" not in local_path \
+                and "%(dirname)s" not in local_path:
+                lpath = os.path.join(local_path, *rremote.split('/'))
+            else:
+                lpath = local_path
+            lpath = self.local_target(lpath, rremote)
+            self.announce_download(lpath, True,
+                posixpath.join(parent, rremote))
+            with open(lpath, 'wb') as out:
+                out = self._hashing(out)
+                shutil.copyfileobj(fd, out)
+            self._hashed(out, lpath, posixpath.join(parent, rremote))
+            result.append(lpath)
         return result
 
     def put(self, local_path, remote_path, use_sudo, mirror_local_mode, mode,
-        local_is_path, temp_dir):
+        local_is_path, temp_dir, sync=False, checksum=False, delta=False,
+        resume=False, staging=None, hashes=None, attrs=None, changed=False):
+        # With sync, ``hashes`` and ``attrs`` are the remote hashes and lstat
+        # attributes the caller already fetched for comparisons, and
+        # ``changed`` means the caller already found the file changed, so
+        # it's uploaded without comparing again (though still with its
+        # modification time.)
         from fabric.api import sudo, hide
         pre = self.ftp.getcwd()
         pre = pre if pre else ''
-        if local_is_path and self.isdir(remote_path):
-            basename = os.path.basename(local_path)
-            remote_path = posixpath.join(remote_path, basename)
+        if local_is_path:
+            joined = posixpath.join(remote_path, os.path.basename(local_path))
+            # The caller may have worked out (and looked up) each target
+            if attrs is not None:
+                if joined in attrs:
+                    remote_path = joined
+            elif self.isdir(remote_path):
+                remote_path = joined
+        sync = sync and local_is_path
+        if sync and not changed:
+            if attrs is not None and remote_path in attrs:
+                attr = attrs[remote_path]
+            else:
+                try:
+                    attr = self.ftp.lstat(remote_path)
+                except IOError:
+                    attr = None
+            if self._unchanged(local_path, remote_path, attr, checksum,
+                use_sudo, hashes):
+                self.skipped.append(remote_path)
+                return None
         if output.running:
-            print("[%s] put: %s -> %s" % (
-                env.host_string,
-                _format_local(local_path, local_is_path),
-                posixpath.join(pre, remote_path)
-            ))
+            with _lock:
+                print("[%s] put: %s -> %s" % (
+                    env.host_string,
+                    _format_local(local_path, local_is_path),
+                    posixpath.join(pre, remote_path)
+                ))
         # When using sudo, "bounce" the file through a guaranteed-unique file
         # path in the default remote CWD (which, typically, the login user will
         # have write permissions on) in order to sudo(mv) it later.
         if use_sudo:
             target_path = remote_path
-            hasher = hashlib.sha1()
-            hasher.update(env.host_string)
-            hasher.update(target_path)
-            remote_path = posixpath.join(temp_dir, hasher.hexdigest())
+            remote_path = staged_path(staging or temp_dir, target_path)
+        # Only send what changed, if the remote end can tell us what it has
+        rattrs = None
+        if delta and local_is_path and not use_sudo:
+            rattrs = self._put_delta(local_path, remote_path)
         # Read, ensuring we handle file-like objects correct re: seek pointer
-        putter = self.ftp.put
-        if not local_is_path:
+        if rattrs is None and resume and local_is_path:
+            rattrs = self._put_resumable(local_path, remote_path)
+        fd = None
+        if rattrs is None and local_is_path:
+            with open(local_path, 'rb') as fd:
+                fd = self._hashing(fd)
+                rattrs = self._upload(fd, remote_path)
+        elif rattrs is None:
             old_pointer = local_path.tell()
             local_path.seek(0)
-            putter = self.ftp.putfo
-        rattrs = putter(local_path, remote_path)
-        if not local_is_path:
+            fd = self._hashing(local_path)
+            rattrs = self._upload(fd, remote_path)
             local_path.seek(old_pointer)
+        # Let later syncs tell the file hasn't changed since
+        if sync:
+            lstat = os.stat(local_path)
+            self.ftp.utime(remote_path, (lstat.st_atime, lstat.st_mtime))
+        # put_dir moves staged files into place, modes and all, in one go
+        if use_sudo and staging:
+            self._hashed(fd, local_path, target_path)
+            return target_path
         # Handle modes if necessary
         if (local_is_path and mirror_local_mode) or (mode is not None):
             lmode = os.stat(local_path).st_mode if mirror_local_mode else mode
@@ -240,28 +1091,106 @@ class SFTP(object):
                 rmode = (rmode & 07777)
             if lmode != rmode:
                 if use_sudo:
-                    with hide('everything'):
-                        sudo('chmod %o \"%s\"' % (lmode, remote_path))
+                    with _lock:
+                        with hide('everything'):
+                            sudo('chmod %o \"%s\"' % (lmode, remote_path))
                 else:
                     self.ftp.chmod(remote_path, lmode)
         if use_sudo:
             # Temporarily nuke 'cwd' so sudo() doesn't "cd" its mv command.
             # (The target path has already been cwd-ified elsewhere.)
-            with settings(hide('everything'), cwd=""):
-                sudo("mv \"%s\" \"%s\"" % (remote_path, target_path))
+            with _lock:
+                with settings(hide('everything'), cwd=""):
+                    sudo("mv \"%s\" \"%s\"" % (remote_path, target_path))
             # Revert to original remote_path for return value's sake
             remote_path = target_path
+        self._hashed(fd, local_path, remote_path)
         return remote_path
 
+    def _put_delta(self, local_path, remote_path):
+        """
+        Update ``remote_path`` to match ``local_path`` by sending only the
+        blocks which differ (see `fabric.delta`.)
+
+        Returns the remote file's new attributes, or None if a delta transfer
+        wasn't possible (e.g. the remote file doesn't exist, or the remote
+        host has no Python) or its result didn't verify, in which case the
+        remote file is left as it was.
+        """
+        try:
+            attr = self.ftp.lstat(remote_path)
+        except IOError:
+            return None
+        if not (stat.S_ISREG(attr.st_mode or 0) and attr.st_size):
+            return None
+        block_size = block_size_for(attr.st_size)
+        transport = connections[self.host_string].get_transport()
+
+        def helper(mode):
+            channel = transport.open_session()
+            channel.exec_command(helper_command(mode, remote_path, block_size))
+            return channel
+        sent = 0
+        try:
+            channel = helper('sig')
+            signatures = channel.makefile('rb').read()
+            if channel.recv_exit_status() != 0:
+                return None
+            signatures = parse_signature(signatures)
+            channel = helper('patch')
+            channel.sendall(_local_hash(local_path) + "\n")
+            with open(local_path, 'rb') as fd:
+                for data in encode(instructions(fd, signatures, block_size)):
+                    channel.sendall(data)
+                    sent += len(data)
+            channel.shutdown_write()
+            reply = channel.makefile('rb').read()
+            if channel.recv_exit_status() != 0 or reply.strip() != 'ok':
+                return None
+        except Exception, e:
+            if output.debug:
+                print("[%s] delta transfer of %s failed: %s" % (
+                    env.host_string, remote_path, e
+                ))
+            return None
+        if output.debug:
+            print("[%s] delta: sent %d bytes for %s (%d bytes)" % (
+                env.host_string, sent, remote_path,
+                os.path.getsize(local_path)
+            ))
+        return self.ftp.lstat(remote_path)
+
+    def _unchanged(self, local_path, remote_path, attr, checksum, use_sudo,
+        hashes=None):
+        """
+        Tell whether ``local_path`` matches the remote file described by
+        ``attr``: same size and modification time or, with ``checksum``, same
+        size and SHA1 hash.
+        """
+        lstat = os.stat(local_path)
+        if attr is None or not stat.S_ISREG(attr.st_mode or 0) \
+            or attr.st_size != lstat.st_size:
+            return False
+        if checksum:
+            if hashes is None:
+                hashes = self.remote_hashes([remote_path], use_sudo)
+            return hashes.get(remote_path) == _local_hash(local_path)
+        return attr.st_mtime is not None \
+            and int(attr.st_mtime) == int(lstat.st_mtime)
+
     def put_dir(self, local_path, remote_path, use_sudo, mirror_local_mode,
-        mode, temp_dir):
+        mode, temp_dir, sync=False, checksum=False, delete=False,
+        delta=False, resume=False):
         if os.path.basename(local_path):
             strip = os.path.dirname(local_path)
         else:
             strip = os.path.dirname(os.path.dirname(local_path))
 
-        remote_paths = []
-
+        # Collect the whole tree first, so directories can be created in one
+        # batch and files uploaded concurrently.
+        directories = []
+        uploads = []
+        local_dirs = {}
         for context, dirs, files in os.walk(local_path):
             rcontext = context.replace(strip, '', 1)
             # normalize pathname separators with POSIX separator
@@ -269,18 +1198,180 @@ class SFTP(object):
             rcontext = rcontext.lstrip('/')
             rcontext = posixpath.join(remote_path, rcontext)
 
-            if not self.exists(rcontext):
-                self.mkdir(rcontext, use_sudo)
-
+            directories.append(rcontext)
+            local_dirs[rcontext] = context
             for d in dirs:
-                n = posixpath.join(rcontext, d)
-                if not self.exists(n):
-                    self.mkdir(n, use_sudo)
+                directories.append(posixpath.join(rcontext, d))
+                local_dirs[directories[-1]] = os.path.join(context, d)
 
             for f in files:
-                local_path = os.path.join(context, f)
-                n = posixpath.join(rcontext, f)
-                p = self.put(local_path, n, use_sudo, mirror_local_mode, mode,
-                    True, temp_dir)
-                remote_paths.append(p)
+                uploads.append((
+                    os.path.join(context, f), posixpath.join(rcontext, f)
+                ))
+
+        seen = set()
+        directories = [
+            d for d in directories if not (d in seen or seen.add(d))
+        ]
+
+        if sync:
+            # Compare against the whole remote tree, fetched up front
+            manifest = dict(
+                (posixpath.normpath(path), attr) for path, attr
+                in self.manifest(directories[0]).iteritems()
+            )
+            attrs = [manifest.get(posixpath.normpath(rpath))
+                for lpath, rpath in uploads]
+            hashes = None
+            if checksum:
+                hashes = self.remote_hashes([
+                    rpath for (lpath, rpath), attr in zip(uploads, attrs)
+                    if attr is not None
+                    and attr.st_size == os.path.getsize(lpath)
+                ], use_sudo)
+            changed = []
+            for (lpath, rpath), attr in zip(uploads, attrs):
+                if self._unchanged(lpath, rpath, attr, checksum, use_sudo,
+                    hashes):
+                    self.skipped.append(rpath)
+                else:
+                    changed.append((lpath, rpath))
+            wanted = set(posixpath.normpath(path) for path in
+                directories + [rpath for lpath, rpath in uploads])
+            if delete:
+                self.delete(sorted(path for path in manifest
+                    if path not in wanted), manifest, use_sudo)
+            directories = [d for d in directories
+                if posixpath.normpath(d) not in manifest]
+            uploads = changed
+
+        # Many small files go faster as one tar stream than one by one
+        threshold = env.put_stream_threshold
+        if threshold and len(uploads) >= threshold and not (use_sudo or sync
+            or delta or mirror_local_mode or mode is not None or self.verify) \
+            and sum(os.path.getsize(lpath) for lpath, rpath in uploads) \
+            < len(uploads) * tarstream.SMALL_FILE:
+            if self._stream_dir(local_path, remote_path, directories,
+                local_dirs, uploads):
+                return [rpath for lpath, rpath in uploads]
+
+        staging = None
+        if use_sudo:
+            # Files go to one staging directory, to be moved into place (and
+            # their directories created) by a single sudo call at the end.
+            staging = staged_path(temp_dir, remote_path) + '.fabric-put'
+            if not self.exists(staging):
+                self.ftp.mkdir(staging)
+        else:
+            self.mkdirs(directories, use_sudo)
+
+        # With sync, files left in uploads are known to have changed
+        def upload(sftp, (lpath, rpath)):
+            return sftp.put(lpath, rpath, use_sudo, mirror_local_mode, mode,
+                True, temp_dir, sync, False, delta, resume, staging,
+                changed=True)
+        done = []
+        for (lpath, rpath), (path, error) in zip(uploads,
+            self.map(upload, uploads)):
+            if error:
+                raise error[0], error[1], error[2]
+            if path is not None:
+                done.append((lpath, path))
+        if staging:
+            return self._finalize(staging, directories, done,
+                mirror_local_mode, mode)
+        return [path for lpath, path in done]
+
+    def _finalize(self, staging, directories, uploads, mirror_local_mode,
+        mode):
+        """
+        Move files `put_dir` uploaded into ``staging`` into place, creating
+        ``directories`` first, with one sudo'd `finalize_script` script.
+        ``uploads`` are the ``(local_path, remote_path)`` of those files.
+
+        Returns the remote paths of the files moved into place. Those which
+        couldn't be are added to ``self.failed``, and left in ``staging``.
+        """
+        moves = [
+            (staged_path(staging, rpath), rpath,
+                requested_mode(lpath, mirror_local_mode, mode))
+            for lpath, rpath in uploads
+        ]
+        self._upload(StringIO(finalize_script(staging, directories, moves)),
+            posixpath.join(staging, 'finalize.sh'))
+        failures = run_finalize_script(staging)
+        remote_paths = []
+        for index, (lpath, rpath) in enumerate(uploads):
+            if index in failures:
+                self.failed.append((lpath, rpath, failures[index]))
+            else:
+                remote_paths.append(rpath)
         return remote_paths
+
+    def _stream_dir(self, local_path, remote_path, directories, local_dirs,
+        uploads):
+        """
+        Upload a tree collected by `put_dir` as one tar stream (see
+        `fabric.tarstream`), extracted by ``tar`` into ``remote_path``.
+
+        Files and directories get the same permissions an SFTP upload would
+        give them. Returns whether the upload worked; if it didn't (e.g. the
+        remote host has no ``tar``), anything already extracted will be
+        overwritten by the usual upload.
+        """
+        prefix = remote_path.rstrip('/') + '/'
+        name = lambda rpath: rpath[len(prefix):] or '.'
+        members = [(local_dirs[d], name(d), 0777) for d in directories] \
+            + [(lpath, name(rpath), 0666) for lpath, rpath in uploads]
+        transport = connections[self.host_string].get_transport()
+        try:
+            status, stderr = tarstream.upload(transport, members,
+                remote_path, options=('--no-same-owner',
+                '--no-same-permissions'))
+        except Exception, e:
+            status, stderr = None, str(e)
+        if status != 0:
+            if output.debug:
+                print("[%s] tar stream to %s failed (%s): %s" % (
+                    env.host_string, remote_path, status, stderr.strip()
+                ))
+            return False
+        if output.running:
+            with _lock:
+                print("[%s] put: %s -> %s (%d files, as a tar stream)" % (
+                    env.host_string, local_path, remote_path, len(uploads)
+                ))
+        return True
+
+    def delete(self, paths, attrs, use_sudo):
+        """
+        Remove ``paths``, whose attributes are given in the ``attrs`` dict.
+
+        ``paths`` must include the contents of any directories in it. With
+        ``use_sudo``, one ``rm -rf`` per few hundred paths is used.
+        """
+        from fabric.api import sudo, hide
+        if not paths:
+            return
+        self.deleted.extend(paths)
+        if use_sudo:
+            # Only the topmost paths are needed
+            doomed = set(paths)
+            top = [path for path in paths
+                if posixpath.dirname(path) not in doomed]
+            for i in range(0, len(top), 200):
+                with _lock:
+                    with settings(hide('everything'), cwd=""):
+                        sudo("rm -rf -- %s" % " ".join(
+                            map(shell_quote, top[i:i + 200])))
+            return
+        isdir = lambda path: stat.S_ISDIR(attrs[path].st_mode or 0)
+        files = [path for path in paths if not isdir(path)]
+        for path, error in self.map(lambda sftp, path: sftp.remove(path),
+            files):
+            if error:
+                raise error[0], error[1], error[2]
+        # Deepest directories first, once they're empty
+        for path in sorted(filter(isdir, paths), key=lambda path:
+            -path.count('/')):
+            self.ftp.rmdir(path)
@@ -0,0 +1,293 @@
+"""
+Persistent remote shells, reused by `~fabric.operations.run` and
+`~fabric.operations.sudo` when :ref:`env.persistent_shell
+<persistent-shell>` is enabled.
+
+Each host gets one long-lived shell, started once (so login profiles are only
+read once) and fed commands on its standard input. Every command is framed so
+that it runs in a subshell, followed by a unique sentinel on both output
+streams; the stdout sentinel carries the command's exit code. `ShellChannel`
+makes one such framed command look like a regular exec channel, so the usual
+I/O machinery applies unchanged.
+"""
+
+from __future__ import with_statement
+
+import os
+import random
+import re
+import threading
+
+from fabric.network import normalize_to_string, ssh, ssh_config
+from fabric.state import env, connections, default_channel
+from fabric.utils import shell_quote
+
+
+def shell_command():
+    """
+    Return the command which starts a persistent shell, based on ``env.shell``.
+
+    That is, ``env.shell`` minus its trailing ``-c`` (``/bin/bash -l`` for the
+    default of ``/bin/bash -l -c``), so the shell reads commands from stdin.
+    """
+    parts = env.shell.split()
+    if parts and parts[-1] == '-c':
+        parts = parts[:-1]
+    return " ".join(parts)
+
+
+def sudo_auth():
+    """
+    Return shell code which makes sure ``sudo`` holds cached credentials.
+
+    A persistent shell can't hand its standard input to ``sudo -S`` (anything
+    ``sudo`` doesn't read would be run as the next command), so the password is
+    read by the shell itself, one line per prompt, and validated with ``sudo
+    -v``. Prompts use ``env.sudo_prompt`` and ``env.again_prompt`` as usual.
+    """
+    return (
+        "if ! sudo -n -v 2>/dev/null; then _fab_n=0; while :; do "
+        "printf '%%s' %(prompt)s >&2; IFS= read -r _fab_pw; "
+        "printf '%%s\\n' \"$_fab_pw\" | sudo -S -p '' -v 2>/dev/null "
+        "&& break; "
+        "_fab_n=$((_fab_n + 1)); if [ $_fab_n -ge 3 ]; then "
+        "echo 'sudo: 3 incorrect password attempts' >&2; exit 1; fi; "
+        "printf '%%s\\n' %(again)s >&2; done; unset _fab_pw; fi"
+    ) % {
+        'prompt': shell_quote(env.sudo_prompt),
+        'again': shell_quote(env.again_prompt),
+    }
+
+
+def shell_code(command, sudo=False):
+    """
+    Return shell code running ``command`` (with stdin from ``/dev/null``).
+
+    If ``sudo`` is True, ``command`` is expected to invoke ``sudo`` without any
+    prompt of its own, and is preceded by `sudo_auth`.
+    """
+    code = "eval %s </dev/null" % shell_quote(command)
+    if sudo:
+        code = "%s; %s" % (sudo_auth(), code)
+    return code
+
+
+class PersistentShell(object):
+    """
+    A long-lived shell on the host given by ``env.host_string``.
+
+    Only one command runs at a time; `command` returns a `ShellChannel` for
+    each. A shell whose last command didn't finish cleanly (e.g. due to a
+    timeout) is of no further use and should be discarded (see `usable`).
+    """
+    def __init__(self):
+        self.key = normalize_to_string(env.host_string)
+        self.pid = os.getpid()
+        self.channel = default_channel()
+        self.transport = self.channel.get_transport()
+        self.forward = None
+        if self.forwarding():
+            self.forward = ssh.agent.AgentRequestHandler(self.channel)
+        self.channel.set_combine_stderr(False)
+        self.channel.exec_command(command=shell_command())
+        self.current = None
+
+    @staticmethod
+    def forwarding():
+        config_agent = ssh_config().get('forwardagent', 'no').lower() == 'yes'
+        return bool(env.forward_agent or config_agent)
+
+    def usable(self):
+        """
+        Whether this shell can run another command with the current settings.
+        """
+        transport = connections[env.host_string].get_transport()
+        return not (
+            self.channel.closed
+            or self.channel.exit_status_ready()
+            or (self.current is not None and not self.current.done())
+            or self.transport is not transport
+            or self.forwarding() != (self.forward is not None)
+        )
+
+    def command(self):
+        self.current = ShellChannel(self)
+        return self.current
+
+    def close(self):
+        # A shell inherited from a parent process (parallel mode) shares its
+        # connection with the parent, so leave that alone.
+        if self.pid != os.getpid():
+            return
+        self.channel.close()
+        if self.forward is not None:
+            self.forward.close()
+
+
+class FrameReader(object):
+    """
+    Read one command's worth of a shell's output stream, up to its sentinel.
+
+    Returns the empty string (end-of-stream, as far as the caller is
+    concerned) once the sentinel has been seen; a trailing exit code after
+    the sentinel is parsed and kept as ``status``.
+    """
+    def __init__(self, read_func, sentinel, with_status):
+        self.read_func = read_func
+        self.sentinel = sentinel
+        if with_status:
+            self.pattern = re.compile(re.escape(sentinel) + r'(\d+)\n')
+        else:
+            self.pattern = re.compile(re.escape(sentinel) + r'\n')
+        self.buffer = ''
+        self.finished = False
+        self.status = None
+
+    def _held(self):
+        """
+        Length of the buffer's tail which could be the start of a sentinel.
+        """
+        index = self.buffer.find(self.sentinel)
+        if index != -1:
+            return len(self.buffer) - index
+        longest = min(len(self.sentinel) - 1, len(self.buffer))
+        for size in range(longest, 0, -1):
+            if self.buffer.endswith(self.sentinel[:size]):
+                return size
+        return 0
+
+    def __call__(self, size):
+        while not self.finished:
+            data = self.read_func(size)
+            if data == '':
+                # Shell went away mid-command; hand back whatever's left.
+                self.finished = True
+                data, self.buffer = self.buffer, ''
+                return data
+            self.buffer += data
+            match = self.pattern.search(self.buffer)
+            if match:
+                self.finished = True
+                if match.groups():
+                    self.status = int(match.group(1))
+                data = self.buffer[:match.start()]
+                self.buffer = ''
+                if data:
+                    return data
+                break
+            held = self._held()
+            data = self.buffer[:len(self.buffer) - held]
+            self.buffer = self.buffer[len(self.buffer) - held:]
+            if data:
+                return data
+        return ''
+
+
+class ShellChannel(object):
+    """
+    Quacks like an exec channel, for one command run in a `PersistentShell`.
+
+    Unlike an exec channel, it has no standard input of its own: local input
+    is never forwarded (it would be run as shell commands afterwards), and
+    ``close`` leaves the shell running.
+    """
+    def __init__(self, shell):
+        self.shell = shell
+        self.chan = shell.channel
+        self.combine_stderr = False
+        sentinel = "__fabric_done_%x__" % random.getrandbits(64)
+        self.sentinel = sentinel
+        self.stdout = FrameReader(self.chan.recv, sentinel, True)
+        self.stderr = FrameReader(self.chan.recv_stderr, sentinel, False)
+
+    input_enabled = property(lambda self: False, lambda self, value: None)
+
+    @property
+    def closed(self):
+        return self.chan.closed
+
+    def settimeout(self, timeout):
+        self.chan.settimeout(timeout)
+
+    def set_combine_stderr(self, combine):
+        self.combine_stderr = combine
+
+    def get_pty(self, *args, **kwargs):
+        raise ValueError("Persistent shells can't provide a pty")
+
+    def request_forward_agent(self, handler):
+        # Forwarding, if any, was requested when the shell was started.
+        return True
+
+    def exec_command(self, command):
+        """
+        Run ``command`` (shell code) in a subshell of the persistent shell.
+        """
+        redirect = " 2>&1" if self.combine_stderr else ""
+        self.chan.sendall(
+            "(\n%s\n)%s; printf '%s%%d\\n' $?; printf '%s\\n' >&2\n" % (
+                command, redirect, self.sentinel, self.sentinel
+            )
+        )
+
+    def recv(self, size):
+        return self.stdout(size)
+
+    def recv_stderr(self, size):
+        return self.stderr(size)
+
+    def send(self, data):
+        return self.chan.send(data)
+
+    def sendall(self, data):
+        return self.chan.sendall(data)
+
+    def done(self):
+        return self.stdout.finished and self.stderr.finished
+
+    def exit_status_ready(self):
+        return self.done() or self.chan.exit_status_ready()
+
+    def recv_exit_status(self):
+        if self.stdout.status is not None:
+            return self.stdout.status
+        # The shell itself exited (e.g. the command ran 'exec').
+        return self.chan.recv_exit_status()
+
+    def close(self):
+        # Nothing to do for a command which ran to completion; otherwise, the
+        # shell's state is unknown and it gets thrown away.
+        if not self.done() or self.stdout.status is None:
+            _discard(self.shell)
+
+
+# Keys are normalized host strings, values PersistentShell objects.
+shells = {}
+_lock = threading.Lock()
+
+
+def _discard(shell):
+    with _lock:
+        if shells.get(shell.key) is shell:
+            del shells[shell.key]
+    shell.close()
+
+
+def shell_channel():
+    """
+    Return a `ShellChannel` on ``env.host_string``'s persistent shell.
+
+    The shell is started on first use, and replaced if it died, its connection
+    was re-established, or its last command didn't finish.
+    """
+    key = normalize_to_string(env.host_string)
+    with _lock:
+        shell = shells.get(key)
+    if shell is not None and not shell.usable():
+        _discard(shell)
+        shell = None
+    if shell is None:
+        shell = PersistentShell()
+        with _lock:
+            shells[key] = shell
+    return shell.command()
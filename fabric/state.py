@@ -6,6 +6,7 @@ import os
 import sys
 from optparse import make_option
 
+from fabric.facts import HostFacts
 from fabric.network import HostConnectionCache, ssh
 from fabric.version import get_version
 from fabric.utils import _AliasDict, _AttributeDict
@@ -104,6 +105,12 @@ env_options = [
         help="abort instead of prompting (for password, host, etc)"
     ),
 
+    make_option('--aggregate',
+        action='store_true',
+        default=False,
+        help="group identical command output across hosts"
+    ),
+
     make_option('-c', '--config',
         dest='rcfile',
         default=_rc_path(),
@@ -141,6 +148,12 @@ env_options = [
         help="gateway host to connect through"
     ),
 
+    make_option('--gather-facts',
+        action='store_true',
+        default=False,
+        help="gather host facts for all hosts before running each task"
+    ),
+
     make_option('--hide',
         metavar='LEVELS',
         help="comma-separated list of output levels to hide"
@@ -206,6 +219,19 @@ env_options = [
         help="default to parallel execution method"
     ),
 
+    make_option('--parallel-log',
+        metavar='PATH',
+        default=None,
+        help="write each host's output in parallel mode to PATH, which "
+             "may contain %(host)s"
+    ),
+
+    make_option('--persistent-shell',
+        action='store_true',
+        default=False,
+        help="reuse one remote shell per host for run/sudo"
+    ),
+
     make_option('--port',
         default=default_port,
         help="SSH connection port"
@@ -305,6 +331,9 @@ env_options = [
 env = _AttributeDict({
     'again_prompt': 'Sorry, try again.',
     'all_hosts': [],
+    'broadcast_ssh': 'ssh -o BatchMode=yes',
+    'cache_queries': False,
+    'cache_ttl': None,
     'combine_stderr': True,
     'colorize_errors': False,
     'command': None,
@@ -315,20 +344,33 @@ env = _AttributeDict({
     'eagerly_disconnect': False,
     'echo_stdin': True,
     'exclude_hosts': [],
+    'facts': HostFacts(),
+    'facts_cache': None,
+    'facts_ttl': 3600,
     'gateway': None,
     'host': None,
     'host_string': None,
     'lcwd': '',  # Must be empty string, not None, for concatenation purposes
     'local_user': _get_system_username(),
     'output_prefix': True,
+    'parallel_console_interval': 0.1,
+    'parallel_console_lines': 0,
+    'parallel_log_backups': 3,
+    'parallel_log_max_bytes': 0,
     'passwords': {},
     'path': '',
     'path_behavior': 'append',
     'port': default_port,
+    'put_stream_threshold': 100,
     'real_fabfile': None,
     'remote_interrupt': None,
     'roles': [],
     'roledefs': {},
+    'sftp_channels': 4,
+    'sftp_chunk_size': 32768,
+    'sftp_max_packet_size': None,
+    'sftp_max_requests': 64,
+    'sftp_window_size': None,
     'shell_env': {},
     'skip_bad_hosts': False,
     'ssh_config_path': default_ssh_config_path,
@@ -339,6 +381,8 @@ env = _AttributeDict({
     'sudo_prompt': 'sudo password:',
     'sudo_user': None,
     'tasks': [],
+    'transfer_backend': 'sftp',
+    'transfer_retries': 3,
     'use_exceptions_for': {'network': False},
     'use_shell': True,
     'use_ssh_config': False,
@@ -0,0 +1,206 @@
+"""
+Directory transfers as a single ``tar`` stream over an exec channel.
+
+Instead of one or more SFTP round trips per file, a whole tree is sent as one
+tar archive: `send` builds it in-process, using `tarfile`'s stream mode, and
+writes it straight into a remote ``tar -x`` as it goes. Downloads work the
+other way around, `download` reading the output of a remote ``tar -c`` as it
+arrives. Nothing besides the files themselves is written to disk on either
+end, and each byte is read once.
+"""
+
+from __future__ import with_statement
+
+import os
+import posixpath
+import socket
+import tarfile
+
+from fabric.utils import shell_quote
+from fabric.state import env
+
+
+# Compression names, and the matching flags of the tar command
+COMPRESSION = {'gz': 'z', 'bz2': 'j'}
+
+# Average file size under which put_dir considers a tree's files small
+SMALL_FILE = 1 << 20
+
+
+def compression(compress):
+    """
+    Normalize a ``compress`` argument to ``"gz"``, ``"bz2"`` or ``""``.
+
+    ``True`` means ``"gz"``; ``None`` and ``False`` mean no compression.
+    """
+    if compress is True:
+        return 'gz'
+    if not compress:
+        return ''
+    if compress not in COMPRESSION:
+        raise ValueError("Unknown compression %r (expected one of %s)" % (
+            compress, ", ".join(sorted(COMPRESSION))
+        ))
+    return compress
+
+
+def remote_path(path):
+    """
+    Quote remote ``path`` for the shell, leaving a leading ``~`` expandable.
+    """
+    if path == '~' or path.startswith('~/'):
+        return '"$HOME"' + (shell_quote(path[1:]) if path[1:] else '')
+    return shell_quote(path)
+
+
+def extract_command(directory, compress=None, use_sudo=False, options=()):
+    """
+    Return the remote command unpacking a tar stream read from stdin.
+
+    Files are extracted into ``directory``, or the remote user's home
+    directory if it's empty. ``options`` are extra arguments for ``tar``.
+    With ``use_sudo``, ``tar`` runs under ``sudo -n`` (as ``env.sudo_user``,
+    if set): its standard input carries the archive, so there's no way to
+    answer a password prompt.
+    """
+    command = ['tar', '-x' + COMPRESSION.get(compression(compress), ''),
+        '-f', '-']
+    if directory:
+        command.extend(['-C', remote_path(directory)])
+    command.extend(options)
+    if use_sudo:
+        prefix = ['sudo', '-n']
+        if env.sudo_user:
+            prefix.extend(['-u', shell_quote(env.sudo_user)])
+        command = prefix + command
+    return " ".join(command)
+
+
+def create_command(directory, names, compress=None):
+    """
+    Return the remote command writing a tar archive of ``names`` to stdout.
+
+    ``names`` are relative to ``directory``, or to the remote user's home
+    directory if it's empty. Symbolic links are followed, as
+    `~fabric.operations.get` does.
+    """
+    command = ['tar', '-c' + COMPRESSION.get(compression(compress), ''),
+        '-h', '-f', '-']
+    if directory:
+        command.extend(['-C', remote_path(directory)])
+    command.append('--')
+    command.extend(shell_quote(name) for name in names)
+    return " ".join(command)
+
+
+def walk(local_path, name):
+    """
+    Yield `send` members for the tree at ``local_path``, archived as ``name``.
+    """
+    for context, dirs, files in os.walk(local_path):
+        relative = context[len(local_path):].replace(os.sep, '/').strip('/')
+        prefix = posixpath.join(name, relative) if relative else name
+        yield context, prefix, None
+        # os.walk doesn't descend into symlinked directories
+        for d in dirs:
+            path = os.path.join(context, d)
+            if os.path.islink(path):
+                yield path, posixpath.join(prefix, d), None
+        for f in files:
+            yield os.path.join(context, f), posixpath.join(prefix, f), None
+
+
+class _ChannelWriter(object):
+    """
+    The minimal file-like object `tarfile` needs to write to a channel.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        self.channel.sendall(data)
+
+
+def send(channel, members, compress=None):
+    """
+    Write a tar archive of ``members`` to ``channel``.
+
+    ``members`` is an iterable of ``(local_path, name, mode)`` tuples, where
+    ``name`` is the path within the archive and ``mode`` overrides the local
+    file's permissions unless it's None. Symbolic links are followed, as
+    `~fabric.operations.put` does. The channel's write side is shut down
+    afterwards, so the remote end sees the end of the archive.
+    """
+    archive = tarfile.open(fileobj=_ChannelWriter(channel),
+        mode='w|' + compression(compress))
+    archive.dereference = True
+    for path, name, mode in members:
+        info = archive.gettarinfo(path, name)
+        if mode is not None:
+            info.mode = mode
+        if info.isreg():
+            with open(path, 'rb') as fd:
+                archive.addfile(info, fd)
+        else:
+            archive.addfile(info)
+    archive.close()
+    channel.shutdown_write()
+
+
+def upload(transport, members, directory, compress=None, use_sudo=False,
+    options=()):
+    """
+    Stream ``members`` (see `send`) into a remote ``tar -x`` in ``directory``.
+
+    Returns the remote command's exit status and standard error.
+    """
+    channel = transport.open_session()
+    channel.exec_command(
+        extract_command(directory, compress, use_sudo, options)
+    )
+    try:
+        send(channel, members, compress)
+    except (socket.error, EOFError):
+        # The remote tar may have stopped reading early; if so, its exit
+        # status tells why.
+        if channel.recv_exit_status() in (0, -1):
+            raise
+    stderr = channel.makefile_stderr('rb').read()
+    return channel.recv_exit_status(), stderr
+
+
+def download(transport, directory, names, compress=None):
+    """
+    Yield the regular files in a remote tar archive of ``names`` (see
+    `create_command`) as they arrive.
+
+    Each file is a ``(name, fd)`` tuple, where ``name`` is its normalized
+    path within the archive and ``fd`` a file object to read it from, valid
+    until the next file is yielded. Raises ``IOError`` if the remote ``tar``
+    fails, or if the archive holds paths outside of ``directory``.
+    """
+    channel = transport.open_session()
+    channel.exec_command(create_command(directory, names, compress))
+    try:
+        try:
+            archive = tarfile.open(fileobj=channel.makefile('rb'),
+                mode='r|' + compression(compress))
+            for info in archive:
+                if not info.isreg():
+                    continue
+                name = posixpath.normpath(info.name)
+                if name.startswith('/') or name.split('/')[0] == '..':
+                    raise IOError("Refusing to extract %r" % info.name)
+                yield name, archive.extractfile(info)
+        except tarfile.TarError:
+            # Most likely nothing came through; the exit status tells why.
+            if channel.recv_exit_status() == 0:
+                raise
+        status = channel.recv_exit_status()
+        if status != 0:
+            stderr = channel.makefile_stderr('rb').read()
+            raise IOError("remote tar exited with status %s: %s" % (
+                status, stderr.strip()
+            ))
+    finally:
+        channel.close()
@@ -6,10 +6,12 @@ import sys
 import textwrap
 
 from fabric import state
+from fabric.aggregate import aggregator
 from fabric.utils import abort, warn, error
 from fabric.network import to_dict, normalize_to_string, disconnect_all
 from fabric.context_managers import settings
 from fabric.job_queue import JobQueue
+from fabric.multiplexer import FrameWriter, Multiplexer
 from fabric.task_utils import crawl, merge, parse_kwargs
 from fabric.exceptions import NetworkError
 
@@ -200,12 +202,14 @@ def _parallel_tasks(commands_to_run):
     ))
 
 
-def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
+def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing,
+    multiplexer=None):
     """
     Primary single-host work body of execute()
     """
     # Log to stdout
-    if state.output.running and not hasattr(task, 'return_value'):
+    if state.output.running and not hasattr(task, 'return_value') \
+        and not state.env.aggregate:
         print("[%s] Executing task '%s'" % (host, my_env['command']))
     # Create per-run env with connection settings
     local_env = to_dict(host)
@@ -223,8 +227,15 @@ def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
         # * nukes the connection cache to prevent shared-access problems
         # * knows how to send the tasks' return value back over a Queue
         # * captures exceptions raised by the task
-        def inner(args, kwargs, queue, name, env):
+        # * sends its output to the parent's multiplexer, if any
+        def inner(args, kwargs, queue, name, env, output=None):
             state.env.update(env)
+            # Aggregated output is printed by the parent.
+            aggregator.queue, aggregator.name = queue, name
+            streams = sys.stdout, sys.stderr
+            if output is not None:
+                sys.stdout = FrameWriter(output, name, 'stdout')
+                sys.stderr = FrameWriter(output, name, 'stderr')
             def submit(result):
                 queue.put({'name': name, 'result': result})
             try:
@@ -244,6 +255,12 @@ def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
                 # driven SystemExits -- will bubble up and terminate the
                 # child process.
                 raise
+            finally:
+                # Send any partial lines while the output queue still works;
+                # tracebacks printed on the way out go to the real stderr.
+                sys.stdout.flush()
+                sys.stderr.flush()
+                sys.stdout, sys.stderr = streams
 
         # Stuff into Process wrapper
         kwarg_dict = {
@@ -253,6 +270,8 @@ def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
             'name': name,
             'env': local_env,
         }
+        if multiplexer is not None:
+            kwarg_dict['output'] = multiplexer.queue
         p = multiprocessing.Process(target=inner, kwargs=kwarg_dict)
         # Name/id is host string
         p.name = name
@@ -332,6 +351,9 @@ def execute(task, *args, **kwargs):
     new_kwargs, hosts, roles, exclude_hosts = parse_kwargs(kwargs)
     # Set up host list
     my_env['all_hosts'] = task.get_hosts(hosts, roles, exclude_hosts, state.env)
+    # Probe all hosts at once up front, rather than one by one as tasks ask.
+    if state.env.gather_facts and my_env['all_hosts']:
+        state.env.facts.gather(my_env['all_hosts'])
 
     parallel = requires_parallel(task)
     if parallel:
@@ -355,49 +377,63 @@ def execute(task, *args, **kwargs):
     # Set up job queue in case parallel is needed
     queue = multiprocessing.Queue() if parallel else None
     jobs = JobQueue(pool_size, queue)
+    # Children's output goes through the multiplexer
+    multiplexer = Multiplexer(multiprocessing.Queue()) if parallel else None
     if state.output.debug:
         jobs._debug = True
 
     # Call on host list
     if my_env['all_hosts']:
-        # Attempt to cycle on hosts, skipping if needed
-        for host in my_env['all_hosts']:
-            try:
-                results[host] = _execute(
-                    task, host, my_env, args, new_kwargs, jobs, queue,
-                    multiprocessing
-                )
-            except NetworkError, e:
-                results[host] = e
-                # Backwards compat test re: whether to use an exception or
-                # abort
-                if not state.env.use_exceptions_for['network']:
-                    func = warn if state.env.skip_bad_hosts else abort
-                    error(e.message, func=func, exception=e.wrapped)
-                else:
-                    raise
-
-            # If requested, clear out connections here and not just at the end.
-            if state.env.eagerly_disconnect:
-                disconnect_all()
-
-        # If running in parallel, block until job queue is emptied
-        if jobs:
-            err = "One or more hosts failed while executing task '%s'" % (
-                my_env['command']
-            )
-            jobs.close()
-            # Abort if any children did not exit cleanly (fail-fast).
-            # This prevents Fabric from continuing on to any other tasks.
-            # Otherwise, pull in results from the child run.
-            ran_jobs = jobs.run()
-            for name, d in ran_jobs.iteritems():
-                if d['exit_code'] != 0:
-                    if isinstance(d['results'], BaseException):
-                        error(err, exception=d['results'])
+        # Output may be grouped across all of this task's hosts.
+        if state.env.aggregate:
+            aggregator.start(my_env['all_hosts'])
+        try:
+            # Attempt to cycle on hosts, skipping if needed
+            for host in my_env['all_hosts']:
+                try:
+                    results[host] = _execute(
+                        task, host, my_env, args, new_kwargs, jobs, queue,
+                        multiprocessing, multiplexer
+                    )
+                except NetworkError, e:
+                    results[host] = e
+                    # Backwards compat test re: whether to use an exception or
+                    # abort
+                    if not state.env.use_exceptions_for['network']:
+                        func = warn if state.env.skip_bad_hosts else abort
+                        error(e.message, func=func, exception=e.wrapped)
                     else:
-                        error(err)
-                results[name] = d['results']
+                        raise
+
+                # If requested, clear out connections here and not just at
+                # the end.
+                if state.env.eagerly_disconnect:
+                    disconnect_all()
+
+            # If running in parallel, block until job queue is emptied
+            if jobs:
+                err = "One or more hosts failed while executing task '%s'" % (
+                    my_env['command']
+                )
+                jobs.close()
+                # Abort if any children did not exit cleanly (fail-fast).
+                # This prevents Fabric from continuing on to any other tasks.
+                # Otherwise, pull in results from the child run.
+                multiplexer.start()
+                try:
+                    ran_jobs = jobs.run()
+                finally:
+                    multiplexer.stop()
+                for name, d in ran_jobs.iteritems():
+                    if d['exit_code'] != 0:
+                        if isinstance(d['results'], BaseException):
+                            error(err, exception=d['results'])
+                        else:
+                            error(err)
+                    results[name] = d['results']
+        finally:
+            if state.env.aggregate:
+                aggregator.finish()
 
     # Or just run once for local-only
     else:
@@ -363,6 +363,13 @@ class RingBuffer(list):
             return self._super.__setitem__(key, value)
 
 
+def shell_quote(string):
+    """
+    Quote ``string`` for literal use as a single shell word.
+    """
+    return "'%s'" % string.replace("'", "'\\''")
+
+
 def apply_lcwd(path, env):
     # Apply CWD if a relative path
     if not os.path.isabs(path) and env.lcwd:
@@ -6,6 +6,7 @@ import os
 import re
 import socket
 import stat
+import subprocess
 import sys
 import threading
 import time
@@ -99,6 +100,54 @@ def _equalize(lists, fillval=None):
     return lists
 
 
+def _copy_output(fd, send):
+    try:
+        for chunk in iter(lambda: os.read(fd, 4096), ''):
+            send(chunk)
+    except socket.error:
+        pass
+
+
+def local_process(args, stdin='', environ=None, cwd=None):
+    """
+    Return a response callable which runs ``args`` as a local process.
+
+    The process is hooked up to the client's channel: its stdout and stderr are
+    sent as they come, and the client's input is written to its stdin (after
+    ``stdin``, if given) until the client sends EOF or hangs up. Its exit code
+    becomes the command's. It runs in directory ``cwd``, if given.
+    """
+    def respond(channel):
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            env=dict(os.environ, **(environ or {})), close_fds=True, cwd=cwd)
+        proc.stdin.write(stdin)
+        proc.stdin.flush()
+        def feed():
+            try:
+                for chunk in iter(lambda: channel.recv(4096), ''):
+                    proc.stdin.write(chunk)
+                    proc.stdin.flush()
+                proc.stdin.close()
+            except (IOError, socket.error):
+                pass
+        feeder = threading.Thread(target=feed)
+        feeder.setDaemon(True)
+        feeder.start()
+        readers = [
+            threading.Thread(target=_copy_output,
+                args=(proc.stdout.fileno(), channel.sendall)),
+            threading.Thread(target=_copy_output,
+                args=(proc.stderr.fileno(), channel.sendall_stderr)),
+        ]
+        for thread in readers:
+            thread.start()
+        for thread in readers:
+            thread.join()
+        return ['', '', proc.wait()]
+    return respond
+
+
 class TestServer(ssh.ServerInterface):
     """
     Test server implementing the 'ssh' lib's server interface parent class.
@@ -110,12 +159,13 @@ class TestServer(ssh.ServerInterface):
     ``serve_responses`` function and its ``SSHHandler`` class.
     """
     def __init__(self, passwords, home, pubkeys, files):
-        self.event = threading.Event()
         self.passwords = passwords
         self.pubkeys = pubkeys
         self.files = FakeFilesystem(files)
         self.home = home
-        self.command = None
+        # Commands requested, by channel ID.
+        self.commands = {}
+        self.condition = threading.Condition()
 
     def check_channel_request(self, kind, chanid):
         if kind == 'session':
@@ -123,17 +173,30 @@ class TestServer(ssh.ServerInterface):
         return ssh.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
 
     def check_channel_exec_request(self, channel, command):
-        self.command = command
-        self.event.set()
+        with self.condition:
+            self.commands[channel.get_id()] = command
+            self.condition.notifyAll()
         return True
 
     def check_channel_pty_request(self, *args):
         return True
 
     def check_channel_shell_request(self, channel):
-        self.event.set()
         return True
 
+    def wait_for_command(self, channel, timeout):
+        """
+        Return the command requested on ``channel``, or None if none shows up.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while channel.get_id() not in self.commands:
+                remaining = deadline - time.time()
+                if remaining <= 0 or channel.closed:
+                    return None
+                self.condition.wait(min(remaining, 0.1))
+            return self.commands.pop(channel.get_id())
+
     def check_auth_password(self, username, password):
         self.username = username
         passed = self.passwords.get(username) == password
@@ -328,7 +391,29 @@ class FakeSFTPServer(ssh.SFTPServerInterface):
         return ssh.SFTP_OK
 
     def mkdir(self, path, attr):
-        self.files[path] = None
+        self.files[self.files.normalize(path)] = None
+        return ssh.SFTP_OK
+
+    def remove(self, path):
+        path = self.files.normalize(path)
+        if path not in self.files:
+            return ssh.SFTP_NO_SUCH_FILE
+        del self.files[path]
+        return ssh.SFTP_OK
+
+    rmdir = remove
+
+    def rename(self, oldpath, newpath):
+        oldpath = self.files.normalize(oldpath)
+        newpath = self.files.normalize(newpath)
+        if oldpath not in self.files:
+            return ssh.SFTP_NO_SUCH_FILE
+        # Like most SFTPv3 servers, refuse to replace existing files
+        if newpath in self.files:
+            return ssh.SFTP_FAILURE
+        fobj = self.files.pop(oldpath)
+        fobj.attributes.filename = os.path.basename(newpath)
+        self.files[newpath] = fobj
         return ssh.SFTP_OK
 
 
@@ -348,47 +433,45 @@ def serve_responses(responses, files, passwords, home, pubkeys, port):
         def handle(self):
             try:
                 self.init_transport()
-                self.waiting_for_command = False
+                # Each channel gets a thread of its own, so that clients may
+                # run several commands at once over one connection.
                 while not self.server.all_done.isSet():
-                    # Don't overwrite channel if we're waiting for a command.
-                    if not self.waiting_for_command:
-                        self.channel = self.transport.accept(1)
-                        if not self.channel:
-                            continue
-                    self.ssh_server.event.wait(10)
-                    if self.ssh_server.command:
-                        self.command = self.ssh_server.command
-                        # Set self.sudo_prompt, update self.command
-                        self.split_sudo_prompt()
-                        if self.command in responses:
-                            self.stdout, self.stderr, self.status = \
-                                self.response()
-                            if self.sudo_prompt and not self.sudo_password():
-                                self.channel.send(
-                                    "sudo: 3 incorrect password attempts\n"
-                                )
-                                break
-                            self.respond()
-                        else:
-                            self.channel.send_stderr(
-                                "Sorry, I don't recognize that command.\n"
-                            )
-                            self.channel.send_exit_status(1)
-                        # Close up shop
-                        self.command = self.ssh_server.command = None
-                        self.waiting_for_command = False
-                        time.sleep(0.5)
-                        self.channel.close()
-                    else:
-                        # If we're here, self.command was False or None,
-                        # but we do have a valid Channel object. Thus we're
-                        # waiting for the command to show up.
-                        self.waiting_for_command = True
-
+                    channel = self.transport.accept(1)
+                    if channel is None:
+                        continue
+                    thread = threading.Thread(target=self.serve,
+                        args=(channel,))
+                    thread.setDaemon(True)
+                    thread.start()
             finally:
                 self.transport.close()
 
+        def serve(self, channel):
+            # Channels for SFTP or interactive shells never see a command.
+            command = self.ssh_server.wait_for_command(channel, 10)
+            if command is None:
+                return
+            # Strip off any sudo prefix
+            sudo_prompt, command = self.split_sudo_prompt(command)
+            if command in responses:
+                if sudo_prompt and not self.sudo_password(channel):
+                    channel.send("sudo: 3 incorrect password attempts\n")
+                    channel.close()
+                    return
+                stdout, stderr, status = self.response(command, channel)
+                # Callable responses may run until the client hangs up.
+                if not channel.closed:
+                    self.respond(channel, stdout, stderr, status)
+            else:
+                channel.send_stderr("Sorry, I don't recognize that command.\n")
+                channel.send_exit_status(1)
+            # Close up shop
+            time.sleep(0.5)
+            channel.close()
+
         def init_transport(self):
+            # Answer small, lock-step exchanges (e.g. scp's) right away
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             transport = ssh.Transport(self.request)
             transport.add_server_key(ssh.RSAKey(filename=SERVER_PRIVKEY))
             transport.set_subsystem_handler('sftp', ssh.SFTPServer,
@@ -398,13 +481,16 @@ def serve_responses(responses, files, passwords, home, pubkeys, port):
             self.ssh_server = server
             self.transport = transport
 
-        def split_sudo_prompt(self):
+        def split_sudo_prompt(self, command):
             prefix = re.escape(_sudo_prefix(None, None).rstrip()) + ' +'
-            result = re.findall(r'^(%s)?(.*)$' % prefix, self.command)[0]
-            self.sudo_prompt, self.command = result
-
-        def response(self):
-            result = responses[self.command]
+            return re.findall(r'^(%s)?(.*)$' % prefix, command, re.DOTALL)[0]
+
+        def response(self, command, channel):
+            result = responses[command]
+            # Callables get to talk to the client directly (e.g. to read its
+            # stdin) before handing back a regular response value.
+            if callable(result):
+                result = result(channel)
             stderr = ""
             status = 0
             sleep = 0
@@ -424,30 +510,30 @@ def serve_responses(responses, files, passwords, home, pubkeys, port):
             time.sleep(sleep)
             return stdout, stderr, status
 
-        def sudo_password(self):
+        def sudo_password(self, channel):
             # Give user 3 tries, as is typical
             passed = False
             for x in range(3):
-                self.channel.send(env.sudo_prompt)
-                password = self.channel.recv(65535).strip()
+                channel.send(env.sudo_prompt)
+                password = channel.recv(65535).strip()
                 # Spit back newline to fake the echo of user's
                 # newline
-                self.channel.send('\n')
+                channel.send('\n')
                 # Test password
                 if password == passwords[self.ssh_server.username]:
                     passed = True
                     break
                 # If here, password was bad.
-                self.channel.send("Sorry, try again.\n")
+                channel.send("Sorry, try again.\n")
             return passed
 
-        def respond(self):
-            for out, err in zip(self.stdout, self.stderr):
+        def respond(self, channel, stdout, stderr, status):
+            for out, err in zip(stdout, stderr):
                 if out is not None:
-                    self.channel.send(out)
+                    channel.send(out)
                 if err is not None:
-                    self.channel.send_stderr(err)
-            self.channel.send_exit_status(self.status)
+                    channel.send_stderr(err)
+            channel.send_exit_status(status)
 
     return SSHServer((HOST, port), SSHHandler)
 
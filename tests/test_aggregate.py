@@ -0,0 +1,85 @@
+from __future__ import with_statement
+
+import sys
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_
+
+from fabric.aggregate import Aggregator, compress_hosts
+from fabric.api import execute, parallel, run, settings, hide
+
+from utils import FabricTest, mock_streams
+from server import server
+
+
+def test_compress_hosts_collapses_ranges():
+    hosts = ["web%03d" % i for i in range(1, 413)] + ["db1", "db2", "db4"]
+    eq_(compress_hosts(hosts + ["lb"]), "web[001-412],db[1-2,4],lb")
+
+
+def test_compress_hosts_keeps_single_hosts_as_is():
+    eq_(compress_hosts(["web01"]), "web01")
+    eq_(compress_hosts(["a.example.com", "b.example.com"]),
+        "a.example.com,b.example.com")
+
+
+def test_compress_hosts_groups_on_last_number():
+    eq_(compress_hosts(["10.0.0.1:22", "10.0.0.2:22", "10.0.0.3:22"]),
+        "10.0.0.1:22,10.0.0.2:22,10.0.0.3:22")
+    eq_(compress_hosts(["rack1-node1", "rack1-node2", "rack2-node1"]),
+        "rack1-node[1-2],rack2-node1")
+
+
+def test_groups_print_once_all_hosts_reported():
+    stream = StringIO()
+    aggregator = Aggregator(stream)
+    aggregator.start(["web1", "web2", "web3"])
+    aggregator.add("web1", "run", "uptime", "up", "", 0)
+    aggregator.add("web3", "run", "uptime", "up", "", 0)
+    eq_(stream.getvalue(), "")
+    aggregator.add("web2", "run", "uptime", "down", "", 1)
+    eq_(stream.getvalue(), """[web[1,3]] run: uptime (2 of 3 hosts)
+    out: up
+[web2] run: uptime (1 of 3 hosts, exit 1)
+    out: down
+""")
+
+
+def test_repeated_commands_are_separate_groups():
+    stream = StringIO()
+    aggregator = Aggregator(stream)
+    aggregator.start(["web1", "web2"])
+    aggregator.add("web1", "run", "date", "1", "", 0)
+    aggregator.add("web1", "run", "date", "2", "", 0)
+    aggregator.add("web2", "run", "date", "1", "", 0)
+    eq_(stream.getvalue(), "[web[1-2]] run: date (2 hosts)\n    out: 1\n")
+    aggregator.finish()
+    ok_(stream.getvalue().endswith(
+        "[web1] run: date (1 of 2 hosts)\n    out: 2\n"))
+
+
+class TestAggregate(FabricTest):
+    @server(port=2200)
+    @server(port=2201)
+    @mock_streams('stdout')
+    def test_execute_groups_identical_output(self):
+        def task():
+            run("ls /simple")
+        with settings(aggregate=True):
+            execute(task, hosts=['127.0.0.1:2200', '127.0.0.1:2201'])
+        eq_(sys.stdout.getvalue(),
+            "[127.0.0.1:[2200-2201]] run: ls /simple (2 hosts)\n"
+            "    out: some output\n")
+
+    @server(port=2200)
+    @server(port=2201)
+    @mock_streams('stdout')
+    def test_parallel_children_report_to_parent(self):
+        @parallel
+        def task():
+            run("ls /simple")
+        with settings(aggregate=True):
+            with hide('status'):
+                execute(task, hosts=['127.0.0.1:2200', '127.0.0.1:2201'])
+        ok_("[127.0.0.1:[2200-2201]] run: ls /simple (2 hosts)\n"
+            in sys.stdout.getvalue())
@@ -0,0 +1,99 @@
+from __future__ import with_statement
+
+import os
+import sys
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_
+
+from fabric.api import broadcast_put, get, hide, settings, env
+from fabric.broadcast import SCRIPT, helper_command, members, \
+    parse_results, relay_tree
+
+from utils import FabricTest
+from server import server, local_process
+
+
+# Stands in for ssh between hosts: runs the remote command locally, in a
+# directory of its own per host.
+FAKE_SSH = r"""
+import os, sys
+args = sys.argv[2:]
+while args[0].startswith('-'):
+    args = args[2:]
+target, command = args
+if 'broken' in target:
+    sys.exit(255)
+path = os.path.join(sys.argv[1], target)
+if not os.path.isdir(path):
+    os.makedirs(path)
+os.chdir(path)
+os.execvp('sh', ['sh', '-c', command])
+"""
+
+
+def test_relay_tree_splits_hosts_evenly():
+    hosts = ['h%d' % i for i in range(7)]
+    eq_(relay_tree(hosts, 2), [
+        ('h0', [('h1', [('h2', [])]), ('h3', [])]),
+        ('h4', [('h5', []), ('h6', [])]),
+    ])
+    eq_(members(relay_tree(hosts, 3)), hosts)
+
+
+def test_relay_tree_of_one_is_a_chain():
+    eq_(relay_tree(['a', 'b', 'c'], 1), [('a', [('b', [('c', [])])])])
+
+
+def test_parse_results():
+    eq_(parse_results("ok web1\nfail web2 disk full\nnoise\nfail web3\n"),
+        {'web1': None, 'web2': 'disk full', 'web3': 'failed'})
+
+
+class TestBroadcast(FabricTest):
+    @server(port=2200)
+    @server(port=2201)
+    def test_broadcast_put_writes_to_every_host(self):
+        """
+        broadcast_put() uploads the file to every host at once
+        """
+        hosts = ['127.0.0.1:2200', '127.0.0.1:2201']
+        local = self.mkfile('artifact.bin', "artifact" * 10000)
+        with hide('everything'):
+            result = broadcast_put(local, '/artifact.bin', hosts=hosts)
+        eq_(result, hosts)
+        ok_(result.succeeded)
+        for host in hosts:
+            remote = StringIO()
+            with settings(hide('everything'), host_string=host):
+                get('/artifact.bin', remote)
+            eq_(remote.getvalue(), "artifact" * 10000)
+
+    def test_broadcast_put_relays_between_hosts(self):
+        """
+        broadcast_put(relay=N) has hosts forward the file to one another
+        """
+        root = self.path('root')
+        os.mkdir(root)
+        fake_ssh = self.mkfile('fake_ssh.py', FAKE_SSH)
+        local = self.mkfile('artifact.bin', "artifact" * 10000)
+        responses = {helper_command():
+            local_process([sys.executable, '-c', SCRIPT], cwd=root)}
+        hosts = [env.host_string, 'web1', 'broken', 'web2']
+
+        @server(responses=responses)
+        def run():
+            with settings(hide('everything'), warn_only=True,
+                broadcast_ssh="%s %s %s" % (sys.executable, fake_ssh,
+                self.tmpdir)):
+                return broadcast_put(local, 'artifact.bin', hosts=hosts,
+                    relay=1, mode=0600)
+        result = run()
+        eq_(result, [env.host_string, 'web1'])
+        # Everything after the broken link in the chain missed out
+        eq_(result.failed, ['broken', 'web2'])
+        ok_('255' in result.errors['web2'])
+        for path in (root, self.path('%s@web1' % env.user)):
+            path = os.path.join(path, 'artifact.bin')
+            eq_(open(path).read(), "artifact" * 10000)
+            eq_(os.stat(path).st_mode & 0777, 0600)
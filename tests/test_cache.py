@@ -0,0 +1,152 @@
+from __future__ import with_statement
+
+import threading
+import time
+
+from nose.tools import eq_, ok_
+
+from fabric.api import run, sudo, put, hide, settings, cached, cached_query
+from fabric.cache import query_cache
+from fabric.contrib.files import exists
+
+from utils import FabricTest
+from server import server
+
+
+class Counted(dict):
+    """
+    Responses dict counting how often each command was actually run.
+    """
+    def __init__(self, responses):
+        super(Counted, self).__init__(responses)
+        self.counts = {}
+
+    def __getitem__(self, key):
+        self.counts[key] = self.counts.get(key, 0) + 1
+        return super(Counted, self).__getitem__(key)
+
+
+@cached_query
+def query(command, **kwargs):
+    with hide('everything'):
+        return run(command, **kwargs)
+
+
+class TestQueryCache(FabricTest):
+    responses = Counted({
+        'uname -r': '3.2.0',
+        'test -e "$(echo /etc)"': '',
+        'touch /tmp/x': '',
+        'false': ['', '', 1],
+    })
+
+    def env_setup(self):
+        super(TestQueryCache, self).env_setup()
+        self.responses.counts.clear()
+        query_cache.clear()
+
+    @server(responses=responses)
+    def test_repeated_queries_run_once(self):
+        with cached():
+            eq_(query("uname -r"), "3.2.0")
+            result = query("uname -r")
+        eq_(result, "3.2.0")
+        ok_(result.succeeded)
+        eq_(self.responses.counts['uname -r'], 1)
+        eq_(query_cache.stats['hits'], 1)
+        eq_(query_cache.stats['misses'], 1)
+
+    @server(responses=responses)
+    def test_nothing_is_cached_outside_cached_block(self):
+        query("uname -r")
+        query("uname -r")
+        eq_(self.responses.counts['uname -r'], 2)
+        eq_(query_cache.stats['misses'], 0)
+
+    @server(responses=responses)
+    def test_unmarked_commands_are_not_cached(self):
+        with cached():
+            with hide('everything'):
+                run("uname -r")
+                run("uname -r")
+        eq_(self.responses.counts['uname -r'], 2)
+
+    @server(responses=responses)
+    def test_writes_invalidate_host(self):
+        with cached():
+            query("uname -r")
+            with hide('everything'):
+                run("touch /tmp/x")
+            query("uname -r")
+        eq_(self.responses.counts['uname -r'], 2)
+        eq_(query_cache.stats['invalidations'], 1)
+
+    @server(responses=responses)
+    def test_uploads_invalidate_host(self):
+        with cached():
+            query("uname -r")
+            with hide('everything'):
+                put(self.mkfile('file.txt', 'text'), '/uploaded.txt')
+        eq_(query_cache.entries, {})
+        eq_(query_cache.stats['invalidations'], 1)
+
+    @server(responses=responses)
+    def test_ttl_expires_results(self):
+        with cached(ttl=0.2):
+            query("uname -r")
+            query("uname -r")
+            time.sleep(0.3)
+            query("uname -r")
+        eq_(self.responses.counts['uname -r'], 2)
+
+    @server(responses=responses)
+    def test_key_includes_warn_only(self):
+        with cached():
+            with settings(warn_only=True):
+                ok_(query("false").failed)
+                ok_(query("false").failed)
+            with hide('aborts'):
+                try:
+                    query("false")
+                except SystemExit:
+                    pass
+                else:
+                    assert False, "Cached failure didn't abort"
+        eq_(self.responses.counts['false'], 2)
+
+    @server(responses=responses)
+    def test_sudo_and_run_are_cached_separately(self):
+        @cached_query
+        def sudo_query():
+            with hide('everything'):
+                return sudo("uname -r")
+        with cached():
+            query("uname -r")
+            sudo_query()
+            sudo_query()
+        eq_(query_cache.stats['hits'], 1)
+        eq_(query_cache.stats['misses'], 2)
+
+    @server(responses=responses)
+    def test_contrib_exists_is_cached(self):
+        with cached():
+            ok_(exists('/etc'))
+            ok_(exists('/etc'))
+        eq_(self.responses.counts['test -e "$(echo /etc)"'], 1)
+
+    def test_queries_are_per_thread(self):
+        """
+        Only the thread inside a cached_query() runs read-only commands
+        """
+        seen = []
+
+        @cached_query
+        def marked():
+            other = threading.Thread(
+                target=lambda: seen.append(query_cache.read_only()))
+            other.start()
+            other.join()
+            seen.append(query_cache.read_only())
+        marked()
+        eq_(seen, [False, True])
+        ok_(not query_cache.read_only())
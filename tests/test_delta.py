@@ -0,0 +1,118 @@
+from __future__ import with_statement
+
+import hashlib
+import random
+import subprocess
+import sys
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_
+
+from fabric.api import get, put, hide
+from fabric.delta import SCRIPT, block_size_for, encode, helper_command, \
+    instructions, parse_signature, signature
+
+from utils import FabricTest
+from server import server, local_process
+
+
+random.seed(41)
+OLD = "".join(chr(random.randrange(256)) for i in range(100000))
+# Some bytes inserted, some changed and some replaced by more; the test
+# server can't truncate files, so NEW mustn't be shorter.
+NEW = OLD[:10000] + "inserted" + OLD[10000:50000] + "x" * 100 \
+    + OLD[50100:90000] + "y" * 6000 + OLD[95000:]
+
+
+def apply(old, ops, block_size):
+    return "".join(
+        old[value * block_size:(value + 1) * block_size]
+        if kind == 'copy' else value
+        for kind, value in ops
+    )
+
+
+def test_instructions_rebuild_new_file():
+    ops = list(instructions(StringIO(NEW), signature(StringIO(OLD), 4096),
+        4096))
+    eq_(apply(OLD, ops, 4096), NEW)
+    literal = sum(len(value) for kind, value in ops if kind == 'data')
+    ok_(literal < 6000 + 5 * 4096, "sent %d literal bytes" % literal)
+
+
+def test_unrelated_files_are_sent_whole():
+    ops = list(instructions(StringIO("b" * 10000),
+        signature(StringIO("a" * 10000), 4096), 4096))
+    eq_(apply("", ops, 4096), "b" * 10000)
+
+
+def test_block_size_grows_with_file_size():
+    eq_(block_size_for(0), 4096)
+    eq_(block_size_for(1 << 32), 65536)
+    eq_(block_size_for(1 << 50), 1 << 20)
+
+
+def helper(mode, path, block_size, stdin=""):
+    process = subprocess.Popen(
+        [sys.executable, '-c', SCRIPT, mode, path, str(block_size)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    stdout = process.communicate(stdin)[0]
+    return stdout, process.returncode
+
+
+class TestDelta(FabricTest):
+    def test_helper_script_signature_matches_local(self):
+        path = self.mkfile('old', OLD)
+        stdout, status = helper('sig', path, 4096)
+        eq_(status, 0)
+        eq_(parse_signature(stdout), signature(StringIO(OLD), 4096))
+
+    def test_helper_script_verifies_before_replacing(self):
+        path = self.mkfile('old', OLD)
+        ops = "".join(encode(instructions(StringIO(NEW),
+            signature(StringIO(OLD), 4096), 4096)))
+        eq_(helper('patch', path, 4096, "0" * 40 + "\n" + ops),
+            ("mismatch\n", 1))
+        eq_(open(path).read(), OLD)
+        digest = hashlib.sha1(NEW).hexdigest()
+        eq_(helper('patch', path, 4096, digest + "\n" + ops), ("ok\n", 0))
+        eq_(open(path).read(), NEW)
+
+    def test_put_with_delta_uses_helper(self):
+        """
+        put(delta=True) updates the remote file through the helper script
+        """
+        # The helper runs locally, on a stand-in for the remote file.
+        standin = self.mkfile('standin', OLD)
+        block_size = block_size_for(len(OLD))
+        responses = {}
+        for mode in ('sig', 'patch'):
+            responses[helper_command(mode, '/delta.bin', block_size)] = \
+                local_process([sys.executable, '-c', SCRIPT, mode, standin,
+                    str(block_size)])
+
+        remote = StringIO()
+
+        @server(responses=responses)
+        def run():
+            with hide('everything'):
+                put(StringIO(OLD), '/delta.bin')
+                put(self.mkfile('new', NEW), '/delta.bin', delta=True)
+                get('/delta.bin', remote)
+        run()
+        eq_(open(standin).read(), NEW)
+        # Nothing went over SFTP the second time
+        eq_(remote.getvalue(), OLD)
+
+    @server()
+    def test_put_with_delta_falls_back_to_full_copy(self):
+        """
+        put(delta=True) uploads the whole file if the helper can't run
+        """
+        with hide('everything'):
+            put(StringIO(OLD), '/delta2.bin')
+            put(self.mkfile('new', NEW), '/delta2.bin', delta=True)
+            remote = StringIO()
+            get('/delta2.bin', remote)
+        eq_(remote.getvalue(), NEW)
@@ -0,0 +1,175 @@
+from __future__ import with_statement
+
+import os
+
+from fudge import patched_context
+from nose.tools import eq_, ok_
+
+from fabric.api import env, execute, hide, settings
+from fabric.contrib.files import sed
+from fabric.facts import parse, probe_command, PROBE
+from fabric.state import connections
+
+from utils import FabricTest
+from server import server, local_process, PORT, USER
+
+
+OUTPUT = """os=Linux
+kernel=3.2.0-4-amd64
+arch=x86_64
+hostname=web1
+distro=debian
+distro_version=7
+cpus=4
+memory=8388608000
+disk_total=
+disk_free=bogus
+sudo=1
+sudo_nopasswd=0
+unexpected=value
+"""
+
+
+def test_parse_converts_types():
+    facts = parse(OUTPUT)
+    eq_(facts.os, "Linux")
+    eq_(facts.kernel, "3.2.0-4-amd64")
+    eq_(facts.cpus, 4)
+    eq_(facts.memory, 8388608000)
+    eq_(facts.sudo, True)
+    eq_(facts.sudo_nopasswd, False)
+
+
+def test_parse_leaves_missing_facts_as_none():
+    facts = parse(OUTPUT)
+    eq_(facts.disk_total, None)
+    eq_(facts.disk_free, None)
+    ok_('unexpected' not in facts)
+
+
+class Recorded(dict):
+    """
+    Responses answering any command not given explicitly with no output,
+    and recording every command run.
+    """
+    def __init__(self, responses):
+        super(Recorded, self).__init__(responses)
+        self.seen = []
+
+    def __contains__(self, key):
+        return True
+
+    def __getitem__(self, key):
+        self.seen.append(key)
+        return self.get(key, '')
+
+
+class Counted(dict):
+    def __init__(self, responses):
+        super(Counted, self).__init__(responses)
+        self.count = 0
+
+    def __getitem__(self, key):
+        self.count += 1
+        return super(Counted, self).__getitem__(key)
+
+
+OTHER_HOST = '%s@localhost:%s' % (USER, PORT)
+
+
+class TestFacts(FabricTest):
+    responses = Counted({probe_command(): OUTPUT})
+
+    def env_setup(self):
+        super(TestFacts, self).env_setup()
+        self.responses.count = 0
+        env.facts.clear()
+
+    @server(responses=responses)
+    def test_facts_are_gathered_on_first_access_only(self):
+        eq_(env.facts[env.host_string].distro, "debian")
+        eq_(env.facts[env.host_string].cpus, 4)
+        eq_(self.responses.count, 1)
+
+    @server(responses=responses)
+    def test_gather_probes_several_hosts(self):
+        failures = env.facts.gather([env.host_string, OTHER_HOST])
+        eq_(failures, {})
+        eq_(self.responses.count, 2)
+        eq_(env.facts[OTHER_HOST].kernel, "3.2.0-4-amd64")
+        eq_(self.responses.count, 2)
+
+    @server(responses=responses)
+    def test_execute_gathers_facts_up_front(self):
+        counts = []
+
+        def task():
+            counts.append(self.responses.count)
+            return env.facts[env.host_string].os
+        with hide('everything'):
+            with settings(gather_facts=True):
+                results = execute(task, hosts=[env.host_string, OTHER_HOST])
+        eq_(counts, [2, 2])
+        eq_(results.values(), ["Linux", "Linux"])
+
+    @server(responses=responses)
+    def test_local_cache_is_reused_until_expiry(self):
+        with settings(facts_cache=self.path('facts')):
+            env.facts.gather([env.host_string])
+            env.facts.clear()
+            eq_(env.facts[env.host_string].os, "Linux")
+            eq_(self.responses.count, 1)
+            env.facts.clear()
+            with settings(facts_ttl=-1):
+                env.facts[env.host_string]
+            eq_(self.responses.count, 2)
+
+    @server(responses={probe_command(): ['', 'oops', 1]})
+    def test_failed_probes_are_reported(self):
+        with hide('everything'):
+            failures = env.facts.gather([env.host_string])
+        ok_(env.host_string in failures)
+        ok_(env.host_string not in env.facts)
+
+    @server(responses={
+        probe_command(): local_process(['/bin/sh', '-c', PROBE])
+    })
+    def test_probe_script_runs_on_a_real_shell(self):
+        facts = env.facts[env.host_string]
+        eq_(facts.os, os.uname()[0])
+        eq_(facts.kernel, os.uname()[2])
+        ok_(facts.cpus >= 1)
+        ok_(isinstance(facts.sudo, bool))
+
+    @server(responses=responses)
+    def test_gather_connects_before_probing(self):
+        connected = []
+
+        def fake_probe(host):
+            connected.append(host in connections)
+            return parse(OUTPUT)
+        with patched_context('fabric.facts', 'probe', fake_probe):
+            env.facts.gather([env.host_string, OTHER_HOST])
+        eq_(connected, [True, True])
+
+    failing = Recorded({probe_command(): ['', 'oops', 1], 'uname': 'Darwin'})
+
+    @server(responses=failing)
+    def test_sed_uses_uname_without_gathered_facts(self):
+        with hide('everything'):
+            sed('/etc/hosts', 'a', 'b')
+        ok_(probe_command() not in self.failing.seen)
+        ok_('uname' in self.failing.seen)
+        ok_(self.failing.seen[-1].startswith('sed -i.bak -E '),
+            self.failing.seen[-1])
+
+    gathered = Recorded({probe_command(): OUTPUT})
+
+    @server(responses=gathered)
+    def test_sed_uses_gathered_os_fact(self):
+        env.facts.gather([env.host_string])
+        with hide('everything'):
+            sed('/etc/hosts', 'a', 'b')
+        ok_('uname' not in self.gathered.seen)
+        ok_(self.gathered.seen[-1].startswith('sed -i.bak -r '),
+            self.gathered.seen[-1])
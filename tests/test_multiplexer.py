@@ -0,0 +1,68 @@
+from __future__ import with_statement
+
+import os
+import sys
+from Queue import Queue
+
+from nose.tools import eq_, ok_
+
+from fabric.api import execute, parallel, run, settings, hide
+from fabric.multiplexer import FrameWriter, HostLog, Multiplexer
+
+from utils import FabricTest, mock_streams
+from server import server
+
+
+def test_frame_writer_sends_whole_lines():
+    queue = Queue()
+    writer = FrameWriter(queue, 'web1', 'stdout')
+    writer.write("one\ntw")
+    writer.write("o\nthr")
+    eq_(queue.get_nowait(), ('web1', 'stdout', "one\n"))
+    eq_(queue.get_nowait(), ('web1', 'stdout', "two\n"))
+    ok_(queue.empty())
+    writer.flush()
+    eq_(queue.get_nowait(), ('web1', 'stdout', "thr"))
+
+
+class TestMultiplexer(FabricTest):
+    def test_host_logs_rotate(self):
+        path = self.path('logs', 'web1.log')
+        log = HostLog(path, max_bytes=10, backups=2)
+        for line in ("first\n", "second\n", "third\n", "fourth\n"):
+            log.write(line)
+        log.close()
+        eq_(open(path).read(), "fourth\n")
+        eq_(open(path + ".1").read(), "third\n")
+        eq_(open(path + ".2").read(), "second\n")
+        ok_(not os.path.exists(path + ".3"))
+
+    @mock_streams('both')
+    def test_console_lines_are_limited(self):
+        queue = Queue()
+        with settings(parallel_console_lines=2, parallel_console_interval=5):
+            multiplexer = Multiplexer(queue)
+        multiplexer.start()
+        queue.put(('web1', 'stdout', "[web1] out: 1\n[web1] out: 2\n"))
+        queue.put(('web1', 'stderr', "[web1] out: 3\n"))
+        multiplexer.stop()
+        eq_(sys.stdout.getvalue(),
+            "[web1] out: 1\n[web1] out: 2\n... 1 line not shown\n")
+        eq_(sys.stderr.getvalue(), "")
+
+    @server(port=2200)
+    @server(port=2201)
+    @mock_streams('stdout')
+    def test_parallel_output_reaches_parent_and_logs(self):
+        @parallel
+        def task():
+            run("ls /simple")
+        hosts = ['127.0.0.1:2200', '127.0.0.1:2201']
+        log = self.path('logs', '%(host)s.log')
+        with settings(parallel_log=log):
+            with hide('status'):
+                execute(task, hosts=hosts)
+        for host in hosts:
+            eq_(open(log % {'host': host}).read(),
+                "run: ls /simple\nout: some output\n")
+            ok_("[%s] out: some output\n" % host in sys.stdout.getvalue())
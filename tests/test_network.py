@@ -4,8 +4,10 @@ from datetime import datetime
 import copy
 import getpass
 import sys
+import threading
+import time
 
-from nose.tools import with_setup, ok_, raises
+from nose.tools import with_setup, eq_, ok_, raises
 from fudge import (Fake, clear_calls, clear_expectations, patch_object, verify,
     with_patched_object, patched_context, with_fakes)
 
@@ -196,6 +198,26 @@ class TestNetwork(FabricTest):
                 # Test
                 ok_(host_string not in hcc)
 
+    def test_connection_cache_connects_once_across_threads(self):
+        """
+        HostConnectionCache connects once to a host looked up by many threads
+        """
+        calls = []
+
+        def slow_connect(*args):
+            calls.append(args)
+            time.sleep(0.1)
+            return object()
+        cache = HostConnectionCache()
+        with patched_context('fabric.network', 'connect', slow_connect):
+            threads = [threading.Thread(target=lambda: cache['localhost'])
+                for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        eq_(len(calls), 1)
+
 
     #
     # Connection loop flow
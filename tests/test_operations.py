@@ -1,5 +1,6 @@
 from __future__ import with_statement
 
+import hashlib
 import os
 import shutil
 import sys
@@ -9,22 +10,33 @@ from StringIO import StringIO
 
 import unittest
 import random
+import socket
+import stat
+import subprocess
+import threading
+import time
 import types
+import zlib
 
 from nose.tools import raises, eq_, ok_
-from fudge import with_patched_object
+from fudge import with_patched_object, patched_context
 
-from fabric.state import env, output
+from fabric.state import env, output, connections
+from fabric.network import ssh
 from fabric.operations import require, prompt, _sudo_prefix, _shell_wrap, \
-    _shell_escape
-from fabric.api import get, put, hide, show, cd, lcd, local, run, sudo, quiet
-from fabric.sftp import SFTP
+    _shell_escape, _compress_wrap, _AttributeString
+from fabric.io import GzipReader, MarkerReader, stdin_loop
+from fabric.api import get, put, hide, show, cd, lcd, local, run, sudo, quiet, \
+    pipe, batch, local_many, settings, run_async, sudo_async, gather, run_all
+import fabric.sftp
+from fabric.sftp import SFTP, finalize_script, parse_failures
 from fabric.exceptions import CommandTimeout
 
 from fabric.decorators import with_settings
 from utils import *
 from server import (server, PORT, RESPONSES, FILES, PASSWORDS, CLIENT_PRIVKEY,
-    USER, CLIENT_PRIVKEY_PASSPHRASE)
+    USER, CLIENT_PRIVKEY_PASSPHRASE, local_process)
+from fake_filesystem import FakeFilesystem
 
 #
 # require()
@@ -419,6 +431,508 @@ class TestRun(FabricTest):
             sudo("slow", timeout=2)
 
 
+#
+# run(compress=True)
+#
+
+def _gzip(text):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+LOG = "".join("Jan 01 00:00:%02d host sshd[1]: line %d\n" % (x % 60, x)
+    for x in range(500))
+
+
+def test_gzip_reader_only_returns_empty_string_at_end_of_stream():
+    """
+    GzipReader doesn't mistake not-yet-decompressible chunks for EOF
+    """
+    chunks = list(_gzip(LOG))
+    chunks.reverse()
+    reader = GzipReader(lambda size: chunks.pop() if chunks else "")
+    result = []
+    while True:
+        data = reader(4096)
+        if data == "":
+            break
+        result.append(data)
+    eq_("".join(result), LOG)
+
+
+def test_compress_wrap_preserves_exit_status():
+    """
+    _compress_wrap() exits with the wrapped command's status, not gzip's
+    """
+    cmd = _compress_wrap("echo foo; echo bar >&2; exit 3", combine_stderr=True)
+    p = subprocess.Popen(['/bin/sh', '-c', cmd], stdout=subprocess.PIPE)
+    stdout = p.communicate()[0]
+    eq_(p.returncode, 3)
+    eq_(zlib.decompress(stdout, 16 + zlib.MAX_WBITS), "foo\nbar\n")
+
+
+def test_compress_wrap_fails_without_gzip():
+    """
+    _compress_wrap() exits with gzip's status when gzip itself fails
+    """
+    cmd = _compress_wrap("exit 0", combine_stderr=True)
+    p = subprocess.Popen(['/bin/sh', '-c', cmd], stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, env={'PATH': '/nonexistent'})
+    p.communicate()
+    eq_(p.returncode, 127)
+
+
+@raises(IOError)
+def test_gzip_reader_refuses_truncated_streams():
+    chunks = [_gzip(LOG)[:-8], ""]
+    reader = GzipReader(lambda size: chunks.pop(0) if chunks else "")
+    while reader(4096):
+        pass
+
+
+class TestCompressedOutput(FabricTest):
+    @server(responses={_compress_wrap('cat app.log', True): _gzip(LOG)})
+    def test_run_compress_returns_decompressed_output(self):
+        with hide('everything'):
+            eq_(run('cat app.log', compress=True), LOG.strip())
+
+    @server(responses={_compress_wrap('cat app.log', True): _gzip(LOG)})
+    @mock_streams('stdout')
+    def test_run_compress_prints_decompressed_output(self):
+        with hide('running'):
+            run('cat app.log', compress=True)
+        assert "[%s] out: Jan 01 00:00:09 host sshd[1]: line 69\n" % (
+            env.host_string) in sys.stdout.getvalue()
+
+    @server(responses={_compress_wrap('cat app.log', False): _gzip(LOG)})
+    def test_run_compress_honors_combine_stderr(self):
+        with hide('everything'):
+            result = run('cat app.log', compress=True, combine_stderr=False)
+        eq_(result, LOG.strip())
+        eq_(result.real_command, _compress_wrap('cat app.log', False))
+
+
+@aborts
+def test_sudo_compress_needs_a_shell():
+    with settings(host_string='localhost'):
+        sudo('cat app.log', compress=True, shell=False)
+
+
+@aborts
+def test_sudo_compress_needs_env_use_shell():
+    with settings(host_string='localhost', use_shell=False):
+        sudo('cat app.log', compress=True)
+
+
+
+#
+# run(stdin=...)
+#
+
+def _read_stdin(channel):
+    data = []
+    while True:
+        chunk = channel.recv(65535)
+        if not chunk:
+            return "".join(data)
+        data.append(chunk)
+
+
+def _echo_stdin(marker=None):
+    """
+    Server response echoing the client's stdin back, like 'cat' would.
+
+    ``marker`` is sent on stderr first, as a sudo'd command would.
+    """
+    def respond(channel):
+        if marker is not None:
+            channel.send_stderr(marker)
+        return _read_stdin(channel)
+    return respond
+
+
+class FakeStdinChannel(object):
+    def __init__(self, exited=False):
+        self.sent = []
+        self.eof = False
+        self.exited = exited
+        self.closed = False
+
+    def sendall(self, data):
+        if self.exited:
+            raise socket.error("Socket is closed")
+        self.sent.append(data)
+
+    def shutdown_write(self):
+        self.eof = True
+
+    def exit_status_ready(self):
+        return self.exited
+
+
+def test_stdin_loop_streams_file_objects_then_sends_eof():
+    chan = FakeStdinChannel()
+    stdin_loop(chan, StringIO("x" * 10), chunk_size=4)
+    eq_(chan.sent, ["xxxx", "xxxx", "xx"])
+    ok_(chan.eof)
+
+
+def test_stdin_loop_streams_iterables():
+    chan = FakeStdinChannel()
+    stdin_loop(chan, (str(x) for x in range(3)))
+    eq_(chan.sent, ["0", "1", "2"])
+    ok_(chan.eof)
+
+
+def test_stdin_loop_tolerates_remote_exiting_early():
+    chan = FakeStdinChannel(exited=True)
+    stdin_loop(chan, ["data"])
+    ok_(not chan.eof)
+
+
+def test_stdin_loop_waits_for_ready_event():
+    chan = FakeStdinChannel()
+    ready = threading.Event()
+    worker = threading.Thread(target=stdin_loop, args=(chan, ["data"], ready))
+    worker.start()
+    worker.join(0.2)
+    eq_(chan.sent, [])
+    ready.set()
+    worker.join()
+    eq_(chan.sent, ["data"])
+
+
+def test_marker_reader_removes_marker_split_across_reads():
+    chunks = ["sudo password:", "\nMAR", "KER", "output"]
+    chunks.reverse()
+    event = threading.Event()
+    reader = MarkerReader(lambda size: chunks.pop() if chunks else "",
+        "MARKER", event)
+    result = []
+    while True:
+        data = reader(4096)
+        if data == "":
+            break
+        result.append(data)
+    eq_("".join(result), "sudo password:\noutput")
+    ok_(event.isSet())
+
+
+class TestStdin(FabricTest):
+    @server(responses={'cat': _echo_stdin()})
+    def test_run_streams_file_object_to_stdin(self):
+        with hide('everything'):
+            eq_(run('cat', stdin=StringIO(LOG)), LOG.strip())
+
+    @server(responses={'cat': _echo_stdin()})
+    def test_run_streams_iterable_to_stdin(self):
+        with hide('everything'):
+            eq_(run('cat', stdin=iter(["foo\n", "bar\n"])), "foo\nbar")
+
+    @server(responses={'/bin/bash -l -c "printf MARKER >&2; cat"':
+        _echo_stdin("MARKER")})
+    @with_patched_object('fabric.operations', '_stdin_marker',
+        lambda: "MARKER")
+    def test_sudo_streams_stdin_after_password_prompt(self):
+        with settings(hide('everything'), use_shell=True):
+            # Password must be handed to sudo, and not end up in the data.
+            with password_response(PASSWORDS[USER], times_called=1):
+                eq_(sudo('cat', stdin=StringIO("payload")), "payload")
+
+
+#
+# pipe()
+#
+
+DUMP = "".join("INSERT INTO users VALUES (%d);\n" % i for i in xrange(500))
+
+
+def _count_stdin(channel):
+    return str(len(_read_stdin(channel)))
+
+
+class TestPipe(FabricTest):
+    # The test server handles one command per connection at a time, so talk
+    # to it under a second host string for the destination end.
+    dst = '%s@localhost:%s' % (USER, PORT)
+
+    @server(responses={'pg_dump app': DUMP, 'wc -c': _count_stdin})
+    def test_pipe_streams_source_stdout_into_destination(self):
+        with hide('everything'):
+            result = pipe(src=(env.host_string, 'pg_dump app'),
+                dst=(self.dst, 'wc -c'))
+        eq_(result, str(len(DUMP)))
+        eq_(result.bytes, len(DUMP))
+        eq_(result.src_return_code, 0)
+        ok_(result.succeeded)
+        ok_(result.elapsed > 0)
+
+    @server(responses={'pg_dump app': DUMP, 'wc -c': _count_stdin})
+    def test_pipe_buffers_are_bounded(self):
+        with hide('everything'):
+            result = pipe((env.host_string, 'pg_dump app'),
+                (self.dst, 'wc -c'), max_buffer=1)
+        eq_(result.bytes, len(DUMP))
+
+    @server(responses={'pg_dump app': ['', 'no such database', 1],
+        'wc -c': _count_stdin})
+    def test_pipe_source_failures_abort(self):
+        with hide('everything', 'aborts'):
+            with settings(warn_only=True):
+                result = pipe((env.host_string, 'pg_dump app'),
+                    (self.dst, 'wc -c'))
+            ok_(result.failed)
+            eq_(result.src_return_code, 1)
+            eq_(result.src_stderr, 'no such database')
+            eq_(result.bytes, 0)
+            try:
+                pipe((env.host_string, 'pg_dump app'),
+                    (self.dst, 'wc -c'))
+            except SystemExit:
+                pass
+            else:
+                assert False, "pipe() didn't abort on source failure"
+
+    @server(responses={'pg_dump app': [DUMP, '', 0, 1],
+        'true': ''})
+    def test_pipe_tolerates_destination_not_reading(self):
+        with hide('everything'):
+            result = pipe((env.host_string, 'pg_dump app'),
+                (self.dst, 'true'), max_buffer=1)
+        ok_(result.succeeded)
+        eq_(result.src_return_code, None)
+
+
+#
+# batch()
+#
+
+# sudo -S -p <prompt> <command...>, as far as the tests are concerned.
+FAKE_SUDO = """sudo() {
+    printf '%%s' "$3" >&2
+    IFS= read -r pw
+    [ "$pw" = '%s' ] || { echo 'Sorry, try again.' >&2; return 1; }
+    shift 3
+    "$@"
+}
+""" % PASSWORDS[USER]
+
+
+class LocalCommands(dict):
+    """
+    Server responses running any command given through the local /bin/sh.
+    """
+    def __init__(self):
+        self.seen = []
+
+    def __contains__(self, command):
+        return True
+
+    def __getitem__(self, command):
+        self.seen.append(command)
+        return local_process(['/bin/sh', '-c', FAKE_SUDO + command])
+
+
+SLOW = {
+    'sleep one': ['one', '', 0, 1],
+    'sleep two': ['two', '', 0, 1],
+    'fail slowly': ['', 'oops', 2, 1],
+}
+
+
+class TestAsync(FabricTest):
+    @server(responses=SLOW)
+    def test_commands_overlap_on_one_connection(self):
+        start = time.time()
+        with hide('everything'):
+            results = gather(run_async("sleep one"), run_async("sleep two"))
+        ok_(time.time() - start < 2.5)
+        eq_(results, ["one", "two"])
+        eq_(results[0].command, "sleep one")
+        ok_(results[0].succeeded)
+        eq_(len(connections), 1)
+
+    @server(responses=SLOW)
+    def test_sudo_async(self):
+        with hide('everything'):
+            future = sudo_async("sleep one")
+            eq_(future.result(), "one")
+        ok_(future.done())
+
+    @server(responses=SLOW)
+    def test_failure_aborts_when_result_is_fetched(self):
+        with hide('everything', 'aborts'):
+            future = run_async("fail slowly")
+            try:
+                future.result()
+            except SystemExit:
+                pass
+            else:
+                assert False, "Failed command didn't abort"
+
+    @server(responses=SLOW)
+    def test_warn_only_applies_as_of_start(self):
+        with hide('everything'):
+            with settings(warn_only=True):
+                future = run_async("fail slowly")
+            result = future.result()
+        eq_(result.return_code, 2)
+        ok_(result.failed)
+
+    @server(responses=SLOW)
+    def test_gather_lets_all_commands_finish_before_aborting(self):
+        with hide('everything', 'aborts'):
+            failing = run_async("fail slowly")
+            other = run_async("sleep one")
+            try:
+                gather(failing, other)
+            except SystemExit:
+                pass
+            else:
+                assert False, "Failed command didn't abort"
+        ok_(other.done())
+        eq_(other.result(), "one")
+
+
+class TestRunAll(FabricTest):
+    def setup(self):
+        super(TestRunAll, self).setup()
+        self.hosts = [env.host_string, '%s@localhost:%s' % (USER, PORT)]
+
+    @server(responses=SLOW)
+    @mock_streams('stdout')
+    def test_runs_on_all_hosts_at_once(self):
+        start = time.time()
+        with hide('running'):
+            results = run_all("sleep one", hosts=self.hosts)
+        ok_(time.time() - start < 2.5)
+        eq_(sorted(results.keys()), sorted(self.hosts))
+        for host in self.hosts:
+            eq_(results[host], "one")
+            eq_(results[host].return_code, 0)
+            ok_(results[host].elapsed >= 1)
+        eq_(results.failed, [])
+        table = sys.stdout.getvalue().splitlines()
+        eq_(len(table), 3)
+        ok_(table[1].startswith(self.hosts[0]))
+        ok_(table[1].endswith("one"))
+
+    @server(responses=SLOW)
+    def test_failures_are_collected_then_abort(self):
+        unreachable = '%s@127.0.0.1:1' % USER
+        hosts = self.hosts + [unreachable]
+        with hide('everything'):
+            with settings(warn_only=True):
+                results = run_all("fail slowly", hosts=hosts)
+        eq_(results.failed, hosts)
+        eq_(results[self.hosts[0]].return_code, 2)
+        eq_(results[self.hosts[0]], "oops")
+        eq_(results[unreachable].return_code, None)
+        eq_(results[unreachable].status, "error")
+        with hide('everything', 'aborts'):
+            try:
+                run_all("fail slowly", hosts=self.hosts)
+            except SystemExit:
+                pass
+            else:
+                assert False, "Failures didn't abort"
+
+    @server(responses=SLOW)
+    def test_timeouts(self):
+        with hide('everything'):
+            with settings(warn_only=True):
+                results = run_all("sleep one", hosts=self.hosts[:1],
+                    timeout=0.3)
+        eq_(results[self.hosts[0]].status, "timeout")
+        ok_(results[self.hosts[0]].failed)
+
+
+class TestBatch(FabricTest):
+    commands = LocalCommands()
+
+    def env_setup(self):
+        super(TestBatch, self).env_setup()
+        del self.commands.seen[:]
+
+    @server(responses=commands)
+    def test_batched_commands_share_one_round_trip(self):
+        with hide('everything'):
+            with batch():
+                one = run("echo one")
+                two = run("echo two; echo err >&2", combine_stderr=False)
+                three = sudo("echo three")
+        eq_(len(self.commands.seen), 1)
+        eq_(one, "one")
+        eq_(two, "two")
+        eq_(two.stderr, "err")
+        eq_(three, "three")
+        ok_(three.succeeded)
+        eq_(three.command, "echo three")
+
+    @server(responses=commands)
+    def test_results_are_unavailable_within_the_block(self):
+        with hide('everything'):
+            with batch():
+                result = run("echo one")
+                try:
+                    str(result)
+                except ValueError:
+                    pass
+                else:
+                    assert False, "Result was available too early"
+        eq_(result, "one")
+
+    @server(responses=commands)
+    def test_failures_abort_in_order(self):
+        before, after = self.path('before'), self.path('after')
+        with hide('everything', 'aborts'):
+            try:
+                with batch():
+                    first = run("touch %s" % before)
+                    run("exit 3")
+                    run("touch %s" % after)
+            except SystemExit:
+                pass
+            else:
+                assert False, "Didn't abort"
+        ok_(first.succeeded)
+        ok_(os.path.exists(before))
+        ok_(not os.path.exists(after))
+
+    @server(responses=commands)
+    def test_warn_only_commands_do_not_stop_the_batch(self):
+        with hide('everything'):
+            with batch():
+                failed = run("exit 3", warn_only=True)
+                with settings(ok_ret_codes=[0, 4]):
+                    ok = run("exit 4")
+                last = run("echo done")
+        eq_(failed.return_code, 3)
+        ok_(failed.failed)
+        ok_(ok.succeeded)
+        eq_(last, "done")
+
+    @server(responses=commands)
+    def test_prefixes_and_output_settings_apply_per_command(self):
+        stdout = StringIO()
+        with batch():
+            with cd('/'):
+                where = run("pwd", stdout=stdout)
+            with hide('everything'):
+                run("echo hidden", stdout=stdout)
+        eq_(where, "/")
+        eq_(stdout.getvalue(), "[%s] out: /\n" % env.host_string)
+
+    @server(responses=commands)
+    def test_unbatchable_calls_flush_first(self):
+        with hide('everything'):
+            with batch():
+                first = run("echo first")
+                second = run("cat", stdin=StringIO("second"))
+                eq_(first, "first")
+                eq_(second, "second")
+        eq_(len(self.commands.seen), 2)
+
+
 #
 # get() and put()
 #
@@ -489,6 +1003,56 @@ class TestFileTransfers(FabricTest):
         for path, contents in leaves:
             eq_contents(self.path(path[1:]), contents)
 
+    @server()
+    def test_walk_needs_one_request_per_directory(self):
+        """
+        SFTP.walk() lists each directory once, and stats nothing
+        """
+        listed = []
+        listdir_attr = ssh.SFTPClient.listdir_attr
+
+        def counted(self, path='.'):
+            listed.append(path)
+            return listdir_attr(self, path)
+
+        def lstat(self, path):
+            raise AssertionError("walk() shouldn't stat %s" % path)
+        with patched_context(ssh.SFTPClient, 'listdir_attr', counted):
+            with patched_context(ssh.SFTPClient, 'lstat', lstat):
+                walked = [(top, sorted(dirs), sorted(files)) for top, dirs, files
+                    in SFTP(env.host_string).walk('/tree')]
+        eq_(walked, [
+            ('/tree', ['subfolder'], ['file1.txt', 'file2.txt']),
+            ('/tree/subfolder', [], ['file3.txt']),
+        ])
+        eq_(sorted(listed), ['/tree', '/tree/subfolder'])
+
+    @server()
+    def test_walk_attr_returns_attributes(self):
+        """
+        SFTP.walk_attr() yields each directory's entries' attributes too
+        """
+        walked = list(SFTP(env.host_string).walk_attr('/tree'))
+        eq_(walked[0][3]['file1.txt'].st_size, 1)
+        ok_(stat.S_ISDIR(walked[0][3]['subfolder'].st_mode))
+
+    @server()
+    def test_get_tree_concurrently(self):
+        """
+        Download entire tree over several SFTP channels
+        """
+        with hide('everything'):
+            with settings(sftp_channels=3):
+                retval = get('tree', self.tmpdir)
+        eq_(sorted(retval), sorted([
+            self.path('tree', 'file1.txt'),
+            self.path('tree', 'file2.txt'),
+            self.path('tree', 'subfolder', 'file3.txt'),
+        ]))
+        leaves = filter(lambda x: x[0].startswith('/tree'), FILES.items())
+        for path, contents in leaves:
+            eq_contents(self.path(path[1:]), contents)
+
     @server()
     def test_get_tree_with_implicit_local_path(self):
         """
@@ -875,6 +1439,507 @@ class TestFileTransfers(FabricTest):
             get('/foo[bar].txt', local2)
         eq_contents(local2, text)
 
+    def _make_tree(self):
+        for i in range(3):
+            os.makedirs(self.path('tree', 'sub%d' % i))
+            for j in range(4):
+                self.mkfile(os.path.join('tree', 'sub%d' % i, '%d.txt' % j),
+                    "%d/%d" % (i, j))
+        os.mkdir(self.path('tree', 'empty'))
+        return self.path('tree')
+
+    @server()
+    def test_put_dir_uploads_concurrently_in_order(self):
+        """
+        put() of a directory returns the same paths, in the same order, however
+        many SFTP channels are used
+        """
+        tree = self._make_tree()
+        with hide('everything'):
+            with settings(sftp_channels=1):
+                serial = put(tree, '/tree1')
+            with settings(sftp_channels=4):
+                concurrent = put(tree, '/tree4')
+        eq_(len(serial), 12)
+        eq_([p.replace('/tree1', '/tree4', 1) for p in serial], concurrent)
+        ok_(self.exists_remotely('/tree4/tree/empty'))
+        local = self.path('downloaded.txt')
+        with hide('everything'):
+            get('/tree4/tree/sub2/3.txt', local)
+        eq_contents(local, "2/3")
+
+    @server()
+    def test_put_dir_failures_are_reported(self):
+        """
+        A file failing to upload makes put() report its directory as failed
+        """
+        tree = self._make_tree()
+        os.symlink(self.path('nonexistent'), os.path.join(tree, 'sub1', 'x'))
+        with settings(hide('everything'), warn_only=True):
+            retval = put(tree, '/tree5')
+        eq_(retval.failed, [tree])
+
+    @server()
+    def test_put_sync_skips_unchanged_files(self):
+        """
+        put(sync=True) only uploads files whose size or mtime changed
+        """
+        tree = self._make_tree()
+        with hide('everything'):
+            first = put(tree, '/sync1', sync=True)
+            second = put(tree, '/sync1', sync=True)
+            changed = os.path.join(tree, 'sub0', '1.txt')
+            with open(changed, 'w') as fd:
+                fd.write("changed")
+            third = put(tree, '/sync1', sync=True)
+        eq_(len(first), 12)
+        eq_(second, [])
+        eq_(sorted(second.skipped), sorted(first))
+        eq_(third, ['/sync1/tree/sub0/1.txt'])
+        eq_(len(third.skipped), 11)
+
+    @server()
+    def test_put_sync_deletes_extraneous_remote_files(self):
+        """
+        put(sync=True, delete=True) removes remote paths missing locally
+        """
+        tree = self._make_tree()
+        with hide('everything'):
+            put(tree, '/sync2', sync=True)
+            put(StringIO("stale"), '/sync2/tree/sub1/stale.txt')
+            shutil.rmtree(os.path.join(tree, 'sub2'))
+            retval = put(tree, '/sync2', sync=True, delete=True)
+        eq_(retval, [])
+        eq_(sorted(retval.deleted), [
+            '/sync2/tree/sub1/stale.txt',
+            '/sync2/tree/sub2',
+            '/sync2/tree/sub2/0.txt',
+            '/sync2/tree/sub2/1.txt',
+            '/sync2/tree/sub2/2.txt',
+            '/sync2/tree/sub2/3.txt',
+        ])
+        ok_(not self.exists_remotely('/sync2/tree/sub1/stale.txt'))
+        ok_(self.exists_remotely('/sync2/tree/sub1/0.txt'))
+
+    @server(responses={
+        "sha1sum -- '/sync3.txt'":
+            "a9993e364706816aba3e25717850c26c9cd0d89d  /sync3.txt"
+    })
+    def test_put_sync_with_checksum_ignores_mtime(self):
+        """
+        put(sync=True, checksum=True) compares hashes instead of mtimes
+        """
+        local = self.mkfile('sync3.txt', 'abc')
+        with hide('everything'):
+            put(local, '/sync3.txt', sync=True)
+            os.utime(local, (0, 0))
+            eq_(put(local, '/sync3.txt', sync=True, checksum=True), [])
+            eq_(put(local, '/sync3.txt', sync=True), ['/sync3.txt'])
+
+    @server(responses={
+        "sha1sum -- '/sync4/tree/same.txt'":
+            "a9993e364706816aba3e25717850c26c9cd0d89d  /sync4/tree/same.txt"
+    })
+    def test_put_dir_sync_with_checksum_ignores_mtime(self):
+        """
+        put(dir, sync=True, checksum=True) uploads changes mtimes don't show
+        """
+        tree = self.path('tree')
+        os.mkdir(tree)
+        local = self.mkfile(os.path.join('tree', 'same.txt'), 'abc')
+        with hide('everything'):
+            put(tree, '/sync4', sync=True)
+            # Same size and mtime as the remote copy, different content
+            mtime = os.stat(local).st_mtime
+            with open(local, 'w') as fd:
+                fd.write('xyz')
+            os.utime(local, (mtime, mtime))
+            retval = put(tree, '/sync4', sync=True, checksum=True)
+            remote = StringIO()
+            get('/sync4/tree/same.txt', remote)
+        eq_(retval, ['/sync4/tree/same.txt'])
+        eq_(remote.getvalue(), 'xyz')
+
+    @server(responses={
+        "sha1sum -- '/sync5a.txt' '/sync5b.txt'":
+            "86f7e437faa5a7fce15d1ddcb9eaeaea377667b8  /sync5a.txt\n"
+            "e9d71f5ee7c92d6dc9e92ffdad17b8bd49418f98  /sync5b.txt"
+    })
+    def test_put_sync_with_checksum_hashes_at_once(self):
+        """
+        put(glob, sync=True, checksum=True) fetches remote hashes in one go
+        """
+        self.mkfile('sync5a.txt', 'a')
+        self.mkfile('sync5b.txt', 'b')
+        with hide('everything'):
+            put(StringIO('x'), '/sync5a.txt')
+            put(StringIO('y'), '/sync5b.txt')
+            retval = put(self.path('sync5*.txt'), '/', sync=True,
+                checksum=True)
+        eq_(retval, [])
+        eq_(sorted(retval.skipped), ['/sync5a.txt', '/sync5b.txt'])
+
+    @server()
+    def test_put_sync_lists_each_remote_directory_once(self):
+        """
+        put(glob, sync=True) looks remote files up without a stat per file
+        """
+        for name in ('sync6a.txt', 'sync6b.txt', 'sync6c.txt'):
+            self.mkfile(name, name)
+        with hide('everything'):
+            put(self.path('sync6*.txt'), '/', sync=True)
+            lstats = []
+            original = ssh.SFTPClient.lstat
+            def lstat(client, path):
+                lstats.append(path)
+                return original(client, path)
+            with patched_context(ssh.SFTPClient, 'lstat', lstat):
+                retval = put(self.path('sync6*.txt'), '/', sync=True)
+        eq_(retval, [])
+        eq_(len(retval.skipped), 3)
+        # Only the target directory itself is looked up
+        eq_(set(lstats), set(['/']))
+
+    @server()
+    def test_lstat_many_gives_none_for_missing_paths(self):
+        """
+        SFTP.lstat_many() maps missing files and directories to None
+        """
+        with hide('everything'):
+            put(StringIO('abc'), '/lstat1.txt')
+        attrs = SFTP(env.host_string).lstat_many(
+            ['/lstat1.txt', '/lstat2.txt', '/nowhere/lstat3.txt'])
+        eq_(attrs['/lstat1.txt'].st_size, 3)
+        eq_(attrs['/lstat2.txt'], None)
+        eq_(attrs['/nowhere/lstat3.txt'], None)
+
+    @server(responses={
+        "head -c 5000 -- '/resume1.bin.fabric-partial' | sha1sum":
+            hashlib.sha1("a" * 5000).hexdigest() + "  -"
+    })
+    def test_put_resume_continues_partial_upload(self):
+        """
+        put(resume=True) carries on from a partial upload whose prefix matches
+        """
+        local = self.mkfile('resume1.bin', "a" * 10000 + "b" * 10000)
+        remote = StringIO()
+        with hide('everything'):
+            # Stands in for what an earlier upload got through
+            put(StringIO("X" * 5000), '/resume1.bin.fabric-partial')
+            eq_(put(local, '/resume1.bin', resume=True), ['/resume1.bin'])
+            get('/resume1.bin', remote)
+        # Only the rest of the file was sent
+        eq_(remote.getvalue(), "X" * 5000 + "a" * 5000 + "b" * 10000)
+        ok_(not self.exists_remotely('/resume1.bin.fabric-partial'))
+
+    # Each connection to the test server sees the files it started with, so
+    # the partial file must exist up front to survive reconnecting.
+    @server(files=FakeFilesystem(dict(FILES,
+        **{'/resume2.bin.fabric-partial': ''})), responses={
+        "head -c 32768 -- '/resume2.bin.fabric-partial' | sha1sum":
+            hashlib.sha1("a" * 32768).hexdigest() + "  -"
+    })
+    def test_put_resume_reconnects_after_connection_drops(self):
+        """
+        put(resume=True) reconnects and resumes when the connection drops
+        """
+        data = "a" * 50000 + "b" * 50000
+        local = self.mkfile('resume2.bin', data)
+        write = ssh.SFTPFile.write
+        calls = []
+
+        def flaky_write(self, block):
+            calls.append(len(block))
+            if len(calls) == 2:
+                raise socket.error("Connection reset by peer")
+            return write(self, block)
+        remote = StringIO()
+        with hide('everything'):
+            with patched_context(ssh.SFTPFile, 'write', flaky_write):
+                put(local, '/resume2.bin', resume=True)
+            get('/resume2.bin', remote)
+        eq_(remote.getvalue(), data)
+        # The first block wasn't sent again
+        eq_(sum(calls), len(data) + 32768)
+
+    @server(responses={
+        "head -c 5000 -- '/resume3.bin' | sha1sum":
+            hashlib.sha1("X" * 5000).hexdigest() + "  -"
+    })
+    def test_get_resume_continues_partial_download(self):
+        """
+        get(resume=True) carries on from a matching partial download, and
+        starts over otherwise
+        """
+        data = "a" * 10000 + "b" * 10000
+        local = self.path('resume3.bin')
+        with hide('everything'):
+            put(StringIO(data), '/resume3.bin')
+            self.mkfile('resume3.bin.fabric-partial', "X" * 5000)
+            eq_(get('/resume3.bin', local, resume=True), [local])
+            eq_contents(local, "X" * 5000 + data[5000:])
+            # No matching hash for this prefix
+            self.mkfile('resume3.bin.fabric-partial', "X" * 4000)
+            get('/resume3.bin', local, resume=True)
+        eq_contents(local, data)
+        ok_(not os.path.exists(local + '.fabric-partial'))
+
+    @server()
+    def test_transfer_tuning_settings(self):
+        """
+        put() and get() work with any chunk size, requests in flight and
+        window size
+        """
+        data = "".join(chr(random.randrange(256)) for i in range(20000))
+        for chunk, requests, window in ((32768, 64, None), (1000, 3, 4096),
+            (1000, 1, None)):
+            remote = StringIO()
+            with settings(hide('everything'), sftp_chunk_size=chunk,
+                sftp_max_requests=requests, sftp_window_size=window,
+                sftp_max_packet_size=window):
+                put(StringIO(data), '/tuned.bin')
+                get('/tuned.bin', remote)
+            eq_(remote.getvalue(), data)
+
+    @server()
+    def test_put_bounds_writes_in_flight(self):
+        """
+        put() waits for acknowledgements past env.sftp_max_requests writes
+        """
+        pipelined = []
+        write = ssh.SFTPFile.write
+
+        def recording_write(self, data):
+            pipelined.append(self.pipelined)
+            return write(self, data)
+        with settings(hide('everything'), sftp_chunk_size=1000,
+            sftp_max_requests=4):
+            with patched_context(ssh.SFTPFile, 'write', recording_write):
+                put(StringIO("x" * 50000), '/bounded.bin')
+        eq_(len(pipelined), 50)
+        # Every fourth write waits for all acknowledgements so far
+        eq_(pipelined[:8], [True, True, True, False] * 2)
+
+    @server()
+    def test_transfers_share_one_sftp_session(self):
+        """
+        put() and get() reuse one SFTP session and home directory lookup
+        """
+        opened, normalized = [], []
+        open_sftp = fabric.sftp.open_sftp
+        normalize = ssh.SFTPClient.normalize
+
+        def counting_open(client):
+            opened.append(client)
+            return open_sftp(client)
+
+        def counting_normalize(self, path):
+            normalized.append(path)
+            return normalize(self, path)
+        with hide('everything'):
+            with nested(
+                patched_context(fabric.sftp, 'open_sftp', counting_open),
+                patched_context(ssh.SFTPClient, 'normalize',
+                    counting_normalize)
+            ):
+                for i in range(3):
+                    put(StringIO("x"), '/shared%d' % i)
+                    get('/shared%d' % i, StringIO())
+                eq_((len(opened), normalized), (1, ['.']))
+                # A new connection means new sessions
+                connections.connect(env.host_string)
+                put(StringIO("x"), '/shared')
+        eq_(len(opened), 2)
+
+    @server()
+    def test_sftp_sessions_are_not_shared_while_in_use(self):
+        """
+        SFTP objects in use at the same time get sessions of their own
+        """
+        first, second = SFTP(env.host_string), SFTP(env.host_string)
+        ok_(first.ftp is not second.ftp)
+        session = first.ftp
+        first.close()
+        third = SFTP(env.host_string)
+        ok_(third.ftp is session)
+        second.close()
+        third.close()
+
+    @server()
+    def test_sftp_reconnect_closes_old_session(self):
+        """
+        SFTP.reconnect() closes the session it replaces
+        """
+        sftp = SFTP(env.host_string)
+        old = sftp.ftp
+        sftp.reconnect()
+        ok_(old.sock.closed)
+        ok_(sftp.ftp is not old)
+        sftp.close()
+
+    @server()
+    def test_sftp_reconnects_share_one_new_connection(self):
+        """
+        SFTP.reconnect() leaves a connection another reconnect replaced alone
+        """
+        first, second = SFTP(env.host_string), SFTP(env.host_string)
+        first.reconnect()
+        second.reconnect()
+        ok_(first.client is second.client)
+        ok_(second.client is connections[env.host_string])
+        first.close()
+        second.close()
+
+    @server()
+    def test_mkdirs_with_sudo_uses_one_command(self):
+        """
+        SFTP.mkdirs(use_sudo=True) creates all directories with one sudo call
+        """
+        commands = []
+        fake_sudo = lambda command, **kwargs: commands.append(command)
+        with settings(hide('everything')):
+            with patched_context('fabric.api', 'sudo', fake_sudo):
+                SFTP(env.host_string).mkdirs(['/a', '/a/b c', '/$x`y`'],
+                    True)
+        eq_(commands, ["mkdir -p -- '/a' '/a/b c' '/$x`y`'"])
+
+    def test_finalize_script_reports_failures_per_file(self):
+        """
+        finalize_script() moves what it can, and reports the rest
+        """
+        staging = self.path('staging')
+        os.mkdir(staging)
+        for name in ('a', 'b', 'c'):
+            self.mkfile(os.path.join('staging', name), name)
+        self.mkfile('blocker', '')
+        script = finalize_script(staging, [self.path('out', 'sub')], [
+            (os.path.join(staging, 'a'), self.path('out', 'sub', 'a'), 0750),
+            (os.path.join(staging, 'b'), self.path('blocker', 'b'), None),
+            (os.path.join(staging, 'c'), self.path('out', "it's c"), None),
+        ])
+        path = self.mkfile(os.path.join('staging', 'finalize.sh'), script)
+        process = subprocess.Popen(['sh', path], stdout=subprocess.PIPE,
+            env=dict(os.environ, LC_ALL='C'))
+        failures = parse_failures(process.communicate()[0])
+        eq_(process.returncode, 1)
+        eq_(failures.keys(), [1])
+        ok_('Not a directory' in failures[1], failures[1])
+        eq_contents(self.path('out', 'sub', 'a'), 'a')
+        eq_(os.stat(self.path('out', 'sub', 'a')).st_mode & 07777, 0750)
+        eq_contents(self.path('out', "it's c"), 'c')
+        # Only the file which couldn't be moved is left behind
+        eq_(os.listdir(staging), ['b'])
+
+    @server()
+    def test_put_dir_with_sudo_finalizes_with_one_command(self):
+        """
+        put(use_sudo=True) moves a whole tree into place with one sudo call
+        """
+        tree = self.path('tree')
+        os.makedirs(os.path.join(tree, 'sub'))
+        self.mkfile(os.path.join('tree', 'one'), 'one')
+        self.mkfile(os.path.join('tree', 'sub', 'two'), 'two')
+        commands, scripts = [], []
+
+        def fake_sudo(command, **kwargs):
+            commands.append(command)
+            script = StringIO()
+            get(command.split(' ', 1)[1].strip("'"), script)
+            scripts.append(script.getvalue())
+            result = _AttributeString("failed 1 mv: Permission denied\r\n")
+            result.failed = True
+            return result
+        with settings(hide('everything'), warn_only=True):
+            with patched_context('fabric.api', 'sudo', fake_sudo):
+                result = put(tree, '/srv', use_sudo=True, mode=0640)
+        eq_(len(commands), 1)
+        ok_(commands[0].startswith('sh '))
+        ok_("mkdir -p -- '/srv/tree' '/srv/tree/sub'\n" in scripts[0])
+        ok_(" '/srv/tree/one' 640\n" in scripts[0])
+        eq_(result, ['/srv/tree/one'])
+        eq_(result.failed, [os.path.join(tree, 'sub', 'two')])
+
+    @server()
+    def test_put_dir_with_sudo_syncs_changed_files_only(self):
+        """
+        put(use_sudo=True, sync=True) only moves changed files into place
+        """
+        tree = self.path('tree')
+        os.makedirs(os.path.join(tree, 'sub'))
+        self.mkfile(os.path.join('tree', 'one'), 'one')
+        two = self.mkfile(os.path.join('tree', 'sub', 'two'), 'two')
+        scripts = []
+
+        def fake_sudo(command, **kwargs):
+            if command.startswith('sha1sum '):
+                return _AttributeString(
+                    "%s  /sync6/tree/one\n%s  /sync6/tree/sub/two" % (
+                    hashlib.sha1("one").hexdigest(),
+                    hashlib.sha1("two").hexdigest()))
+            script = StringIO()
+            get(command.split(' ', 1)[1].strip("'"), script)
+            scripts.append(script.getvalue())
+            result = _AttributeString("")
+            result.failed = False
+            return result
+        with hide('everything'):
+            put(tree, '/sync6', sync=True)
+            # Same size and mtime as the remote copy, different content
+            mtime = os.stat(two).st_mtime
+            with open(two, 'w') as fd:
+                fd.write('TWO')
+            os.utime(two, (mtime, mtime))
+            with patched_context('fabric.api', 'sudo', fake_sudo):
+                result = put(tree, '/sync6', use_sudo=True, sync=True,
+                    checksum=True)
+        eq_(result, ['/sync6/tree/sub/two'])
+        eq_(result.skipped, ['/sync6/tree/one'])
+        eq_(len(scripts), 1)
+        ok_(" '/sync6/tree/sub/two' " in scripts[0])
+        ok_("'/sync6/tree/one'" not in scripts[0])
+
+    @server(responses={
+        "sha256sum -- '/verify1.txt' '/verify2.txt'":
+            hashlib.sha256("one").hexdigest() + "  /verify1.txt\n"
+            + hashlib.sha256("tampered").hexdigest() + "  /verify2.txt"
+    })
+    def test_put_verify_checks_remote_hashes_at_once(self):
+        """
+        put(verify='sha256') hashes uploads, and checks them with one command
+        """
+        self.mkfile('verify1.txt', 'one')
+        self.mkfile('verify2.txt', 'two')
+        with settings(hide('everything'), warn_only=True):
+            result = put(self.path('verify*.txt'), '/', verify='sha256')
+        eq_(result.hashes, {
+            '/verify1.txt': hashlib.sha256("one").hexdigest(),
+            '/verify2.txt': hashlib.sha256("two").hexdigest(),
+        })
+        eq_(result.verified, {'/verify1.txt': True, '/verify2.txt': False})
+        eq_(result.failed, [self.path('verify2.txt')])
+
+    @server(files={'/verify3.txt': 'three'}, responses={
+        "md5sum -- '/verify3.txt'":
+            hashlib.md5("three").hexdigest() + "  /verify3.txt"
+    })
+    def test_get_verify_checks_remote_hashes(self):
+        """
+        get(verify=...) hashes downloads, to files and file-like objects
+        """
+        local = self.path('verify3.txt')
+        fake_file = StringIO()
+        with hide('everything'):
+            result = get('/verify3.txt', local, verify='md5')
+            eq_(result.verified, {local: True})
+            result = get('/verify3.txt', fake_file, verify='md5')
+            eq_(result.verified, {'/verify3.txt': True})
+        eq_(result.hashes, {'/verify3.txt': hashlib.md5("three").hexdigest()})
+
+    @raises(ValueError)
+    def test_verify_needs_a_known_algorithm(self):
+        with settings(host_string='localhost'):
+            put(StringIO('x'), 'x', verify='crc32')
+
     #
     # Interactions with cd()
     #
@@ -998,6 +2063,66 @@ def test_local_output_and_capture():
                     del local.description
 
 
+@mock_streams('both')
+def test_local_stream_prints_and_captures():
+    with hide('running'):
+        result = local("echo one; echo two >&2; printf three", capture=True,
+            stream=True)
+    eq_(result, "one\nthree")
+    eq_(result.stderr, "two")
+    eq_(sys.stdout.getvalue(),
+        "[localhost] out: one\n[localhost] out: three\n")
+    eq_(sys.stderr.getvalue(), "[localhost] err: two\n")
+
+
+def test_local_records_elapsed_time():
+    with hide('everything'):
+        result = local("sleep 0.2", capture=True)
+    ok_(result.elapsed >= 0.2)
+
+
+def test_local_many_runs_commands_concurrently():
+    start = time.time()
+    with hide('everything'):
+        results = local_many(["sleep 0.5; echo %d" % i for i in range(4)],
+            max_workers=4)
+    ok_(time.time() - start < 1.5)
+    eq_(results, ["0", "1", "2", "3"])
+    ok_(all(result.elapsed >= 0.5 for result in results))
+
+
+@mock_streams('stdout')
+def test_local_many_prefixes_lines_with_names():
+    with hide('running'):
+        results = local_many({'css': "echo a; echo b", 'js': "echo c"})
+    eq_(results['css'], "a\nb")
+    eq_(results['js'], "c")
+    lines = sorted(sys.stdout.getvalue().splitlines())
+    eq_(lines, ["[css] out: a", "[css] out: b", "[js] out: c"])
+
+
+class TestLocalMany(FabricTest):
+    def test_failures_are_reported_after_all_commands_ran(self):
+        marker = self.path('marker')
+        with hide('everything', 'aborts'):
+            try:
+                local_many(["exit 3", "sleep 0.2; touch %s" % marker],
+                    max_workers=2)
+            except SystemExit:
+                pass
+            else:
+                assert False, "Failure didn't abort"
+        ok_(os.path.exists(marker))
+
+    def test_warn_only_returns_failed_results(self):
+        with hide('everything'):
+            with settings(warn_only=True):
+                results = local_many(["exit 3", "true"])
+        eq_(results[0].return_code, 3)
+        ok_(results[0].failed)
+        ok_(results[1].succeeded)
+
+
 class TestRunSudoReturnValues(FabricTest):
     @server()
     def test_returns_command_given(self):
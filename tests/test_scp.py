@@ -0,0 +1,255 @@
+from __future__ import with_statement
+
+import hashlib
+import os
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_, raises
+
+from fabric.api import cd, get, hide, put, settings
+from fabric.scp import Sink, glob_path, sink_command, source_command
+
+from utils import FabricTest, eq_contents
+from server import server, local_process
+from test_operations import FAKE_SUDO
+
+
+class LocalHost(dict):
+    """
+    Server responses running any command through the local /bin/sh, in a
+    stand-in home directory.
+    """
+    def __init__(self, home):
+        self.home = home
+        self.seen = []
+
+    def __contains__(self, command):
+        return True
+
+    def __getitem__(self, command):
+        self.seen.append(command)
+        return local_process(['/bin/sh', '-c', FAKE_SUDO + command],
+            environ={'HOME': self.home, 'LC_ALL': 'C'}, cwd=self.home)
+
+
+class FakeChannel(object):
+    """
+    Channel whose remote end writes ``stdout`` and ``stderr``, then exits
+    with ``status``.
+    """
+    def __init__(self, stdout, status=0, stderr=''):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.status = status
+        self.sent = []
+
+    def exec_command(self, command):
+        self.command = command
+
+    def makefile(self, mode):
+        return StringIO(self.stdout)
+
+    def makefile_stderr(self, mode):
+        return StringIO(self.stderr)
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def recv_exit_status(self):
+        return self.status
+
+    def shutdown_write(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeTransport(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def open_session(self):
+        return self.channel
+
+
+def _sink(responses, status, stderr=''):
+    """
+    A Sink whose remote end acknowledges the start, gives ``responses`` to
+    the records sent, then exits with ``status``.
+    """
+    channel = FakeChannel("/home\nd\0" + responses, status, stderr)
+    return Sink(FakeTransport(channel), "scp -t .")
+
+
+@raises(IOError)
+def test_sink_reports_remote_failures_at_the_end():
+    sink = _sink("\0\0", 1, "scp: ./x: No space left on device")
+    eq_(sink.send_file(StringIO('x'), 1, 'x', 0644), None)
+    sink.finish()
+
+
+def test_sink_exit_status_may_be_for_refused_files():
+    sink = _sink("\1scp: x: Permission denied\n", 1)
+    eq_(sink.send_file(StringIO('x'), 1, 'x', 0644),
+        "scp: x: Permission denied")
+    sink.finish()
+
+
+def test_glob_path_leaves_wildcards_and_tilde():
+    eq_(glob_path("~/logs/*.log"), "~/logs/*.log")
+    eq_(glob_path("/a b/it's;[ab]?"), "/a\\ b/it\\'s\\;[ab]?")
+    eq_(glob_path("~user"), "~user")
+
+
+def test_commands_protect_leading_dashes():
+    eq_(source_command("-rf"), "scp -r -f ./-rf")
+    ok_(sink_command("-x").endswith("exec scp -r -t './-x'"))
+
+
+@raises(ValueError)
+def test_put_refuses_options_scp_lacks():
+    with settings(host_string='localhost'):
+        put(StringIO('x'), 'x', sync=True, backend='scp')
+
+
+@raises(ValueError)
+def test_unknown_backends_are_refused():
+    with settings(host_string='localhost'):
+        get('x', StringIO(), backend='ftp')
+
+
+class TestSCP(FabricTest):
+    def setup(self):
+        super(TestSCP, self).setup()
+        self.home = self.path('home')
+        os.mkdir(self.home)
+        self.host = LocalHost(self.home)
+
+    def remote(self, *parts):
+        return os.path.join(self.home, *parts)
+
+    def tree(self):
+        os.makedirs(self.path('tree', 'sub'))
+        self.mkfile(os.path.join('tree', 'one'), 'one')
+        self.mkfile(os.path.join('tree', 'sub', 'two'), 'two')
+        return self.path('tree')
+
+    def test_put_and_get_tree(self):
+        """
+        put()/get(backend='scp') send whole trees over one remote scp each
+        """
+        tree = self.tree()
+
+        @server(responses=self.host)
+        def run():
+            with hide('everything'):
+                sent = put(tree, '', backend='scp')
+                received = get('tree', self.path('back'), backend='scp')
+            return sent, received
+        sent, received = run()
+        eq_(sorted(sent), [self.remote('tree', 'one'),
+            self.remote('tree', 'sub', 'two')])
+        eq_contents(self.remote('tree', 'sub', 'two'), 'two')
+        eq_(sorted(received), [self.path('back', 'tree', 'one'),
+            self.path('back', 'tree', 'sub', 'two')])
+        eq_contents(self.path('back', 'tree', 'sub', 'two'), 'two')
+        eq_(len(self.host.seen), 2)
+
+    def test_put_and_get_files(self):
+        """
+        put()/get(backend='scp') handle single files, globs and file objects
+        """
+        os.mkdir(self.remote('dir'))
+        self.mkfile('a.txt', 'a')
+        self.mkfile('b.txt', 'b')
+        received = StringIO()
+
+        @server(responses=self.host)
+        def run():
+            with settings(hide('everything'), transfer_backend='scp'):
+                with cd(self.remote('dir')):
+                    put(self.path('*.txt'), '.')
+                put(StringIO('data'), 'dir/c.bin')
+                get('dir/c.bin', received)
+                return get(self.remote('dir', '*.txt'),
+                    self.path('back', '%(basename)s'))
+        eq_(sorted(run()), [self.path('back', 'a.txt'),
+            self.path('back', 'b.txt')])
+        eq_contents(self.remote('dir', 'a.txt'), 'a')
+        eq_(received.getvalue(), 'data')
+
+    def test_verify(self):
+        """
+        put()/get(backend='scp', verify=...) check hashes of what they sent
+        """
+        tree = self.tree()
+
+        @server(responses=self.host)
+        def run():
+            with settings(hide('everything'), transfer_backend='scp'):
+                sent = put(tree, '', verify='sha1')
+                received = get('tree/sub', self.path('back'), verify='sha1')
+            return sent, received
+        sent, received = run()
+        eq_(sent.verified, {self.remote('tree', 'one'): True,
+            self.remote('tree', 'sub', 'two'): True})
+        eq_(sent.hashes[self.remote('tree', 'one')],
+            hashlib.sha1('one').hexdigest())
+        eq_(received.verified, {self.path('back', 'sub', 'two'): True})
+        eq_(len(self.host.seen), 4)
+
+    def test_put_applies_modes(self):
+        """
+        put(backend='scp') gives files exactly the requested mode
+        """
+        local = self.mkfile('script.sh', 'echo')
+        os.chmod(local, 0751)
+
+        @server(responses=self.host)
+        def run():
+            with hide('everything'):
+                put(local, 'exact.sh', mode=0604, backend='scp')
+                put(local, 'mirrored.sh', mirror_local_mode=True,
+                    backend='scp')
+        run()
+        eq_(os.stat(self.remote('exact.sh')).st_mode & 07777, 0604)
+        eq_(os.stat(self.remote('mirrored.sh')).st_mode & 07777, 0751)
+
+    def test_put_reports_refused_files(self):
+        """
+        put(backend='scp') lists files the remote scp refused on .failed
+        """
+        tree = self.tree()
+        # A directory where a file should go
+        os.makedirs(self.remote('tree', 'one'))
+
+        @server(responses=self.host)
+        def run():
+            with settings(hide('everything'), warn_only=True):
+                return put(tree, '', backend='scp')
+        result = run()
+        eq_(result, [self.remote('tree', 'sub', 'two')])
+        eq_(result.failed, [os.path.join(tree, 'one')])
+
+    def test_put_with_sudo_moves_files_into_place_at_once(self):
+        """
+        put(use_sudo=True, backend='scp') stages files, then runs one sudo
+        """
+        tree = self.tree()
+
+        @server(responses=self.host)
+        def run():
+            with hide('everything'):
+                return put(tree, 'srv', use_sudo=True, mode=0640,
+                    backend='scp')
+        result = run()
+        eq_(sorted(result), [self.remote('srv', 'tree', 'one'),
+            self.remote('srv', 'tree', 'sub', 'two')])
+        eq_contents(self.remote('srv', 'tree', 'sub', 'two'), 'two')
+        eq_(os.stat(self.remote('srv', 'tree', 'one')).st_mode & 07777,
+            0640)
+        eq_(len(self.host.seen), 2)
+        ok_(self.host.seen[1].endswith("/finalize.sh'"), self.host.seen[1])
+        # Nothing left behind
+        eq_(os.listdir(self.home), ['srv'])
@@ -0,0 +1,163 @@
+from __future__ import with_statement
+
+import os
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from fabric.api import cd, hide, run, settings, sudo
+from fabric.exceptions import CommandTimeout
+from fabric.shell import FrameReader, shells
+from fabric.state import env
+
+from utils import FabricTest, password_response
+from server import server, local_process, PASSWORDS, USER
+
+
+#
+# FrameReader
+#
+
+def _reader(chunks, with_status=True):
+    chunks = list(reversed(chunks))
+    return FrameReader(lambda size: chunks.pop() if chunks else '', 'SENT',
+        with_status)
+
+def _read_all(reader):
+    result = []
+    while True:
+        data = reader(4096)
+        if data == '':
+            return "".join(result)
+        result.append(data)
+
+
+def test_frame_reader_stops_at_sentinel_and_parses_status():
+    reader = _reader(["output\n", "SENT3\n", "next command's"])
+    eq_(_read_all(reader), "output\n")
+    eq_(reader.status, 3)
+
+
+def test_frame_reader_handles_sentinel_split_across_reads():
+    reader = _reader(["out", "putSE", "NT", "12", "7\n"])
+    eq_(_read_all(reader), "output")
+    eq_(reader.status, 127)
+
+
+def test_frame_reader_does_not_hold_back_unrelated_output():
+    reader = _reader(["sudo password:", "SENT\n"], with_status=False)
+    eq_(reader(4096), "sudo password:")
+    eq_(reader(4096), "")
+    ok_(reader.finished)
+
+
+def test_frame_reader_returns_leftovers_if_stream_ends_early():
+    reader = _reader(["partial", "SEN"])
+    eq_(_read_all(reader), "partialSEN")
+    ok_(reader.finished)
+    eq_(reader.status, None)
+
+
+#
+# Persistent shells, talking to a real local /bin/sh
+#
+
+# Stands in for sudo: remembers a successful 'sudo -v' in $FAB_AUTH, and runs
+# commands as the current user.
+FAKE_SUDO = """sudo() {
+    if [ "$1" = -n ]; then [ -f "$FAB_AUTH" ]; return; fi
+    shift 3
+    if [ "$1" = -v ]; then
+        IFS= read -r pw
+        [ "$pw" = '%s' ] && touch "$FAB_AUTH"
+        return
+    fi
+    [ -f "$FAB_AUTH" ] || { echo "sudo: no password" >&2; return 1; }
+    "$@"
+}
+""" % PASSWORDS[USER]
+
+STARTED = []
+
+
+def local_shell(channel):
+    """
+    Server response hooking the channel up to a local /bin/sh.
+    """
+    STARTED.append(channel)
+    auth = tempfile.mktemp()
+    try:
+        return local_process(['/bin/sh'], stdin=FAKE_SUDO,
+            environ={'FAB_AUTH': auth})(channel)
+    finally:
+        if os.path.exists(auth):
+            os.remove(auth)
+
+
+class TestPersistentShell(FabricTest):
+    def env_setup(self):
+        super(TestPersistentShell, self).env_setup()
+        env.use_shell = True
+        env.shell = '/bin/sh -c'
+        env.persistent_shell = True
+        del STARTED[:]
+
+    def teardown(self):
+        shells.clear()
+        super(TestPersistentShell, self).teardown()
+
+    @server(responses={'/bin/sh': local_shell})
+    def test_commands_share_one_shell(self):
+        with hide('everything'):
+            eq_(run("echo one"), "one")
+            eq_(run("echo two"), "two")
+        eq_(len(STARTED), 1)
+
+    @server(responses={'/bin/sh': local_shell})
+    def test_return_codes_and_stderr(self):
+        with settings(hide('everything'), warn_only=True):
+            result = run("echo out; echo err >&2; exit 3",
+                combine_stderr=False)
+            eq_(result, "out")
+            eq_(result.stderr, "err")
+            eq_(result.return_code, 3)
+            ok_(result.failed)
+            eq_(run("echo out; echo err >&2"), "out\nerr")
+            # Syntax errors are confined to their own command.
+            ok_(run("echo 'unbalanced").failed)
+            eq_(run("echo fine"), "fine")
+        eq_(len(STARTED), 1)
+
+    @server(responses={'/bin/sh': local_shell})
+    def test_commands_do_not_leak_state(self):
+        with hide('everything'):
+            run("cd /; FOO=bar")
+            ok_(run("pwd") != "/")
+            eq_(run("echo x${FOO}x"), "xx")
+            with cd("/"):
+                eq_(run("pwd"), "/")
+
+    @server(responses={'/bin/sh': local_shell})
+    def test_sudo_authenticates_once(self):
+        with hide('everything'):
+            eq_(sudo("echo hi"), "hi")
+            eq_(sudo("echo again"), "again")
+        eq_(len(STARTED), 1)
+
+    @server(responses={'/bin/sh': local_shell})
+    def test_sudo_reprompts_for_bad_passwords(self):
+        env.password = 'wrong'
+        with hide('everything'):
+            with password_response(PASSWORDS[USER], times_called=1):
+                eq_(sudo("echo hi"), "hi")
+
+    @server(responses={'/bin/sh': local_shell})
+    def test_unfinished_commands_retire_the_shell(self):
+        with hide('everything'):
+            try:
+                run("sleep 2", timeout=1)
+            except CommandTimeout:
+                pass
+            else:
+                assert False, "Didn't time out"
+        ok_(not shells.values()[0].usable())
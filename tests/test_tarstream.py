@@ -0,0 +1,150 @@
+from __future__ import with_statement
+
+import os
+import stat
+
+from nose.tools import eq_, ok_, raises
+
+from fabric.api import get, put, hide, settings
+from fabric.contrib.project import upload_project
+from fabric.tarstream import compression, create_command, extract_command
+
+from utils import FabricTest
+from server import server, local_process
+
+
+def test_extract_command_quotes_directory():
+    eq_(extract_command("/srv/it's"), "tar -x -f - -C '/srv/it'\\''s'")
+    eq_(extract_command("~/app", 'gz'), "tar -xz -f - -C \"$HOME\"'/app'")
+    eq_(extract_command("", 'bz2'), "tar -xj -f -")
+
+
+def test_extract_command_with_sudo_never_prompts():
+    eq_(extract_command("/srv", use_sudo=True),
+        "sudo -n tar -x -f - -C '/srv'")
+    with settings(sudo_user='www'):
+        eq_(extract_command("/srv", use_sudo=True),
+            "sudo -n -u 'www' tar -x -f - -C '/srv'")
+
+
+def test_create_command_follows_links():
+    eq_(create_command("/var", ["log", "-x"], True),
+        "tar -cz -h -f - -C '/var' -- 'log' '-x'")
+
+
+def test_compression_names():
+    eq_(compression(True), 'gz')
+    eq_(compression(None), '')
+    eq_(compression('bz2'), 'bz2')
+
+
+@raises(ValueError)
+def test_unknown_compression_is_refused():
+    compression('zip')
+
+
+class TestTarStream(FabricTest):
+    def _make_tree(self, name, count):
+        os.makedirs(self.path(name, 'sub'))
+        os.mkdir(self.path(name, 'empty'))
+        for i in range(count):
+            self.mkfile(os.path.join(name, 'sub', '%d.txt' % i), str(i))
+        os.chmod(self.path(name, 'sub', '0.txt'), 0755)
+        return self.path(name)
+
+    def _remote(self, name):
+        # Stands in for the remote filesystem: the remote tar runs locally.
+        os.mkdir(self.path(name))
+        return self.path(name)
+
+    def test_put_streams_trees_of_many_small_files(self):
+        """
+        put() sends a tree of many small files as one tar stream
+        """
+        tree = self._make_tree('tree', 5)
+        remote = self._remote('remote')
+        command = extract_command('/streamed', options=('--no-same-owner',
+            '--no-same-permissions'))
+        responses = {command: local_process(['tar', '-x', '-f', '-', '-C',
+            remote, '--no-same-owner', '--no-same-permissions'])}
+
+        @server(responses=responses)
+        def run():
+            with settings(hide('everything'), put_stream_threshold=5):
+                return put(tree, '/streamed')
+        paths = run()
+        eq_(sorted(paths),
+            ['/streamed/tree/sub/%d.txt' % i for i in range(5)])
+        eq_(open(os.path.join(remote, 'tree', 'sub', '4.txt')).read(), "4")
+        ok_(os.path.isdir(os.path.join(remote, 'tree', 'empty')))
+        # Like an SFTP upload, local permissions aren't carried over
+        mode = os.stat(os.path.join(remote, 'tree', 'sub', '0.txt')).st_mode
+        ok_(not mode & stat.S_IXUSR)
+
+    @server()
+    def test_put_falls_back_to_sftp_without_remote_tar(self):
+        """
+        put() uploads trees over SFTP if the tar stream fails
+        """
+        tree = self._make_tree('tree', 5)
+        with settings(hide('everything'), put_stream_threshold=5):
+            paths = put(tree, '/streamed2')
+        eq_(len(paths), 5)
+        ok_(self.exists_remotely('/streamed2/tree/sub/4.txt'))
+        ok_(self.exists_remotely('/streamed2/tree/empty'))
+
+    def test_upload_project_can_stream(self):
+        """
+        upload_project(stream=True) pipes the project into a remote tar
+        """
+        project = self._make_tree('project', 3)
+        remote = self._remote('remote')
+        responses = {extract_command('/srv', 'bz2'):
+            local_process(['tar', '-xjf', '-', '-C', remote])}
+
+        @server(responses=responses)
+        def run():
+            with hide('everything'):
+                upload_project(project, '/srv', stream=True, compress='bz2')
+        run()
+        eq_(open(os.path.join(remote, 'project', 'sub', '2.txt')).read(), "2")
+        # No temporary archive is left behind
+        eq_(sorted(os.listdir(remote)), ['project'])
+
+    def test_get_can_stream_directories(self):
+        """
+        get(mode='stream') downloads a directory as one tar stream, with the
+        same local paths and return value as over SFTP
+        """
+        logs = self._make_tree(os.path.join('remote', 'logs'), 4)
+        responses = {create_command('/srv', ['logs'], 'gz'):
+            local_process(['tar', '-czhf', '-', '-C', self.path('remote'),
+                '--', 'logs'])}
+        target = self.path('local', '%(host)s', 'x', '%(path)s')
+
+        @server(responses=responses)
+        def run():
+            with hide('everything'):
+                put(logs, '/srv')
+                streamed = get('/srv/logs', target.replace('x', 'stream'),
+                    mode='stream', compress='gz')
+                sftp = get('/srv/logs', target.replace('x', 'sftp'))
+            return streamed, sftp
+        streamed, sftp = run()
+        eq_(sorted(streamed),
+            sorted(path.replace('sftp', 'stream') for path in sftp))
+        eq_(len(streamed), 4)
+        eq_(open([path for path in streamed
+            if path.endswith('3.txt')][0]).read(), "3")
+
+    @server()
+    def test_get_stream_failures_are_reported(self):
+        """
+        get(mode='stream') reports the remote tar failing
+        """
+        with hide('everything'):
+            put(self._make_tree('tree', 1), '/srv2')
+            with settings(warn_only=True):
+                result = get('/srv2/tree', self.path('local'),
+                    mode='stream')
+        eq_(result.failed, ['/srv2/tree'])
@@ -1,5 +1,6 @@
 from __future__ import with_statement
 
+import subprocess
 import sys
 from unittest import TestCase
 
@@ -8,7 +9,8 @@ from fudge.patcher import with_patched_object
 from nose.tools import eq_, raises
 
 from fabric.state import output, env
-from fabric.utils import warn, indent, abort, puts, fastprint, error, RingBuffer
+from fabric.utils import (warn, indent, abort, puts, fastprint, error,
+    RingBuffer, shell_quote)
 from fabric import utils  # For patching
 from fabric.context_managers import settings, hide
 from fabric.colors import magenta, red
@@ -223,3 +225,14 @@ class TestRingBuffer(TestCase):
         self.b.extend("abcde")
         self.b.extend("fgh")
         eq_(self.b, ['d', 'e', 'f', 'g', 'h'])
+
+
+def test_shell_quote_makes_one_literal_word():
+    """
+    shell_quote() output reaches the shell's command as is
+    """
+    for string in ("plain", "it's", "$HOME `id` \"q\" \\", "a b\nc", ""):
+        out = subprocess.Popen(['/bin/sh', '-c',
+            "printf '%%s' %s" % shell_quote(string)],
+            stdout=subprocess.PIPE).communicate()[0]
+        eq_(out, string)